@@ -53,23 +53,61 @@
 # -------------------------------------------------
 # Getting libraries and utilities
 # -------------------------------------------------
+import argparse
 import cdsapi
 import calendar
 import datetime
+import hashlib
 import json
+import math
 import os
-from multiprocessing import Pool
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import forcing_catalogue
+import forcing_check
+import task_events
+import task_shards
+from download_scheduler import ConcurrencyController, call_with_retries, run_task_queue
+from forcing_cache import ForcingCache, DEFAULT_CACHE_DIR, DEFAULT_QUOTA_GB
+from netcdf_encoding import write_netcdf
+from request_planner import MB, grid_points, estimate_bytes, day_ranges, print_plan
+from tiling import domain_tiles, mosaic
+from zarr_store import MonthlyZarrStore, time_dim
+
+# Default download options (may be overridden in era5_crocotools_param)
+resume = True                            # skip pieces already recorded in the manifest
+manifest_name = 'ERA5_manifest.jsonl'    # manifest file, written inside era5_dir_raw
+max_in_flight = 4                        # CDS requests running at the same time
+adaptive_concurrency = True              # adapt the CDS requests in flight to their throughput and errors, from max_in_flight
+max_in_flight_limit = 16                 # most CDS requests in flight with adaptive_concurrency
+requests_per_minute = 30                 # rate of new CDS requests
+max_retries = 4                          # retries of a failed request
+retry_delay = 30                         # base delay (s) of the exponential backoff
+batch_requests = False                   # group variables and months into single CDS requests
+batch_max_months = 12                    # months per batched request
+batch_max_fields = 120000                # CDS limit on fields (variables x days x times) per request
+static_variables = ['land_sea_mask']     # fields fetched once, not once per month
+request_target_mb = 500                  # batched requests grow up to this estimated size
+request_max_mb = 4000                    # larger requests are split into day ranges
+era5_resolution = 0.25                   # grid step (degrees) used to estimate request sizes
+tile_deg = None                          # split the area into tiles of this size (degrees), fetched concurrently
+nc_encoding = {'complevel': 1, 'packing': 'float32', 'variables': {}}  # files written here (netcdf_encoding.py)
+zarr_store = None                        # Zarr store receiving a copy of all the months, one group per variable
+verify_outputs = True                    # check the monthly files after the downloads, download the bad ones again
+max_nan_fraction = 0.99                  # files whose data sample has more missing values are bad
+contiguous_requests = False              # batched requests without duplicated n_overlap days
+use_cache = False                        # serve requests from the shared forcing cache
+cache_dir = DEFAULT_CACHE_DIR            # location of the shared forcing cache
+cache_quota_gb = DEFAULT_QUOTA_GB        # disk quota of the shared forcing cache
 
 # Importing utility function from ERA5_utilities
 from ERA5_utilities import addmonths4date
 from era5_crocotools_param import *  # Import parameters like `year_start`, `month_start`, `area`, etc.
 
-# Print parameters for confirmation
-print('Year start:', year_start)
-print('Year end:', year_end)
-print('Month start:', month_start)
-print('Month end:', month_end)
-
 # Adjust area if `ownArea` is not set
 dl = 2
 if ownArea == 0:
@@ -89,9 +127,6 @@ lonmin = str(float(lonmin) - dl)
 lonmax = str(float(lonmax) + dl)
 latmin = str(float(latmin) - dl)
 latmax = str(float(latmax) + dl)
-print('Adjusted area:')
-print('lonmin =', lonmin, ', lonmax =', lonmax)
-print('latmin =', latmin, ', latmax =', latmax)
 
 # Define area
 area = [latmax, lonmin, latmin, lonmax]
@@ -103,11 +138,228 @@ os.makedirs(era5_dir_raw, exist_ok=True)
 with open('ERA5_variables.json', 'r') as jf:
     era5 = json.load(jf)
 
-
-# Function to download all variables for a specific date
-def download_data_by_date(year, month, area, era5, variables, era5_dir_raw, n_overlap):
-    c = cdsapi.Client()
-
+# Manifest of completed downloads
+manifest_file = os.path.join(era5_dir_raw, manifest_name)
+
+# Shared cache of forcing downloads
+cache = ForcingCache(cache_dir, cache_quota_gb) if use_cache else None
+
+# CDS requests in flight across all tasks, tiles and day ranges; with adaptive_concurrency
+# the limit follows the throughput and errors of the download tasks, and the task
+# threads are started up to its largest value
+if adaptive_concurrency:
+    cds_slots = ConcurrencyController(max_in_flight, max_limit=max_in_flight_limit, sources=('era5', 'era5-requeue'))
+    task_threads = max_in_flight_limit
+else:
+    cds_slots = threading.BoundedSemaphore(max_in_flight)
+    task_threads = max_in_flight
+
+
+# Function to compute the checksum of a downloaded file
+def file_checksum(path, blocksize=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Function to build the manifest key of a request (variable, dates, area, time, ...)
+def manifest_key(product, options):
+    return json.dumps([product, options], sort_keys=True)
+
+
+# Function to read the manifest, the last entry of a key wins
+def load_manifest(manifest_file):
+    entries = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a killed run
+                entries[entry['key']] = entry
+    return entries
+
+
+# Function to append one entry to the manifest (a single O_APPEND write, safe across workers)
+def record_manifest(manifest_file, entry):
+    line = (json.dumps(entry, sort_keys=True) + '\n').encode()
+    fd = os.open(manifest_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+# Function to check that a file starts like a NetCDF (classic or HDF5) file
+def is_netcdf(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    return magic[:3] == b'CDF' or magic == b'\x89HDF'
+
+
+# Function to check whether an output file matches its manifest entry
+def is_complete(output, entry):
+    if entry is None or not os.path.exists(output):
+        return False
+    st = os.stat(output)
+    if st.st_size != entry['size']:
+        return False
+    if st.st_mtime_ns == entry.get('mtime_ns'):
+        return True  # untouched since it was recorded
+    return file_checksum(output) == entry['sha256']
+
+
+# Function to validate a temporary file, move it in place and record it in the manifest
+def commit_file(tmp, output, key, manifest_file, allow_zip=False):
+    if os.path.getsize(tmp) == 0 or not (is_netcdf(tmp) or (allow_zip and zipfile.is_zipfile(tmp))):
+        raise IOError(f'{tmp} is not a valid NetCDF file')
+    entry = {
+        'key': key,
+        'file': os.path.basename(output),
+        'size': os.path.getsize(tmp),
+        'sha256': file_checksum(tmp),
+    }
+    os.replace(tmp, output)
+    entry['mtime_ns'] = os.stat(output).st_mtime_ns
+    record_manifest(manifest_file, entry)
+    # Chunks of the contiguous mode are temporary, only the monthly files are catalogued
+    if not allow_zip:
+        forcing_catalogue.record(output, 'era5', json.loads(key)[0], entry['sha256'])
+
+
+# Function to estimate the size (bytes) of a CDS request
+def estimate_request(options):
+    north, west, south, east = [float(x) for x in options['area']]
+    npoints = grid_points(south, north, era5_resolution) * grid_points(west, east, era5_resolution)
+    nvars = len(options['variable']) if isinstance(options['variable'], list) else 1
+    return estimate_bytes(npoints, 1, count_fields(options, nvars))
+
+
+# Function to split a request into tiles of tile_deg degrees (if set), and the
+# tiles above request_max_mb into day ranges
+def split_request(options):
+    tiles = [options]
+    if tile_deg:
+        north, west, south, east = [float(x) for x in options['area']]
+        tiles = [dict(options, area=[str(y1), str(x0), str(y0), str(x1)])
+                 for x0, x1, y0, y1 in domain_tiles(west, east, south, north, tile_deg, era5_resolution)]
+
+    pieces = []
+    for tile in tiles:
+        npieces = math.ceil(estimate_request(tile) / (request_max_mb * MB))
+        if npieces <= 1:
+            pieces.append(tile)
+            continue
+        d0, d1 = [datetime.date.fromisoformat(d) for d in tile['date'].split('/')]
+        pieces.extend(dict(tile, date=f'{start}/{end}') for start, end in day_ranges(d0, d1, npieces))
+    return pieces
+
+
+# Function to retrieve a request; tiles and day ranges are fetched concurrently,
+# each retried on its own, and mosaicked / joined locally without loading whole fields
+def retrieve_split(c, product, options, target):
+    import xarray as xr
+
+    pieces = split_request(options)
+    if len(pieces) == 1:
+        with cds_slots:
+            c.retrieve(product, options, target)
+        return
+
+    print(f"Splitting {options['variable']} {options['date']} into {len(pieces)} requests")
+    workdir = f'{target}.pieces'
+    os.makedirs(workdir, exist_ok=True)
+
+    # Pieces fetched by an earlier attempt are kept, only the missing ones are requested
+    def fetch(i):
+        piece_file = os.path.join(workdir, f'piece{i}')
+        if not os.path.exists(piece_file):
+            with cds_slots:
+                cdsapi.Client().retrieve(product, pieces[i], f'{piece_file}.part')
+            os.replace(f'{piece_file}.part', piece_file)
+        return piece_file
+
+    # The pool threads retry their pieces under the handle of the request
+    handle = task_events.current()
+
+    def fetch_with_retries(i):
+        with task_events.bound(handle):
+            return call_with_retries(fetch, i, max_retries, retry_delay)
+
+    with ThreadPoolExecutor(max_workers=min(len(pieces), task_threads)) as executor:
+        futures = [executor.submit(fetch_with_retries, i) for i in range(len(pieces))]
+    piece_files = [future.result() for future in futures]
+
+    datasets = []
+    try:
+        tiles = {}
+        for i, (piece, piece_file) in enumerate(zip(pieces, piece_files)):
+            ds = open_cds_download(piece_file, os.path.join(workdir, str(i)))
+            datasets.append(ds)
+            tiles.setdefault(piece['date'], []).append(ds)
+        parts = [mosaic(tiles[date]) for date in sorted(tiles)]
+        tdim = 'valid_time' if 'valid_time' in parts[0].dims else 'time'
+        combined = parts[0] if len(parts) == 1 else \
+            xr.concat(parts, dim=tdim, data_vars='minimal', coords='minimal', compat='override')
+        write_netcdf(combined, target, **nc_encoding)
+    finally:
+        for ds in datasets:
+            ds.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Function to download one request into a temporary file and move it in place
+def retrieve_atomic(c, product, options, output, manifest_file):
+    tmp = f'{output}.part{os.getpid()}'
+    try:
+        retrieve_split(c, product, options, tmp)
+        task_events.current().add_bytes(os.path.getsize(tmp))
+        commit_file(tmp, output, manifest_key(product, options), manifest_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# Function to describe a CDS request for the shared forcing cache
+def cache_request(product, options):
+    north, west, south, east = [float(x) for x in options['area']]
+    extra = {k: v for k, v in options.items() if k not in ('variable', 'area', 'date')}
+    return {
+        'source': 'era5',
+        'dataset': product,
+        'variables': [options['variable']],
+        'bbox': [west, east, south, north],
+        'time': options['date'].split('/'),
+        'extra': extra,
+    }
+
+
+# Function to serve one monthly file from the shared cache, True on a hit
+def fetch_from_cache(product, options, output):
+    if cache is None:
+        return False
+    tmp = f'{output}.part{os.getpid()}'
+    try:
+        if not cache.fetch(cache_request(product, options), tmp):
+            return False
+        commit_file(tmp, output, manifest_key(product, options), manifest_file)
+        return True
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# Function to add one monthly file to the shared cache
+def store_in_cache(product, options, output):
+    if cache is not None:
+        cache.store(cache_request(product, options), output)
+
+
+# Function to build the CDS request of one variable for one month
+def build_request(year, month, vname, area, era5, n_overlap):
     # Number of days in the month
     days_in_month = calendar.monthrange(year, month)[1]
 
@@ -123,76 +375,608 @@ def download_data_by_date(year, month, area, era5, variables, era5_dir_raw, n_ov
     datestr_end_overlap = datetime.date.fromordinal(n_end + n_overlap).strftime('%Y-%m-%d')
     vdate = datestr_start_overlap + '/' + datestr_end_overlap
 
-    # Loop over variables for this date
-    for vname in variables:
-        vlong = era5[vname][0]
-        vlevt = era5[vname][3]
-
-        # Request options
-        options = {
-            'product_type': 'reanalysis',
-            'type': 'an',
-            'date': vdate,
-            'variable': vlong,
-            'levtype': vlevt,
-            'area': area,
-            'format': 'netcdf',
-        }
-
-        if vlong == 'sea_surface_temperature':
-            options['time'] = '00'
-        elif vlong == 'land_sea_mask':
-            options['time'] = '00:00'
-        else:
-            options['time'] = time
+    vlong = era5[vname][0]
+    vlevt = era5[vname][3]
+
+    # Request options
+    options = {
+        'product_type': 'reanalysis',
+        'type': 'an',
+        'date': vdate,
+        'variable': vlong,
+        'levtype': vlevt,
+        'area': area,
+        'format': 'netcdf',
+    }
+
+    if vlong == 'sea_surface_temperature':
+        options['time'] = '00'
+    elif vlong == 'land_sea_mask':
+        options['time'] = '00:00'
+    else:
+        options['time'] = time
+
+    if vlong in ['specific_humidity', 'relative_humidity']:
+        options['pressure_level'] = '1000'
+        product = 'reanalysis-era5-pressure-levels'
+    else:
+        product = 'reanalysis-era5-single-levels'
+
+    # Output filename
+    fname = f'ERA5_ecmwf_{vname.upper()}_Y{year}M{str(month).zfill(2)}.nc'
+    return product, options, fname
+
+
+# Function to download one variable for one month (raises on failure)
+def download_variable(c, year, month, vname, area, era5, era5_dir_raw, n_overlap, manifest):
+    product, options, fname = build_request(year, month, vname, area, era5, n_overlap)
+    output = os.path.join(era5_dir_raw, fname)
+
+    # Skip pieces already downloaded and verified
+    if resume and is_complete(output, manifest.get(manifest_key(product, options))):
+        print(f"Skipping {fname} - already complete")
+        return
+
+    # Serve it from the shared cache if possible
+    if fetch_from_cache(product, options, output):
+        return
+
+    # Print info
+    print(f"Downloading {options['variable']} for {year}-{month}...")
+
+    # Perform the download
+    retrieve_atomic(c, product, options, output, manifest_file)
+    store_in_cache(product, options, output)
+    print(f"Downloaded {fname}")
+
+
+# Function to list the (year, month) combinations of a date range
+def month_range(start_year, start_month, end_year, end_month):
+    monthly_date_start = datetime.datetime(start_year, start_month, 1)
+    monthly_date_end = datetime.datetime(end_year, end_month, 1)
 
-        if vlong in ['specific_humidity', 'relative_humidity']:
-            options['pressure_level'] = '1000'
-            product = 'reanalysis-era5-pressure-levels'
-        else:
-            product = 'reanalysis-era5-single-levels'
+    len_monthly_dates = (monthly_date_end.year - monthly_date_start.year) * 12 + \
+                        (monthly_date_end.month - monthly_date_start.month) + 1
+
+    return [(monthly_date_start.year + (monthly_date_start.month + i - 1) // 12,
+             (monthly_date_start.month + i - 1) % 12 + 1)
+            for i in range(len_monthly_dates)]
+
+
+# Parallel processing over (month, variable) tasks from one shared queue
+def process_dates_in_parallel(start_year, start_month, end_year, end_month, area, era5, variables, era5_dir_raw, n_overlap):
+    # Generate list of year-month combinations
+    dates = month_range(start_year, start_month, end_year, end_month)
+
+    # Read the manifest once for all workers
+    manifest = load_manifest(manifest_file) if resume else {}
 
-        # Output filename
-        fname = f'ERA5_ecmwf_{vname.upper()}_Y{year}M{str(month).zfill(2)}.nc'
-        output = os.path.join(era5_dir_raw, fname)
+    # One CDS client per worker thread, reused for all its tasks
+    local = threading.local()
 
-        # Print info
-        print(f"Downloading {vlong} for {year}-{month}...")
+    def run(task):
+        year, month, vname = task
+        if not hasattr(local, 'client'):
+            local.client = cdsapi.Client()
+        download_variable(local.client, year, month, vname, area, era5, era5_dir_raw, n_overlap, manifest)
 
-        # Perform the download
+    # Prepare tasks
+    tasks = [(year, month, vname) for year, month in dates for vname in variables]
+
+    # Process tasks with a cap on requests in flight
+    return run_task_queue(tasks, run, max_in_flight=task_threads,
+                          requests_per_minute=requests_per_minute,
+                          max_retries=max_retries, base_delay=retry_delay, source='era5', shard=shard)
+
+
+# Function to count the fields (variables x days x times) of a request
+def count_fields(options, nvars):
+    d0, d1 = options['date'].split('/')
+    ndays = (datetime.date.fromisoformat(d1) - datetime.date.fromisoformat(d0)).days + 1
+    ntimes = len(options['time']) if isinstance(options['time'], (list, tuple)) else 1
+    return nvars * ndays * ntimes
+
+
+# Function to group the pending (month, variable) tasks into batched requests
+def plan_batches(pending, area, era5, n_overlap):
+    # Group variables sharing product, levtype, time and pressure level
+    groups = {}
+    for year, month, vname in pending:
+        if era5[vname][0] in static_variables:
+            continue
+        product, options, _ = build_request(year, month, vname, area, era5, n_overlap)
+        spec = json.dumps([product, options['levtype'], options['time'],
+                           options.get('pressure_level')], sort_keys=True)
+        groups.setdefault(spec, {}).setdefault((year, month), []).append(vname)
+
+    # Merge consecutive months of a group while the request stays below the CDS
+    # limits and the target size
+    batches = []
+    for months in groups.values():
+        current, current_vars = [], None
+        for ym in sorted(months):
+            vnames = tuple(sorted(months[ym]))
+            if current:
+                prev_year, prev_month = current[-1]
+                consecutive = ym == (prev_year + prev_month // 12, prev_month % 12 + 1)
+                _, trial = build_batch_request(current + [ym], vnames, area, era5, n_overlap)
+                if (not consecutive or vnames != current_vars or len(current) >= batch_max_months
+                        or count_fields(trial, len(vnames)) > batch_max_fields
+                        or estimate_request(trial) > request_target_mb * MB):
+                    batches.append((current_vars, tuple(current), False))
+                    current = []
+            current.append(ym)
+            current_vars = vnames
+        if current:
+            batches.append((current_vars, tuple(current), False))
+
+    # Static fields are fetched once and shared by all months
+    static = {}
+    for year, month, vname in pending:
+        if era5[vname][0] in static_variables:
+            static.setdefault(vname, []).append((year, month))
+    batches.extend(((vname,), tuple(months), True) for vname, months in static.items())
+    return batches
+
+
+# Function to build the CDS request covering several variables and consecutive months
+def build_batch_request(months, vnames, area, era5, n_overlap, pad_start=True, pad_end=True):
+    (y0, m0), (y1, m1) = months[0], months[-1]
+    product, options, _ = build_request(y0, m0, vnames[0], area, era5, n_overlap if pad_start else 0)
+    _, last, _ = build_request(y1, m1, vnames[0], area, era5, n_overlap if pad_end else 0)
+    options = dict(options)
+    options['date'] = options['date'].split('/')[0] + '/' + last['date'].split('/')[1]
+    options['variable'] = [era5[vname][0] for vname in vnames]
+    return product, options
+
+
+# Function to open a CDS download, which may be a zip of several NetCDF files
+def open_cds_download(path, workdir):
+    import xarray as xr
+
+    if not zipfile.is_zipfile(path):
+        return xr.open_dataset(path, chunks={})
+    with zipfile.ZipFile(path) as zf:
+        members = [zf.extract(name, workdir) for name in zf.namelist() if name.endswith('.nc')]
+    return xr.merge([xr.open_dataset(m, chunks={}) for m in members], compat='override')
+
+
+# Function to find a variable of a CDS dataset from its ERA5 short name
+def find_variable(ds, vname):
+    for name in ds.data_vars:
+        if name.lower() == vname.lower() or \
+                str(ds[name].attrs.get('GRIB_shortName', '')).lower() == vname.lower():
+            return name
+    raise KeyError(f'{vname} not found in {list(ds.data_vars)}')
+
+
+# Function to write the per-variable monthly files of a batched download
+def split_batch(combined, vnames, months, area, era5, era5_dir_raw, n_overlap):
+    tdim = 'valid_time' if 'valid_time' in combined.dims else 'time'
+    for vname in vnames:
+        name = find_variable(combined, vname)
+        for year, month in months:
+            product, options, fname = build_request(year, month, vname, area, era5, n_overlap)
+            output = os.path.join(era5_dir_raw, fname)
+            d0, d1 = options['date'].split('/')
+            ds_month = combined[[name]].sel({tdim: slice(d0, d1 + 'T23:59:59')})
+            tmp = f'{output}.part{os.getpid()}'
+            try:
+                write_netcdf(ds_month, tmp, **nc_encoding)
+                commit_file(tmp, output, manifest_key(product, options), manifest_file)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            store_in_cache(product, options, output)
+            print(f"Split {fname}")
+
+
+# Function to download one batch and split it into the per-variable monthly files
+def download_batch(c, batch, area, era5, era5_dir_raw, n_overlap):
+    vnames, months, is_static = batch
+
+    # Static fields: download the first month once, then link it for the others
+    if is_static:
+        (y0, m0), vname = months[0], vnames[0]
+        product, options, fname = build_request(y0, m0, vname, area, era5, n_overlap)
+        first = os.path.join(era5_dir_raw, fname)
+        print(f"Downloading {options['variable']} once for {len(months)} months...")
+        retrieve_atomic(c, product, options, first, manifest_file)
+        for year, month in months[1:]:
+            product, options, fname = build_request(year, month, vname, area, era5, n_overlap)
+            output = os.path.join(era5_dir_raw, fname)
+            tmp = f'{output}.part{os.getpid()}'
+            try:
+                os.link(first, tmp)
+            except OSError:
+                shutil.copyfile(first, tmp)
+            commit_file(tmp, output, manifest_key(product, options), manifest_file)
+        return
+
+    product, options = build_batch_request(months, vnames, area, era5, n_overlap)
+    label = f"{','.join(vnames)} for {months[0][0]}-{months[0][1]}..{months[-1][0]}-{months[-1][1]}"
+    print(f"Downloading {label}...")
+
+    workdir = tempfile.mkdtemp(prefix='ERA5_batch_', dir=era5_dir_raw)
+    try:
+        combined_file = os.path.join(workdir, 'combined.nc')
+        retrieve_split(c, product, options, combined_file)
+        task_events.current().add_bytes(os.path.getsize(combined_file))
+        combined = open_cds_download(combined_file, workdir)
+        try:
+            split_batch(combined, vnames, months, area, era5, era5_dir_raw, n_overlap)
+        finally:
+            combined.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"Downloaded {label}")
+
+
+# Function to list the (month, variable) pieces that are missing or invalid;
+# with fetch, those found in the shared cache are copied in place instead
+def pending_tasks(dates, area, era5, variables, era5_dir_raw, n_overlap, fetch=True):
+    manifest = load_manifest(manifest_file) if resume else {}
+    pending = []
+    for year, month in dates:
+        for vname in variables:
+            product, options, fname = build_request(year, month, vname, area, era5, n_overlap)
+            output = os.path.join(era5_dir_raw, fname)
+            if resume and is_complete(output, manifest.get(manifest_key(product, options))):
+                continue
+            if fetch and fetch_from_cache(product, options, output):
+                continue
+            pending.append((year, month, vname))
+    return pending
+
+
+# Batched processing: several variables and months per CDS request, split locally
+def process_dates_batched(start_year, start_month, end_year, end_month, area, era5, variables, era5_dir_raw, n_overlap):
+    dates = month_range(start_year, start_month, end_year, end_month)
+    if shard is None:
+        pending = pending_tasks(dates, area, era5, variables, era5_dir_raw, n_overlap)
+    else:
+        # The workers must plan the same batches: all of them, the files already complete
+        # are skipped by the worker running the batch
+        pending = [(year, month, vname) for year, month in dates for vname in variables]
+
+    batches = plan_batches(pending, area, era5, n_overlap)
+    print(f"{len(pending)} monthly files pending, fetched with {len(batches)} CDS requests")
+
+    local = threading.local()
+
+    def run(batch):
+        if not hasattr(local, 'client'):
+            local.client = cdsapi.Client()
+        if shard is None:
+            download_batch(local.client, batch, area, era5, era5_dir_raw, n_overlap)
+            return
+        vnames, months, _ = batch
+        missing = pending_tasks(months, area, era5, vnames, era5_dir_raw, n_overlap)
+        if not missing:
+            print(f"Skipping {','.join(vnames)} for {months[0][0]}-{months[0][1]}..{months[-1][0]}-{months[-1][1]}"
+                  f" - already complete")
+        for part in plan_batches(missing, area, era5, n_overlap):
+            download_batch(local.client, part, area, era5, era5_dir_raw, n_overlap)
+
+    return run_task_queue(batches, run, max_in_flight=task_threads,
+                          requests_per_minute=requests_per_minute,
+                          max_retries=max_retries, base_delay=retry_delay, source='era5', shard=shard)
+
+
+# Function to decide which batches need the overlap days at their ends:
+# only the ends of a contiguous run of months, neighbours supply the rest
+def plan_padding(batches):
+    def shift(ym, n):
+        k = ym[0] * 12 + ym[1] - 1 + n
+        return k // 12, k % 12 + 1
+
+    padding = []
+    for vnames, months, _ in batches:
+        before = any(set(vnames) <= set(other[0]) and other[1][-1] == shift(months[0], -1) for other in batches)
+        after = any(set(vnames) <= set(other[0]) and other[1][0] == shift(months[-1], 1) for other in batches)
+        padding.append((not before, not after))
+    return padding
+
+
+# Function to download one contiguous chunk into the intermediate directory
+def download_chunk(c, batch, pad_start, pad_end, area, era5, chunk_dir, n_overlap, manifest):
+    vnames, months, _ = batch
+    product, options = build_batch_request(months, vnames, area, era5, n_overlap, pad_start, pad_end)
+    d0, d1 = options['date'].split('/')
+    output = os.path.join(chunk_dir, f"ERA5_chunk_{'-'.join(vnames).upper()}_{d0}_{d1}")
+    if resume and is_complete(output, manifest.get(manifest_key(product, options))):
+        return output
+    print(f"Downloading {','.join(vnames)} for {d0}..{d1}...")
+    tmp = f'{output}.part{os.getpid()}'
+    try:
+        retrieve_split(c, product, options, tmp)
+        task_events.current().add_bytes(os.path.getsize(tmp))
+        commit_file(tmp, output, manifest_key(product, options), manifest_file, allow_zip=True)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    print(f"Downloaded {os.path.basename(output)}")
+    return output
+
+
+# Function to write the monthly files of one variable from the contiguous chunks
+def assemble_months(vname, months, chunk_files, area, era5, era5_dir_raw, n_overlap):
+    import xarray as xr
+
+    workdir = tempfile.mkdtemp(prefix='ERA5_assemble_', dir=era5_dir_raw)
+    datasets = [open_cds_download(f, workdir) for f in chunk_files]
+    try:
+        tdim = 'valid_time' if 'valid_time' in datasets[0].dims else 'time'
+        pieces = [ds[[find_variable(ds, vname)]] for ds in datasets]
+        buffer = xr.concat(sorted(pieces, key=lambda ds: ds[tdim].values[0]), dim=tdim)
+        # A chunk padded for another variable of its batch can repeat the first steps of
+        # the next chunk of this variable
+        buffer = buffer.drop_duplicates(tdim).sortby(tdim)
+        for year, month in months:
+            product, options, fname = build_request(year, month, vname, area, era5, n_overlap)
+            output = os.path.join(era5_dir_raw, fname)
+            d0, d1 = options['date'].split('/')
+            ds_month = buffer.sel({tdim: slice(d0, d1 + 'T23:59:59')})
+            times = ds_month[tdim].values
+            if len(times) == 0 or str(times[0])[:10] != d0 or str(times[-1])[:10] != d1:
+                raise IOError(f'{fname}: chunks do not cover {d0}/{d1}')
+            tmp = f'{output}.part{os.getpid()}'
+            try:
+                write_netcdf(ds_month, tmp, **nc_encoding)
+                commit_file(tmp, output, manifest_key(product, options), manifest_file)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            store_in_cache(product, options, output)
+            print(f"Assembled {fname}")
+    finally:
+        for ds in datasets:
+            ds.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Contiguous processing: every time range is requested once, the overlap
+# days of each monthly file are sliced locally from the neighbouring chunks
+def process_dates_contiguous(start_year, start_month, end_year, end_month, area, era5, variables, era5_dir_raw, n_overlap):
+    dates = month_range(start_year, start_month, end_year, end_month)
+    pending = pending_tasks(dates, area, era5, variables, era5_dir_raw, n_overlap)
+    manifest = load_manifest(manifest_file) if resume else {}
+
+    batches = plan_batches(pending, area, era5, n_overlap)
+    chunks = [b for b in batches if not b[2]]
+    padding = dict(zip(chunks, plan_padding(chunks)))
+    print(f"{len(pending)} monthly files pending, fetched with {len(batches)} CDS requests")
+
+    chunk_dir = os.path.join(era5_dir_raw, 'ERA5_chunks')
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunk_files = {}
+    local = threading.local()
+
+    # Phase 1: download the contiguous chunks (and static fields)
+    def run(batch):
+        if not hasattr(local, 'client'):
+            local.client = cdsapi.Client()
+        if batch[2]:
+            download_batch(local.client, batch, area, era5, era5_dir_raw, n_overlap)
+        else:
+            pad_start, pad_end = padding[batch]
+            chunk_files[batch] = download_chunk(local.client, batch, pad_start, pad_end,
+                                                area, era5, chunk_dir, n_overlap, manifest)
+
+    failures = run_task_queue(batches, run, max_in_flight=task_threads,
+                              requests_per_minute=requests_per_minute,
+                              max_retries=max_retries, base_delay=retry_delay, source='era5')
+
+    # Phase 2: assemble the overlapping monthly files of each variable
+    for vname in variables:
+        months = [(year, month) for year, month, v in pending if v == vname]
+        files = [f for b, f in chunk_files.items() if vname in b[0]]
+        if era5[vname][0] in static_variables or not months or not files:
+            continue
         try:
-            c.retrieve(product, options, output)
-            print(f"Downloaded {fname}")
+            assemble_months(vname, months, files, area, era5, era5_dir_raw, n_overlap)
         except Exception as e:
-            print(f"Error downloading {vname} for {year}-{month}: {e}")
+            print(f"Failed to assemble {vname}: {e}")
+            failures.append(((vname, tuple(months)), e))
 
+    if not failures:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    return failures
 
-# Parallel processing over dates
-def process_dates_in_parallel(start_year, start_month, end_year, end_month, area, era5, variables, era5_dir_raw, n_overlap):
-    # Generate list of year-month combinations
-    monthly_date_start = datetime.datetime(start_year, start_month, 1)
-    monthly_date_end = datetime.datetime(end_year, end_month, 1)
 
-    len_monthly_dates = (monthly_date_end.year - monthly_date_start.year) * 12 + \
-                        (monthly_date_end.month - monthly_date_start.month) + 1
+# Function to list the (year, month, variable) files written by this worker of a sharded run
+def shard_files():
+    if batch_requests:
+        return {(year, month, vname) for vnames, months, _ in shard.done for year, month in months for vname in vnames}
+    return set(shard.done)
 
-    dates = [(monthly_date_start.year + (monthly_date_start.month + i - 1) // 12,
-              (monthly_date_start.month + i - 1) % 12 + 1)
-             for i in range(len_monthly_dates)]
 
-    # Prepare tasks
-    tasks = [(year, month, area, era5, variables, era5_dir_raw, n_overlap) for year, month in dates]
+# Function to list the monthly files of a (year, month, variable) task or of a batch
+def task_outputs(task):
+    items = [(year, month, vname) for year, month in task[1] for vname in task[0]] if batch_requests else [task]
+    return [os.path.join(era5_dir_raw, build_request(year, month, vname, area, era5, n_overlap)[2])
+            for year, month, vname in items]
 
-    # Process dates in parallel
-    with Pool() as pool:
-        pool.starmap(download_data_by_date, tasks)
 
+# Worker of a sharded run (SLURM job array or several processes, see task_shards.py),
+# None for a single worker: its (month, variable) tasks or batched requests are claimed
+# in era5_dir_raw/.claims, per domain and variables, and the check and Zarr copy only
+# see the files it wrote
+shard = task_shards.default_shard('era5', era5_dir_raw,
+                                  config=[area, time, n_overlap, {vname: era5[vname] for vname in variables}],
+                                  outputs=task_outputs)
 
-# Main execution
-process_dates_in_parallel(
-    year_start, month_start, year_end, month_end,
-    area, era5, variables, era5_dir_raw, n_overlap
-)
 
-# Print completion message
-print('ERA5 data request has been successfully completed!')
+# Function to copy the monthly files into the Zarr store, months written concurrently;
+# every variable has its own group as they do not share their time steps.
+# only: the (year, month, variable) files to copy, all by default
+def copy_to_zarr_store(start_year, start_month, end_year, end_month, area, era5, variables, era5_dir_raw, n_overlap,
+                       only=None):
+    dates = month_range(start_year, start_month, end_year, end_month)
+    stores = {}
+    tasks = []
+    for vname in variables:
+        _, options, _ = build_request(start_year, start_month, vname, area, era5, n_overlap)
+        per_day = len(options['time']) if isinstance(options['time'], list) else 1
+        stores[vname] = MonthlyZarrStore(zarr_store, (start_year, start_month),
+                                         lambda year, month, n=per_day: calendar.monthrange(year, month)[1] * n,
+                                         nc_encoding['packing'], group=vname.upper())
+        for year, month in dates:
+            _, _, fname = build_request(year, month, vname, area, era5, n_overlap)
+            if only is not None and (year, month, vname) not in only:
+                continue
+            if os.path.exists(os.path.join(era5_dir_raw, fname)):
+                tasks.append((year, month, vname))
+                # A static field is copied once, from its first month
+                if era5[vname][0] in static_variables:
+                    break
+
+    def run(task):
+        year, month, vname = task
+        _, _, fname = build_request(year, month, vname, area, era5, n_overlap)
+        workdir = tempfile.mkdtemp(prefix='ERA5_zarr_', dir=era5_dir_raw)
+        ds = open_cds_download(os.path.join(era5_dir_raw, fname), workdir)
+        try:
+            ds = ds[[find_variable(ds, vname)]].reset_coords(drop=True)
+            if era5[vname][0] in static_variables:
+                stores[vname].write_static(ds.isel({time_dim(ds): 0}, drop=True))
+            else:
+                stores[vname].write_month(ds, year, month)
+        finally:
+            ds.close()
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"Copied {fname} to {os.path.basename(zarr_store)}")
+
+    return run_task_queue(tasks, run, max_in_flight=max_in_flight, max_retries=0, source='era5-zarr')
+
+
+# Function to check the monthly files (variable, dates with the n_overlap days, missing values)
+# and to download the bad ones again; returns the files still bad as failures.
+# only: the (year, month, variable) files to check, all by default
+def verify_downloads(start_year, start_month, end_year, end_month, area, era5, variables, era5_dir_raw, n_overlap,
+                     only=None):
+    tasks, expected = {}, {}
+    for year, month in month_range(start_year, start_month, end_year, end_month):
+        for vname in variables:
+            if only is not None and (year, month, vname) not in only:
+                continue
+            product, options, fname = build_request(year, month, vname, area, era5, n_overlap)
+            output = os.path.join(era5_dir_raw, fname)
+            if not os.path.exists(output):
+                continue  # failed downloads are already reported
+            # Static fields may be copied from another month (batched requests)
+            d0, d1 = (None, None) if era5[vname][0] in static_variables else options['date'].split('/')
+            tasks[output] = (year, month, vname)
+            expected[output] = {'variables': [vname], 'start': d0, 'end': d1, 'max_nan': max_nan_fraction}
+
+    bad = forcing_check.scan(expected)
+    if not bad:
+        print(f"{len(expected)} files passed the integrity check")
+        return []
+    forcing_check.print_report(bad, len(expected))
+    for output in bad:
+        forcing_check.quarantine(output)
+        if cache is not None:
+            year, month, vname = tasks[output]
+            cache.discard(cache_request(*build_request(year, month, vname, area, era5, n_overlap)[:2]))
+
+    # The bad files are downloaded again one by one, whatever the request mode
+    local = threading.local()
+
+    def run(task):
+        year, month, vname = task
+        if not hasattr(local, 'client'):
+            local.client = cdsapi.Client()
+        download_variable(local.client, year, month, vname, area, era5, era5_dir_raw, n_overlap, {})
+
+    failures = run_task_queue([tasks[output] for output in bad], run, max_in_flight=task_threads,
+                              requests_per_minute=requests_per_minute,
+                              max_retries=max_retries, base_delay=retry_delay, source='era5-requeue')
+    failed = {task for task, _ in failures}
+    still_bad = forcing_check.scan({output: expected[output] for output in bad if tasks[output] not in failed})
+    for output, problems in still_bad.items():
+        forcing_check.quarantine(output)
+        failures.append((tasks[output], IOError('; '.join(problems))))
+    return failures
+
+
+# Function to print the requests of the run and their estimated size, downloading nothing
+def print_request_plan(start_year, start_month, end_year, end_month, area, era5, variables, era5_dir_raw, n_overlap):
+    dates = month_range(start_year, start_month, end_year, end_month)
+    pending = pending_tasks(dates, area, era5, variables, era5_dir_raw, n_overlap, fetch=False)
+
+    requests = []
+    if batch_requests or contiguous_requests:
+        for vnames, months, is_static in plan_batches(pending, area, era5, n_overlap):
+            (y0, m0), (y1, m1) = months[0], months[-1]
+            if is_static:
+                product, options, _ = build_request(y0, m0, vnames[0], area, era5, n_overlap)
+            else:
+                product, options = build_batch_request(months, vnames, area, era5, n_overlap)
+            requests.append((f"{','.join(vnames)} {y0}-{m0:02d}..{y1}-{m1:02d}", options))
+    else:
+        for year, month, vname in pending:
+            product, options, fname = build_request(year, month, vname, area, era5, n_overlap)
+            requests.append((fname, options))
+
+    print(f"{len(pending)} monthly files pending")
+    return print_plan([(label, len(split_request(options)), estimate_request(options))
+                       for label, options in requests])
+
+
+# Main execution, under the guard as the check processes (spawned) import this script again
+if __name__ == "__main__":
+    # Print parameters for confirmation
+    print('Year start:', year_start)
+    print('Year end:', year_end)
+    print('Month start:', month_start)
+    print('Month end:', month_end)
+    print('Adjusted area:')
+    print('lonmin =', lonmin, ', lonmax =', lonmax)
+    print('latmin =', latmin, ', latmax =', latmax)
+
+    parser = argparse.ArgumentParser(description="Download the ERA5 forcing of CROCO from the CDS.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the planned requests and their estimated size, download nothing")
+    args = parser.parse_args()
+    if args.dry_run:
+        print_request_plan(year_start, month_start, year_end, month_end,
+                           area, era5, variables, era5_dir_raw, n_overlap)
+        raise SystemExit(0)
+
+    if contiguous_requests and shard is not None:
+        raise SystemExit("contiguous_requests assemble every variable from all its chunks and cannot be sharded, "
+                         "use batch_requests")
+    if contiguous_requests:
+        process = process_dates_contiguous
+    elif batch_requests:
+        process = process_dates_batched
+    else:
+        process = process_dates_in_parallel
+    failures = process(
+        year_start, month_start, year_end, month_end,
+        area, era5, variables, era5_dir_raw, n_overlap
+    )
+
+    # Files of this run: all of them, or those written by this worker of a sharded run
+    only = shard_files() if shard is not None else None
+
+    # Check the monthly files, the bad ones are downloaded again
+    if verify_outputs:
+        failures += verify_downloads(year_start, month_start, year_end, month_end,
+                                     area, era5, variables, era5_dir_raw, n_overlap, only)
+
+    # Copy the monthly files into the Zarr store
+    if zarr_store:
+        failures += copy_to_zarr_store(year_start, month_start, year_end, month_end,
+                                       area, era5, variables, era5_dir_raw, n_overlap, only)
+
+    # Print the per-task summary, the changes of the CDS requests in flight and the completion message
+    task_events.finish()
+    if adaptive_concurrency:
+        cds_slots.print_history()
+    if failures:
+        print(f'ERA5 data request finished with {len(failures)} failed downloads:')
+        for task, e in failures:
+            print(f'  {task}: {e}')
+        raise SystemExit(1)
+    print('ERA5 data request has been successfully completed!')
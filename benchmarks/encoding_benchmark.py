@@ -0,0 +1,127 @@
+#===========================================================================
+# Bytes on disk and read-back time of the forcing files for several
+# NetCDF encodings (netcdf_encoding.py) against the xarray defaults
+#
+#  A synthetic month of ocean forcing (smooth fields plus noise, like the
+#  CMEMS and SODA outputs) is written once per encoding, then read back
+#  the way crocotools does (one horizontal slab per variable, time step
+#  and level) and as whole variables.
+#
+#  python benchmarks/encoding_benchmark.py --nx 240 --ny 180 --ntimes 5
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from netcdf_encoding import write_netcdf
+
+# name: settings of write_netcdf, None for the xarray defaults
+ENCODINGS = {
+    'default': None,
+    'zlib1-float32': {'complevel': 1, 'packing': 'float32'},
+    'zlib4-float32': {'complevel': 4, 'packing': 'float32'},
+    'zlib4-int16': {'complevel': 4, 'packing': 'int16'},
+    'zlib9-int16': {'complevel': 9, 'packing': 'int16'},
+}
+
+
+# Function to build a synthetic month of ocean forcing
+def synthetic_month(nx, ny, ntimes, nlevels, seed=0):
+    rng = np.random.default_rng(seed)
+    lon = np.linspace(80, 80 + nx / 12, nx)
+    lat = np.linspace(0, ny / 12, ny)
+    depth = np.geomspace(0.5, 5500, nlevels)
+    times = pd.date_range('2000-01-01', periods=ntimes)
+    x, y = np.meshgrid(np.linspace(0, 2 * np.pi, nx), np.linspace(0, np.pi, ny))
+    profile = np.exp(-depth / 500)[None, :, None, None]
+    phase = np.arange(ntimes)[:, None, None, None] / 10
+
+    def field(mean, amplitude, noise):
+        pattern = np.sin(x + phase) * np.cos(y)
+        return (mean + amplitude * profile * pattern
+                + noise * rng.standard_normal((ntimes, nlevels, ny, nx))).astype('f4')
+
+    dims = ('time', 'depth', 'latitude', 'longitude')
+    return xr.Dataset(
+        {
+            'zos': (dims[:1] + dims[2:], field(0, 0.5, 0.01)[:, 0]),
+            'uo': (dims, field(0, 0.3, 0.02)),
+            'vo': (dims, field(0, 0.3, 0.02)),
+            'thetao': (dims, field(4, 24, 0.05)),
+            'so': (dims, field(35, 1, 0.01)),
+        },
+        coords={'time': times, 'depth': depth, 'latitude': lat, 'longitude': lon})
+
+
+# Function to read a file back one horizontal slab at a time, as crocotools does
+def read_slabs(path):
+    with xr.open_dataset(path) as ds:
+        for name, variable in ds.data_vars.items():
+            for t in range(ds.sizes['time']):
+                if 'depth' in variable.dims:
+                    for k in range(ds.sizes['depth']):
+                        variable.isel(time=t, depth=k).values
+                else:
+                    variable.isel(time=t).values
+
+
+# Function to read the whole variables of a file back
+def read_all(path):
+    with xr.open_dataset(path) as ds:
+        return {name: variable.values for name, variable in ds.data_vars.items()}
+
+
+def timed(fn, *args):
+    start = time.monotonic()
+    result = fn(*args)
+    return time.monotonic() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare NetCDF encodings of the forcing files.")
+    parser.add_argument("--nx", type=int, default=240, help="Longitude points")
+    parser.add_argument("--ny", type=int, default=180, help="Latitude points")
+    parser.add_argument("--ntimes", type=int, default=5, help="Time steps")
+    parser.add_argument("--nlevels", type=int, default=50, help="Depth levels")
+    parser.add_argument("--encodings", nargs='+', choices=list(ENCODINGS), default=list(ENCODINGS), help="Encodings to compare")
+    parser.add_argument("--output", type=str, help="JSON file receiving the results")
+    args = parser.parse_args()
+
+    ds = synthetic_month(args.nx, args.ny, args.ntimes, args.nlevels)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_encoding_') as workdir:
+        for name in args.encodings:
+            path = os.path.join(workdir, f'{name}.nc')
+            settings = ENCODINGS[name]
+            if settings is None:
+                write_s, _ = timed(ds.to_netcdf, path)
+            else:
+                write_s, _ = timed(lambda: write_netcdf(ds, path, **settings))
+            slab_s, _ = timed(read_slabs, path)
+            full_s, values = timed(read_all, path)
+            error = max(float(np.nanmax(np.abs(values[v] - ds[v].values))) for v in values)
+            results.append({'encoding': name, 'bytes': os.path.getsize(path), 'write_s': write_s,
+                            'slab_read_s': slab_s, 'full_read_s': full_s, 'max_error': error})
+
+    base = results[0]['bytes']
+    print(f"{'encoding':<16} {'MB':>8} {'ratio':>6} {'write s':>8} {'slabs s':>8} {'full s':>8} {'max error':>10}")
+    for r in results:
+        print(f"{r['encoding']:<16} {r['bytes'] / 1e6:>8.1f} {r['bytes'] / base:>6.2f} {r['write_s']:>8.2f} "
+              f"{r['slab_read_s']:>8.2f} {r['full_read_s']:>8.2f} {r['max_error']:>10.2e}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#===========================================================================
+# Offline stand-in for cdsapi.Client, used by the benchmarks
+#
+#  retrieve() sleeps for the CDS queue delay, writes a synthetic ERA5
+#  NetCDF file for the requested variables, dates, times and area, and
+#  then sleeps as if the file had been transferred at the given bandwidth.
+#
+#  Environment:
+#    FAKE_CDS_QUEUE_DELAY  seconds spent queued per request (default 0.5)
+#    FAKE_CDS_BANDWIDTH    bytes/s of the transfer (default 50e6)
+#    FAKE_CDS_RESOLUTION   grid step in degrees (default 0.25)
+#    FAKE_CDS_LOG          JSON-lines file receiving one record per request
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+QUEUE_DELAY = float(os.environ.get('FAKE_CDS_QUEUE_DELAY', 0.5))
+BANDWIDTH = float(os.environ.get('FAKE_CDS_BANDWIDTH', 50e6))
+RESOLUTION = float(os.environ.get('FAKE_CDS_RESOLUTION', 0.25))
+LOG = os.environ.get('FAKE_CDS_LOG')
+
+# The HDF5 library is not thread-safe, files are written one at a time
+_write_lock = threading.Lock()
+
+# Short names of the ERA5 variables used by CROCO
+SHORT_NAMES = {
+    '10m_u_component_of_wind': 'u10',
+    '10m_v_component_of_wind': 'v10',
+    '2m_temperature': 't2m',
+    '2m_dewpoint_temperature': 'd2m',
+    'mean_sea_level_pressure': 'msl',
+    'sea_surface_temperature': 'sst',
+    'land_sea_mask': 'lsm',
+    'total_precipitation': 'tp',
+    'surface_net_solar_radiation': 'ssr',
+    'surface_thermal_radiation_downwards': 'strd',
+    'specific_humidity': 'q',
+    'relative_humidity': 'r',
+}
+
+
+class Client:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def retrieve(self, product, options, target):
+        start = time.time()
+        time.sleep(QUEUE_DELAY)
+
+        d0, d1 = options['date'].split('/')
+        hours = options['time'] if isinstance(options['time'], (list, tuple)) else [options['time']]
+        offsets = sorted(pd.Timedelta(hours=int(str(h)[:2])) for h in hours)
+        times = pd.DatetimeIndex([day + h for day in pd.date_range(d0, d1, freq='D') for h in offsets])
+
+        north, west, south, east = [float(x) for x in options['area']]
+        lat = np.arange(north, south - RESOLUTION / 2, -RESOLUTION)
+        lon = np.arange(west, east + RESOLUTION / 2, RESOLUTION)
+
+        variables = options['variable'] if isinstance(options['variable'], list) else [options['variable']]
+        rng = np.random.default_rng(len(times))
+        data = {SHORT_NAMES.get(v, v): (('valid_time', 'latitude', 'longitude'),
+                                        rng.random((len(times), len(lat), len(lon)), dtype='f4'))
+                for v in variables}
+        ds = xr.Dataset(data, coords={'valid_time': times, 'latitude': lat, 'longitude': lon})
+        with _write_lock:
+            ds.to_netcdf(target)
+
+        time.sleep(os.path.getsize(target) / BANDWIDTH)
+        if LOG:
+            with open(LOG, 'a') as f:
+                f.write(json.dumps({'stage': 'retrieve', 'start': start, 'end': time.time(),
+                                    'bytes': os.path.getsize(target)}) + '\n')
@@ -0,0 +1,81 @@
+#===========================================================================
+# Offline stand-in for the copernicusmarine Python API, used by the
+# benchmarks (the `copernicusmarine` command next to it shares the data)
+#
+#  open_dataset() sleeps for the login/catalogue time once per call and
+#  returns a lazy (dask) synthetic dataset on the global 1/12 degree grid
+#  covering 1993-2030.
+#
+#  Environment:
+#    FAKE_CMEMS_DELAY      seconds of login/catalogue time (default 1.0)
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import os
+import time
+
+import dask.array as da
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+DELAY = float(os.environ.get('FAKE_CMEMS_DELAY', 1.0))
+RESOLUTION = 1 / 12
+
+# The 50 depth levels of the GLORYS12 products
+DEPTHS = np.array([
+    0.494, 1.541, 2.646, 3.819, 5.078, 6.441, 7.930, 9.573, 11.405, 13.467,
+    15.810, 18.496, 21.599, 25.211, 29.445, 34.434, 40.344, 47.374, 55.764, 65.807,
+    77.854, 92.326, 109.729, 130.666, 155.851, 186.126, 222.475, 266.040, 318.127, 380.213,
+    453.938, 541.089, 643.567, 763.333, 902.339, 1062.440, 1245.291, 1452.251, 1684.284, 1941.893,
+    2225.078, 2533.336, 2865.703, 3220.820, 3597.032, 3992.484, 4405.224, 4833.291, 5274.784, 5727.917,
+])
+
+
+# Function to list the points of the global grid between two bounds
+def axis(lo, hi):
+    return np.arange(np.ceil(lo / RESOLUTION - 1e-6), np.floor(hi / RESOLUTION + 1e-6) + 1) * RESOLUTION
+
+
+# Function to build the coordinates of a request
+def coordinates(dataset_id, lon_min, lon_max, lat_min, lat_max, depth_min, depth_max, start, end):
+    lon = axis(lon_min, lon_max)
+    lat = axis(lat_min, lat_max)
+    depth = DEPTHS[(DEPTHS >= depth_min - 1e-3) & (DEPTHS <= depth_max + 1e-3)]
+    freq = 'MS' if 'P1M' in dataset_id else 'D'
+    times = pd.date_range(start, end, freq=freq)
+    return times, depth, lat, lon
+
+
+# Function to assemble a dataset from the coordinates and an array factory
+def make_dataset(variables, times, depth, lat, lon, random):
+    data = {}
+    for v in variables:
+        if v == 'zos':
+            data[v] = (('time', 'latitude', 'longitude'), random((len(times), len(lat), len(lon))))
+        else:
+            data[v] = (('time', 'depth', 'latitude', 'longitude'), random((len(times), len(depth), len(lat), len(lon))))
+    coords = {'time': times, 'latitude': lat, 'longitude': lon}
+    if any(v != 'zos' for v in variables):
+        coords['depth'] = depth
+    return xr.Dataset(data, coords=coords)
+
+
+# Function to build the synthetic (in memory) dataset of one subset request
+def synthetic_dataset(dataset_id, variables, lon_min, lon_max, lat_min, lat_max, depth_min, depth_max, start, end):
+    times, depth, lat, lon = coordinates(dataset_id, lon_min, lon_max, lat_min, lat_max, depth_min, depth_max, start, end)
+    rng = np.random.default_rng(len(times))
+    return make_dataset(variables, times, depth, lat, lon, lambda shape: rng.random(shape, dtype='f4'))
+
+
+def open_dataset(dataset_id, variables, minimum_longitude, maximum_longitude, minimum_latitude, maximum_latitude,
+                 minimum_depth=DEPTHS[0], maximum_depth=DEPTHS[-1], start_datetime='1993-01-01',
+                 end_datetime='2030-12-31', **kwargs):
+    time.sleep(DELAY)
+    times, depth, lat, lon = coordinates(dataset_id, minimum_longitude, maximum_longitude,
+                                         minimum_latitude, maximum_latitude, minimum_depth, maximum_depth,
+                                         start_datetime[:10], end_datetime[:10])
+
+    def random(shape):
+        return da.random.random(shape, chunks=(1,) + shape[1:]).astype('f4')
+    return make_dataset(variables, times, depth, lat, lon, random)
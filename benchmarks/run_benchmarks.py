@@ -0,0 +1,249 @@
+#===========================================================================
+# Offline throughput benchmarks of the forcing scripts
+#
+#  Every scenario runs in its own child process against local stand-ins:
+#    era5   ERA5_parallel_download_request_croco.py with benchmarks/fake_cdsapi
+#    cmems  the download / merge / cleanup stages of the CmemsDownload pipeline
+#           of my_parallel_ocean_frc_monthly_copernicusmarine_download.py with
+#           benchmarks/fake_copernicusmarine on the PATH (command line) or
+#           on sys.path (in-process API)
+#    soda   download_soda_data_Oforc_OGCM_4CROCO.py against soda_mirror.py,
+#           then process_soda3.15.2.py
+#  and reports months/hour, bytes/s, peak RSS and per-stage latency.
+#
+#  python benchmarks/run_benchmarks.py --scenarios era5 cmems soda --months 6
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import calendar
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+ERA5_VARIABLES = {
+    'u10': ['10m_u_component_of_wind', 165, '10 metre U wind component', 'sfc'],
+    'v10': ['10m_v_component_of_wind', 166, '10 metre V wind component', 'sfc'],
+    't2m': ['2m_temperature', 167, '2 metre temperature', 'sfc'],
+    'msl': ['mean_sea_level_pressure', 151, 'Mean sea level pressure', 'sfc'],
+    'sst': ['sea_surface_temperature', 34, 'Sea surface temperature', 'sfc'],
+    'lsm': ['land_sea_mask', 172, 'Land-sea mask', 'sfc'],
+}
+
+
+# Function to load a script of the repository as a module
+def load_script(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Function to summarise a list of latencies
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return {'n': 0}
+
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {'n': len(values), 'p50': pct(50), 'p95': pct(95), 'max': values[-1]}
+
+
+# Function to read the per-request records written by the fakes
+def read_log(path):
+    stages = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                stages.setdefault(record['stage'], []).append(record['end'] - record['start'])
+    return stages
+
+
+# Function to add up the size of the files of a directory
+def directory_bytes(path, suffix='.nc'):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) if f.endswith(suffix))
+
+
+# Function to list (year, month) pairs starting in January 2000
+def months_from_2000(nmonths):
+    return [(2000 + i // 12, i % 12 + 1) for i in range(nmonths)]
+
+
+def bench_era5(workdir, args):
+    (y0, m0), (y1, m1) = months_from_2000(args.months)[0], months_from_2000(args.months)[-1]
+    raw_dir = os.path.join(workdir, 'era5_raw')
+    with open(os.path.join(workdir, 'ERA5_variables.json'), 'w') as f:
+        json.dump(ERA5_VARIABLES, f)
+    with open(os.path.join(workdir, 'ERA5_utilities.py'), 'w') as f:
+        f.write('def addmonths4date(*args):\n    raise NotImplementedError\n')
+    with open(os.path.join(workdir, 'era5_crocotools_param.py'), 'w') as f:
+        f.write(f"year_start = {y0}\nmonth_start = {m0}\nyear_end = {y1}\nmonth_end = {m1}\n"
+                f"ownArea = 1\nlonmin, lonmax, latmin, latmax = '80', '100', '5', '25'\nparamFile = ''\n"
+                f"era5_dir_raw = {raw_dir!r}\nn_overlap = 1\n"
+                f"variables = {list(ERA5_VARIABLES)!r}\n"
+                f"time = ['%02d:00' % h for h in range(24)]\n"
+                f"batch_requests = {args.era5_mode == 'batched'}\n"
+                f"contiguous_requests = {args.era5_mode == 'contiguous'}\n")
+
+    log = os.path.join(workdir, 'cds.log')
+    env = dict(os.environ, FAKE_CDS_LOG=log,
+               PYTHONPATH=os.pathsep.join([os.path.join(BENCH_DIR, 'fake_cdsapi'), workdir, REPO_DIR]))
+    start = time.monotonic()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'ERA5_parallel_download_request_croco.py')],
+                   cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL)
+    wall = time.monotonic() - start
+    return wall, directory_bytes(raw_dir), read_log(log)
+
+
+def bench_cmems(workdir, args):
+    fake_dir = os.path.join(BENCH_DIR, 'fake_copernicusmarine')
+    os.environ['PATH'] = fake_dir + os.pathsep + os.environ['PATH']
+    if args.cmems_engine == 'api':
+        sys.path.insert(0, fake_dir)
+    log = os.path.join(workdir, 'cmems.log')
+    os.environ['FAKE_CMEMS_LOG'] = log
+    cmems = load_script('my_parallel_ocean_frc_monthly_copernicusmarine_download.py', 'cmems_bench')
+    pipeline = cmems.pipeline
+    pipeline.data_dir = os.path.join(workdir, 'cmems')
+    os.makedirs(pipeline.data_dir, exist_ok=True)
+    (cmems.YEAR_START, cmems.MONTH_START), (cmems.YEAR_END, cmems.MONTH_END) = \
+        months_from_2000(args.months)[0], months_from_2000(args.months)[-1]
+    if args.cmems_engine == 'cli':
+        cmems.session.use_api = False
+    if args.cmems_groups == 'variable':
+        pipeline.variable_groups = [[v] for v in pipeline.variables]
+    cmems.DAY_START, cmems.DAY_END = 1, calendar.monthrange(cmems.YEAR_END, cmems.MONTH_END)[1]
+
+    # Time every call of the three stages
+    stages = {}
+
+    def timed(name, fn):
+        def wrapper(*a):
+            start = time.monotonic()
+            try:
+                return fn(*a)
+            finally:
+                stages.setdefault(name, []).append(time.monotonic() - start)
+        return wrapper
+
+    pipeline.download_stage = timed('download', pipeline.download_stage)
+    pipeline.merge_stage = timed('merge', pipeline.merge_stage)
+    pipeline.cleanup_stage = timed('cleanup', pipeline.cleanup_stage)
+
+    start = time.monotonic()
+    pipeline.run_requests(pipeline.plan_requests(cmems.month_list()), "cmems")
+    wall = time.monotonic() - start
+    stages.update(read_log(log))
+    return wall, directory_bytes(pipeline.data_dir), stages
+
+
+def bench_soda(workdir, args):
+    import soda_mirror
+
+    years = sorted({year for year, _ in months_from_2000(args.months)})
+    mirror_dir = os.path.join(workdir, 'mirror')
+    for year in years:
+        soda_mirror.make_soda_year(mirror_dir, year, args.soda_resolution)
+    server = soda_mirror.serve(mirror_dir)
+
+    download = load_script('download_soda_data_Oforc_OGCM_4CROCO.py', 'soda_download_bench')
+    download.BASE_URL = f"http://127.0.0.1:{server.server_address[1]}/"
+    download.SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+    raw_dir = os.path.join(workdir, 'soda_raw')
+    out_dir = os.path.join(workdir, 'soda_out')
+    os.makedirs(raw_dir, exist_ok=True)
+
+    stages = {}
+    start = time.monotonic()
+    urls = [url for year in years for url in download.monthly_urls(year)]
+    download.download_files(urls, raw_dir)
+    stages['download'] = [time.monotonic() - start]
+
+    # In a child process of its own: its writer processes (spawn) import it by its path
+    t0 = time.monotonic()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'process_soda3.15.2.py'),
+                    '--input-dir', raw_dir, '--output-dir', out_dir,
+                    '--start-year', str(years[0]), '--end-year', str(years[-1]),
+                    '--start-month', '1', '--end-month', '12', '--workers', str(args.soda_workers)],
+                   check=True, stdout=subprocess.DEVNULL)
+    stages['process'] = [time.monotonic() - t0]
+    wall = time.monotonic() - start
+    server.shutdown()
+    return wall, directory_bytes(out_dir), stages
+
+
+SCENARIOS = {'era5': bench_era5, 'cmems': bench_cmems, 'soda': bench_soda}
+
+
+# Function to run one scenario in this (child) process and print its result as JSON
+def run_child(name, args):
+    sys.path.insert(0, BENCH_DIR)
+    with tempfile.TemporaryDirectory(prefix=f'bench_{name}_') as workdir:
+        wall, nbytes, stages = SCENARIOS[name](workdir, args)
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result = {
+        'scenario': name,
+        'months': args.months,
+        'wall_s': wall,
+        'months_per_hour': args.months / wall * 3600,
+        'bytes': nbytes,
+        'bytes_per_s': nbytes / wall,
+        'peak_rss_mb': rss / 1024,
+        'stages': {stage: latency_summary(values) for stage, values in stages.items()},
+    }
+    print(json.dumps(result))
+
+
+# Function to print the results as a table
+def print_report(results):
+    print(f"{'scenario':<8} {'wall s':>8} {'months/h':>10} {'MB/s':>8} {'RSS MB':>8}  stages (n, p50/p95 s)")
+    for r in results:
+        stages = ', '.join(f"{k} {v['n']}x {v.get('p50', 0):.2f}/{v.get('p95', 0):.2f}"
+                           for k, v in r['stages'].items())
+        print(f"{r['scenario']:<8} {r['wall_s']:>8.1f} {r['months_per_hour']:>10.0f} "
+              f"{r['bytes_per_s'] / 1e6:>8.2f} {r['peak_rss_mb']:>8.0f}  {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the forcing download and processing scripts.")
+    parser.add_argument("--scenarios", nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS), help="Scenarios to run")
+    parser.add_argument("--months", type=int, default=6, help="Number of months, starting in January 2000")
+    parser.add_argument("--era5-mode", choices=['single', 'batched', 'contiguous'], default='single', help="ERA5 request mode")
+    parser.add_argument("--cmems-engine", choices=['api', 'cli'], default='api', help="copernicusmarine API or command line")
+    parser.add_argument("--cmems-groups", choices=['all', 'variable'], default='all', help="One CMEMS request for all variables or one per variable")
+    parser.add_argument("--soda-resolution", type=float, default=1.0, help="Grid step (degrees) of the synthetic SODA files")
+    parser.add_argument("--soda-workers", type=int, default=1, help="Years processed in parallel")
+    parser.add_argument("--output", type=str, help="JSON file receiving the results")
+    parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args)
+        return
+
+    results = []
+    passthrough = [a for a in sys.argv[1:] if a not in args.scenarios and a != '--scenarios']
+    for name in args.scenarios:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name] + passthrough,
+                             check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
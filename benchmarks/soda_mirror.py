@@ -0,0 +1,140 @@
+#===========================================================================
+# Local SODA mirror for the benchmarks: synthetic yearly files served by
+# http.server with Range support, so the downloader can split and resume
+#
+#  python soda_mirror.py --directory /tmp/soda_mirror --years 2000 2001 --port 8000
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import http.server
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Function to build a synthetic SODA3.15.2 regridded dataset at the given times
+def soda_dataset(times, resolution=1.0, nlevels=20, seed=0):
+    lon = np.arange(resolution / 2, 360, resolution)
+    lat = np.arange(-75 + resolution / 2, 90, resolution)
+    depth = np.geomspace(5, 5000, nlevels)
+    rng = np.random.default_rng(seed)
+
+    def field(*shape):
+        return rng.random(shape, dtype='f4')
+
+    shape3d = (len(times), len(depth), len(lat), len(lon))
+    return xr.Dataset(
+        {
+            'temp': (('time', 'st_ocean', 'yt_ocean', 'xt_ocean'), field(*shape3d)),
+            'salt': (('time', 'st_ocean', 'yt_ocean', 'xt_ocean'), field(*shape3d)),
+            'u': (('time', 'st_ocean', 'yu_ocean', 'xu_ocean'), field(*shape3d)),
+            'v': (('time', 'st_ocean', 'yu_ocean', 'xu_ocean'), field(*shape3d)),
+            'ssh': (('time', 'yt_ocean', 'xt_ocean'), field(len(times), len(lat), len(lon))),
+        },
+        coords={
+            'time': times,
+            'st_ocean': ('st_ocean', depth, {'cartesian_axis': 'Z', 'units': 'meters'}),
+            'xt_ocean': ('xt_ocean', lon, {'cartesian_axis': 'X', 'units': 'degrees_E'}),
+            'yt_ocean': ('yt_ocean', lat, {'cartesian_axis': 'Y', 'units': 'degrees_N'}),
+            'xu_ocean': ('xu_ocean', lon + resolution / 2, {'cartesian_axis': 'X', 'units': 'degrees_E'}),
+            'yu_ocean': ('yu_ocean', lat + resolution / 2, {'cartesian_axis': 'Y', 'units': 'degrees_N'}),
+        })
+
+
+# Function to write a synthetic SODA3.15.2 regridded yearly file (12 monthly means)
+def make_soda_year(directory, year, resolution=1.0, nlevels=20):
+    path = os.path.join(directory, f"soda3.15.2_mn_ocean_reg_{year}.nc")
+    if os.path.exists(path):
+        return path
+    times = pd.date_range(f"{year}-01-01", periods=12, freq='MS') + pd.Timedelta(days=14)
+    os.makedirs(directory, exist_ok=True)
+    soda_dataset(times, resolution, nlevels, year).to_netcdf(path)
+    return path
+
+
+# Function to write the synthetic 5-day files (one pentad each, named after its centre
+# day, every 5 days from 1980-01-03) centred between two dates
+def make_soda_pentads(directory, start, end, resolution=1.0, nlevels=20):
+    centres = pd.date_range('1980-01-03', end, freq='5D')
+    paths = []
+    os.makedirs(directory, exist_ok=True)
+    for centre in centres[centres >= pd.Timestamp(start)]:
+        path = os.path.join(directory, f"soda3.15.2_5dy_ocean_reg_{centre:%Y_%m_%d}.nc")
+        if not os.path.exists(path):
+            soda_dataset(pd.DatetimeIndex([centre]), resolution, nlevels, int(centre.strftime('%Y%m%d'))).to_netcdf(path)
+        paths.append(path)
+    return paths
+
+
+# Request handler adding single-range "Range: bytes=a-b" support to http.server
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if os.path.isdir(path) or not match or not os.path.exists(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/x-netcdf')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        self.range_left = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        left = getattr(self, 'range_left', None)
+        if left is None:
+            return super().copyfile(source, outputfile)
+        while left > 0:
+            block = source.read(min(left, 1 << 20))
+            if not block:
+                break
+            outputfile.write(block)
+            left -= len(block)
+        self.range_left = None
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to serve a directory in a background thread, returns the server
+def serve(directory, port=0):
+    handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=directory, **kwargs)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic SODA3.15.2 yearly files over HTTP.")
+    parser.add_argument("--directory", type=str, required=True, help="Directory of the mirror")
+    parser.add_argument("--years", type=int, nargs='+', default=[2000], help="Years to generate")
+    parser.add_argument("--resolution", type=float, default=1.0, help="Grid step in degrees")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    args = parser.parse_args()
+
+    for year in args.years:
+        make_soda_year(args.directory, year, args.resolution)
+    server = serve(args.directory, args.port)
+    print(f"Serving {args.directory} on http://127.0.0.1:{server.server_address[1]}/")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
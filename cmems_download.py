@@ -0,0 +1,376 @@
+#===========================================================================
+# Monthly CMEMS download pipeline shared by the copernicusmarine scripts
+#
+#  The months of a date range are grouped into requests sized from their
+#  estimated volume (request_planner.py); every request is split into
+#  pieces (variable groups, time ranges, depth slabs, tiles) below the
+#  largest request size. The requests go through a download / merge /
+#  cleanup pipeline: the pieces are fetched through the CopernicusSession
+#  (or the shared forcing cache), merged lazily into the monthly files (or
+#  the months of a Zarr store) once all of them are there, then removed.
+#  The scripts keep their configuration and build one CmemsDownload.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+import xarray as xr
+
+import forcing_catalogue
+import forcing_check
+import task_events
+from download_scheduler import call_with_retries, run_pipeline, print_stage_times
+from netcdf_encoding import write_netcdf
+from request_planner import (MB, SURFACE_VARIABLES, dataset_resolution, grid_points, time_steps, steps_per_day,
+                             depth_levels, depth_slabs, day_ranges, estimate_bytes, print_plan)
+from tiling import domain_tiles, mosaic
+
+
+# Function to get the first and last day of a list of consecutive months
+def request_dates(months):
+    (y0, m0, d0, _), (y1, m1, _, d1) = months[0], months[-1]
+    return date(y0, m0, d0), date(y1, m1, d1)
+
+
+# Function to get the monthly file of a month
+def monthly_file(data_dir, year, month):
+    return os.path.join(data_dir, f'raw_motu_mercator_Y{year}M{month:02d}.nc')
+
+
+class CmemsDownload:
+    # slots: semaphore (or ConcurrencyController) of the copernicusmarine requests in flight;
+    # piece_threads: pieces of a request downloaded at once (1: one after the other);
+    # stage_workers: months downloading, merging and being cleaned up at once;
+    # sync: new time steps are appended to the existing monthly files
+    def __init__(self, session, data_dir, variable_groups, slots, cache=None, zarr_store=None, encoding=None,
+                 tile_deg=None, request_target_mb=200, request_max_mb=2000, max_months=12, max_retries=3,
+                 retry_delay=10, piece_threads=1, stage_workers=(2, 1, 1), queue_size=2,
+                 max_nan=forcing_check.MAX_NAN_FRACTION, sync=False):
+        self.session = session
+        self.data_dir = data_dir
+        self.variable_groups = [list(group) for group in variable_groups]
+        self.slots = slots
+        self.cache = cache
+        self.zarr_store = zarr_store
+        self.encoding = encoding or {}
+        self.tile_deg = tile_deg
+        self.request_target_mb = request_target_mb
+        self.request_max_mb = request_max_mb
+        self.max_months = max_months
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.piece_threads = piece_threads
+        self.stage_workers = stage_workers
+        self.queue_size = queue_size
+        self.max_nan = max_nan
+        self.sync = sync
+
+    @property
+    def dataset_id(self):
+        return self.session.dataset_id
+
+    @property
+    def bbox(self):
+        return self.session.lon_min, self.session.lon_max, self.session.lat_min, self.session.lat_max
+
+    @property
+    def depths(self):
+        return self.session.depth_min, self.session.depth_max
+
+    @property
+    def variables(self):
+        return [v for group in self.variable_groups for v in group]
+
+    # Function to describe a subset request for the shared forcing cache
+    def cache_request(self, group, start_str, end_str, depths=None, bbox=None):
+        return {
+            'source': 'cmems',
+            'dataset': self.dataset_id,
+            'variables': list(group),
+            'bbox': list(bbox or self.bbox),
+            'time': [start_str, end_str],
+            'depth': list(depths or self.depths),
+        }
+
+    # Function to build the name of the file downloaded for one variable group, time range, depth slab and tile
+    def temp_filename(self, group, start_str, end_str, depths=None, bbox=None):
+        slab = f"_{depths[0]:.3f}-{depths[1]:.3f}m" if depths else ""
+        tile = f"_{bbox[0]:.3f}E{bbox[2]:.3f}N" if bbox else ""
+        return os.path.join(self.data_dir,
+                            f"{self.dataset_id}_{'-'.join(group)}_{start_str[:10]}_{end_str[:10]}{slab}{tile}.nc")
+
+    # Function to download data for a group of variables
+    def download_variables(self, group, start_str, end_str, depths=None, bbox=None):
+        output_file = self.temp_filename(group, start_str, end_str, depths, bbox)
+        request = self.cache_request(group, start_str, end_str, depths, bbox)
+        if self.cache is not None and self.cache.fetch(request, output_file):
+            return output_file
+
+        with self.slots, task_events.task('cmems', os.path.basename(output_file)):
+            output_file = self.session.subset(group, start_str, end_str, output_file, depths, bbox)
+
+        if output_file is None:
+            print(f"Failed to download data for {', '.join(group)} from {start_str} to {end_str}")
+            return None
+        print(f"Successfully downloaded data for {', '.join(group)} from {start_str} to {end_str}")
+        if self.cache is not None:
+            self.cache.store(request, output_file)
+        return output_file
+
+    # Function to download one piece of a request, retrying it alone on failure
+    def download_piece(self, piece):
+        def attempt(piece):
+            output_file = self.download_variables(*piece)
+            if output_file is None:
+                raise IOError(f"no file for {os.path.basename(self.temp_filename(*piece))}")
+            return output_file
+        try:
+            return call_with_retries(attempt, piece, self.max_retries, self.retry_delay)
+        except Exception as e:
+            print(f"Giving up on {os.path.basename(self.temp_filename(*piece))}: {e}")
+            return None
+
+    # Function to download the pieces of one request, piece_threads at a time;
+    # the files (None for a failed piece) are in the order of the pieces
+    def download_pieces(self, pieces):
+        if self.piece_threads <= 1:
+            return [self.download_piece(piece) for piece in pieces]
+        with ThreadPoolExecutor(max_workers=min(len(pieces), self.piece_threads)) as executor:
+            futures = [executor.submit(self.download_piece, piece) for piece in pieces]
+            for future in as_completed(futures):
+                future.result()  # Retrieve result to catch exceptions
+        return [future.result() for future in futures]
+
+    # Function to estimate the size (bytes) of one variable group between two dates
+    def estimate_group(self, group, start, end, depths=None, bbox=None):
+        step = dataset_resolution(self.dataset_id)
+        x0, x1, y0, y1 = bbox or self.bbox
+        npoints = grid_points(x0, x1, step) * grid_points(y0, y1, step)
+        nlevels = len(depth_levels(*(depths or self.depths)))
+        levels = sum(1 if v in SURFACE_VARIABLES else nlevels for v in group)
+        return estimate_bytes(npoints, levels, time_steps(self.dataset_id, start, end))
+
+    # Function to list the tiles of the domain, [None] without tiling
+    def tile_list(self):
+        if not self.tile_deg:
+            return [None]
+        step = dataset_resolution(self.dataset_id)
+        return domain_tiles(*self.bbox, self.tile_deg, step, pad=step / 10)
+
+    # Function to split one variable group between two dates (on one tile) into pieces
+    # below request_max_mb: time ranges for daily or hourly data, depth slabs otherwise
+    def split_group(self, group, start, end, bbox=None):
+        npieces = math.ceil(self.estimate_group(group, start, end, None, bbox) / (self.request_max_mb * MB))
+        surface = [v for v in group if v in SURFACE_VARIABLES]
+        levels = depth_levels(*self.depths)
+        if npieces <= 1:
+            ranges, slabs = [(start, end)], [None]
+        elif steps_per_day(self.dataset_id) is not None and time_steps(self.dataset_id, start, end) >= npieces:
+            ranges, slabs = day_ranges(start, end, npieces), [None]
+        elif len(surface) < len(group) and len(levels) > 1:
+            ranges, slabs = [(start, end)], depth_slabs(levels, npieces)
+        else:
+            ranges, slabs = [(start, end)], [None]
+
+        pieces = []
+        for t0, t1 in ranges:
+            start_str, end_str = t0.strftime('%Y-%m-%dT00:00:00'), t1.strftime('%Y-%m-%dT00:00:00')
+            if slabs == [None]:
+                pieces.append((tuple(group), start_str, end_str, None, bbox))
+                continue
+            # Surface variables are not cut into slabs
+            if surface:
+                pieces.append((tuple(surface), start_str, end_str, None, bbox))
+            deep = tuple(v for v in group if v not in SURFACE_VARIABLES)
+            pieces.extend((deep, start_str, end_str, slab, bbox) for slab in slabs)
+        return pieces
+
+    # Function to group consecutive months into requests below request_target_mb;
+    # each request is (months, pieces)
+    def plan_requests(self, months):
+        requests, current = [], []
+        for item in months:
+            trial = current + [item]
+            size = sum(self.estimate_group(group, *request_dates(trial)) for group in self.variable_groups)
+            if current and (len(trial) > self.max_months or size > self.request_target_mb * MB):
+                requests.append(current)
+                current = []
+            current.append(item)
+        if current:
+            requests.append(current)
+        return [(tuple(r), [piece for group in self.variable_groups for tile in self.tile_list()
+                            for piece in self.split_group(group, *request_dates(r), tile)])
+                for r in requests]
+
+    # Function to print the requests and their estimated size, downloading nothing
+    def print_request_plan(self, requests):
+        rows = []
+        for months, pieces in requests:
+            (y0, m0, _, _), (y1, m1, _, _) = months[0], months[-1]
+            size = sum(self.estimate_group(group, date.fromisoformat(t0[:10]), date.fromisoformat(t1[:10]), depths, bbox)
+                       for group, t0, t1, depths, bbox in pieces)
+            rows.append((f"{y0}-{m0:02d}..{y1}-{m1:02d}", len(pieces), size))
+        return print_plan(rows)
+
+    # Function to write the monthly NetCDF files of one request from its downloaded pieces
+    def concatenate_files(self, months, file_list, pieces=None):
+        pieces = pieces or [None] * len(file_list)
+        (y0, m0, _, _), (y1, m1, _, _) = months[0], months[-1]
+
+        # Every planned piece is needed: without one, a variable group, some days or some
+        # depth levels would be missing from the months
+        missing = sum(1 for f in file_list if f is None)
+        if missing or not file_list:
+            print(f"Failed to merge files for {y0}-{m0:02d}..{y1}-{m1:02d}: "
+                  f"{missing} of {len(file_list)} pieces not downloaded")
+            return None
+
+        # Tiles of the same variable group, time range and depth slab are mosaicked together
+        tiles = {}
+        for i, (piece, f) in enumerate(zip(pieces, file_list)):
+            tiles.setdefault(piece[:4] if piece else i, []).append(f)
+
+        # A single downloaded file of a single month needs no merge, it is moved in place
+        # (in sync mode only if the month has no file yet)
+        output_file = monthly_file(self.data_dir, y0, m0)
+        if len(file_list) == 1 and len(months) == 1 and self.zarr_store is None and \
+                not (self.sync and os.path.exists(output_file)):
+            os.replace(file_list[0], output_file)
+            forcing_catalogue.record(output_file, 'cmems', self.dataset_id)
+            print(f"Successfully created {os.path.basename(output_file)}")
+            return [output_file]
+
+        # Open lazily, one time step and one level per chunk, mosaic the tiles and
+        # combine the variable groups, time ranges and depth slabs
+        datasets = []
+        outputs = []
+        try:
+            parts = []
+            for files in tiles.values():
+                opened = [xr.open_dataset(f, chunks={'time': 1, 'depth': 1}) for f in files]
+                datasets.extend(opened)
+                parts.append(mosaic(opened))
+            combined = xr.combine_by_coords(parts, coords='minimal', compat='override', join='outer',
+                                             combine_attrs='override')
+
+            # Every month is written chunk by chunk, then moved in place (or into its region of the Zarr store)
+            for year, month, day_start, day_end in months:
+                output_file = monthly_file(self.data_dir, year, month)
+                output_filename = os.path.basename(output_file)
+                tmp_file = output_file + '.part'
+                ds_month = combined.sel(time=slice(f"{year}-{month:02d}-{day_start:02d}",
+                                                   f"{year}-{month:02d}-{day_end:02d}T23:59:59"))
+                if ds_month.sizes['time'] == 0:
+                    raise ValueError(f"no time steps for {year}-{month:02d}")
+                if self.zarr_store is not None:
+                    self.zarr_store.write_month(ds_month, year, month)
+                    outputs.append(self.zarr_store.path)
+                    print(f"Successfully wrote {year}-{month:02d} to {os.path.basename(self.zarr_store.path)}")
+                    continue
+                if self.sync and os.path.exists(output_file):
+                    # The steps already in the file are kept, the newer ones appended after them
+                    existing = xr.open_dataset(output_file, chunks={'time': 1, 'depth': 1})
+                    datasets.append(existing)
+                    ds_month = ds_month.sel(time=ds_month['time'] > existing['time'][-1])
+                    if ds_month.sizes['time'] == 0:
+                        print(f"{output_filename} is up to date")
+                        outputs.append(output_file)
+                        continue
+                    ds_month = xr.concat([existing, ds_month], dim='time', data_vars='minimal', coords='minimal',
+                                         compat='override', join='override', combine_attrs='override')
+                try:
+                    write_netcdf(ds_month, tmp_file, **self.encoding)
+                    os.replace(tmp_file, output_file)
+                finally:
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+                forcing_catalogue.record(output_file, 'cmems', self.dataset_id)
+                outputs.append(output_file)
+                print(f"Successfully created {output_filename}")
+            return outputs
+
+        except Exception as e:
+            print(f"Failed to merge files for {y0}-{m0:02d}..{y1}-{m1:02d}: {e}")
+            return None
+
+        finally:
+            # Ensure datasets are closed even if an error occurs
+            for ds in datasets:
+                ds.close()
+
+    # Function to list the files a request writes, given its (year, month, first day,
+    # last day): the monthly files, or the Zarr store
+    def request_outputs(self, months):
+        if self.zarr_store is not None:
+            return [self.zarr_store.path]
+        return [monthly_file(self.data_dir, year, month) for year, month, _, _ in months]
+
+    # Function to check the monthly files (variables, days or month covered, missing values);
+    # returns the months whose file is missing or bad, the bad files being moved aside
+    def bad_months(self, months):
+        daily = steps_per_day(self.dataset_id) is not None
+        expected = {}
+        for year, month, day_start, day_end in months:
+            if daily:
+                dates = {'start': f'{year}-{month:02d}-{day_start:02d}', 'end': f'{year}-{month:02d}-{day_end:02d}'}
+            else:
+                dates = {'month': f'{year}-{month:02d}'}
+            expected[monthly_file(self.data_dir, year, month)] = dict(dates, variables=self.variables,
+                                                                      max_nan=self.max_nan)
+
+        bad = forcing_check.scan(expected)
+        if not bad:
+            print(f"{len(expected)} files passed the integrity check")
+            return []
+        forcing_check.print_report(bad, len(expected))
+        for output_file in bad:
+            forcing_check.quarantine(output_file)
+        return [item for item, output_file in zip(months, expected) if output_file in bad]
+
+    # Function to forget the cached downloads of requests, before they are downloaded again
+    def discard_cached(self, requests):
+        if self.cache is None:
+            return
+        for _, pieces in requests:
+            for piece in pieces:
+                self.cache.discard(self.cache_request(*piece))
+
+    # Pipeline stages: each returns what the next stage needs, or None to stop
+    def download_stage(self, item):
+        months, pieces = item
+        return months, pieces, self.download_pieces(pieces)
+
+    def merge_stage(self, item):
+        months, pieces, file_list = item
+        return file_list if self.concatenate_files(months, file_list, pieces) else None
+
+    # Function to remove the temporary files of one request
+    def cleanup_stage(self, file_list):
+        for file_path in file_list:
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+                print(f"Removed {file_path}")
+
+    # Function to run requests through the download, merge and cleanup pipeline: request
+    # N+1 downloads while request N merges and request N-1 is cleaned up; with a shard,
+    # only the requests this worker claims (named by their months)
+    def run_requests(self, requests, source, shard=None):
+        def merge(item):
+            file_list = self.merge_stage(item)
+            if shard is not None:
+                (shard.complete if file_list else shard.release)(item[0])
+            return file_list
+
+        start = time.monotonic()
+        items = requests if shard is None else shard.claimed(requests, key=lambda request: request[0])
+        download_workers, merge_workers, cleanup_workers = self.stage_workers
+        stats = run_pipeline(items, [
+            ("download", self.download_stage, download_workers),
+            ("merge", merge, merge_workers),
+            ("cleanup", self.cleanup_stage, cleanup_workers),
+        ], queue_size=self.queue_size, source=source)
+        print_stage_times(stats, time.monotonic() - start)
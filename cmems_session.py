@@ -0,0 +1,131 @@
+#===========================================================================
+# In-process copernicusmarine downloads shared by the CMEMS scripts
+#
+#  One CopernicusSession per run: the dataset is opened once through the
+#  copernicusmarine Python API (one login, one catalogue lookup) for the
+#  whole bbox and depth range, and every month is sliced from it lazily.
+#  Several variables of the same dataset are fetched in one request.
+#  If the toolbox cannot be imported or its API call fails, the request
+#  falls back to the `copernicusmarine subset` command line.
+#  Files written in-process use the encoding of netcdf_encoding.py and
+#  are streamed to disk by blocks of time steps.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import os
+import subprocess
+import threading
+
+import task_events
+from netcdf_encoding import write_netcdf_steps
+
+try:
+    import copernicusmarine
+except ImportError:
+    copernicusmarine = None
+
+
+class CopernicusSession:
+    def __init__(self, dataset_id, bbox, depth, use_api=True, encoding=None):
+        self.dataset_id = dataset_id
+        self.lon_min, self.lon_max, self.lat_min, self.lat_max = bbox
+        self.depth_min, self.depth_max = depth
+        self.use_api = use_api and copernicusmarine is not None
+        self.encoding = encoding or {}
+        self._datasets = {}
+        self._lock = threading.Lock()
+
+    # Function to open (once per variable group) the lazy dataset of the whole run
+    def open(self, variables):
+        key = tuple(variables)
+        with self._lock:
+            if key not in self._datasets:
+                self._datasets[key] = copernicusmarine.open_dataset(
+                    dataset_id=self.dataset_id,
+                    variables=list(variables),
+                    minimum_longitude=self.lon_min,
+                    maximum_longitude=self.lon_max,
+                    minimum_latitude=self.lat_min,
+                    maximum_latitude=self.lat_max,
+                    minimum_depth=self.depth_min,
+                    maximum_depth=self.depth_max,
+                )
+            return self._datasets[key]
+
+    # Function to get the last time step (numpy datetime64) the dataset holds for the
+    # variables, None if it cannot be known (command line only, or failed API call)
+    def last_time(self, variables):
+        if not self.use_api:
+            return None
+        try:
+            return self.open(variables)['time'].values[-1]
+        except Exception as e:
+            print(f"copernicusmarine API could not give the last time step of {self.dataset_id}: {e}")
+            return None
+
+    # Function to get the lazy dataset of the variables between two dates
+    # (and two depths and a tile, the whole depth range and bbox by default)
+    def open_month(self, variables, start_str, end_str, depths=None, bbox=None):
+        ds = self.open(variables).sel(time=slice(start_str, end_str))
+        if depths is not None and 'depth' in ds.dims:
+            ds = ds.sel(depth=slice(*depths))
+        if bbox is not None:
+            ds = ds.sel(longitude=slice(bbox[0], bbox[1]), latitude=slice(bbox[2], bbox[3]))
+        return ds
+
+    # Function to download the variables between two dates into output_file;
+    # returns output_file, or None if the download failed
+    def subset(self, variables, start_str, end_str, output_file, depths=None, bbox=None):
+        if self.use_api:
+            try:
+                return self.subset_api(variables, start_str, end_str, output_file, depths, bbox)
+            except Exception as e:
+                print(f"copernicusmarine API failed for {', '.join(variables)} from {start_str} to {end_str}, "
+                      f"using the command line: {e}")
+        return self.subset_cli(variables, start_str, end_str, output_file, depths, bbox)
+
+    def subset_api(self, variables, start_str, end_str, output_file, depths=None, bbox=None):
+        ds = self.open_month(variables, start_str, end_str, depths, bbox)
+        if ds.sizes.get('time', 0) == 0:
+            raise ValueError("no time steps in the requested range")
+        # Fetched by blocks of time steps, outside the NetCDF lock of the process
+        tmp_file = output_file + '.part'
+        try:
+            write_netcdf_steps(ds, tmp_file, **self.encoding)
+            os.replace(tmp_file, output_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        task_events.current().add_bytes(os.path.getsize(output_file))
+        return output_file
+
+    def subset_cli(self, variables, start_str, end_str, output_file, depths=None, bbox=None):
+        depth_min, depth_max = depths or (self.depth_min, self.depth_max)
+        lon_min, lon_max, lat_min, lat_max = bbox or (self.lon_min, self.lon_max, self.lat_min, self.lat_max)
+        command = ["copernicusmarine", "subset", "--dataset-id", self.dataset_id]
+        for variable in variables:
+            command += ["--variable", variable]
+        command += [
+            "--minimum-longitude", str(lon_min),
+            "--maximum-longitude", str(lon_max),
+            "--minimum-latitude", str(lat_min),
+            "--maximum-latitude", str(lat_max),
+            "--start-datetime", start_str,
+            "--end-datetime", end_str,
+            "--minimum-depth", str(depth_min),
+            "--maximum-depth", str(depth_max),
+            "--output-directory", os.path.dirname(output_file) or '.',
+            "--output-filename", os.path.basename(output_file)
+        ]
+
+        handle = task_events.current()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        stdout, stderr = process.communicate(input='y\n')
+        handle.exit_code = process.returncode
+        handle.stderr = stderr
+        if process.returncode != 0 or not os.path.exists(output_file):
+            handle.fail(f"copernicusmarine subset exited with {process.returncode}")
+            print(f"copernicusmarine subset failed for {', '.join(variables)} from {start_str} to {end_str}: {stderr}")
+            return None
+        handle.add_bytes(os.path.getsize(output_file))
+        return output_file
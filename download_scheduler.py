@@ -0,0 +1,293 @@
+#===========================================================================
+# Shared work queue for the forcing download scripts
+#
+#  Tasks are taken from one queue by a fixed number of worker threads, so
+#  the number of requests in flight never exceeds `max_in_flight`, whatever
+#  the number of CPU cores. New requests are further limited by a token
+#  bucket, and failed tasks are retried with exponential backoff and jitter.
+#  Tasks that still fail are returned to the caller instead of being lost.
+#
+#  The number of requests in flight can also follow the remote service
+#  (ConcurrencyController, AIMD): one more request while the aggregate
+#  throughput of the finished tasks keeps improving, the limit multiplied
+#  by a factor below 1 on errors, throttling responses or falling throughput.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import queue
+import random
+import threading
+import time
+
+import task_events
+
+
+# Token bucket allowing `rate` requests per second with bursts of `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until one token is available and take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Error messages of the remote services asking the client to slow down
+THROTTLING_MARKERS = ('429', 'too many requests', 'rate limit', 'throttl', '503', 'service unavailable')
+
+
+# Function to tell whether an error is a throttling response of the remote service
+def is_throttling(error):
+    return error is not None and any(marker in str(error).lower() for marker in THROTTLING_MARKERS)
+
+
+# Limit of the requests in flight adapted to the remote service (AIMD), used like a
+# semaphore (`with controller:`). It follows the task events of `sources`: every
+# `window` seconds (and at least `limit` finished tasks) the throughput of the window
+# is compared with the previous one; the limit grows by one while it improves by more
+# than `tolerance` (if the limit was reached), stays on a plateau, and is multiplied by
+# `decrease` when it falls, or on a failure or retry (once per window, a burst of errors
+# counts once). After a decrease, the next window only measures the new limit.
+# `limit` is the current limit, `history` its changes.
+class ConcurrencyController:
+    def __init__(self, initial=4, min_limit=1, max_limit=16, sources=None, window=30.0,
+                 decrease=0.5, tolerance=0.05):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = max(self.min_limit, min(self.max_limit, initial))
+        self.sources = set(sources) if sources else None
+        self.window = window
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.last_decrease = -float('inf')
+        self.history = [{'time': time.time(), 'limit': self.limit, 'bytes_per_s': None, 'reason': 'start'}]
+        self.cond = threading.Condition()
+        self._new_window(time.monotonic(), None)
+        task_events.add_listener(self.observe)
+
+    def _new_window(self, now, rate):
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_tasks = 0
+        self.previous_rate = rate
+        self.saturated = self.in_flight >= self.limit
+
+    def __enter__(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+            self.saturated = self.saturated or self.in_flight >= self.limit
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+        return False
+
+    # Function to change the limit (called with the lock held); returns the change, None if none
+    def _set_limit(self, limit, reason, rate):
+        if limit == self.limit:
+            return None
+        old, self.limit = self.limit, limit
+        self.history.append({'time': time.time(), 'limit': limit, 'bytes_per_s': rate, 'reason': reason})
+        self.cond.notify_all()
+        return old, limit, reason, rate
+
+    # Function to follow the task events (task_events listener): end events give the
+    # bytes of the finished tasks, failed end events and retries the errors
+    def observe(self, record):
+        if record['event'] not in ('end', 'retry'):
+            return
+        if self.sources is not None and record['source'] not in self.sources:
+            return
+        now = time.monotonic()
+        change = None
+        with self.cond:
+            if record['event'] == 'retry' or not record.get('ok', True):
+                if now - self.last_decrease >= self.window:
+                    reason = 'throttled' if is_throttling(record.get('error')) else 'error'
+                    change = self._set_limit(max(self.min_limit, int(self.limit * self.decrease)), reason, None)
+                    self.last_decrease = now
+                    self._new_window(now, None)
+            else:
+                self.window_bytes += record.get('bytes') or 0
+                self.window_tasks += 1
+                elapsed = now - self.window_start
+                if elapsed >= self.window and self.window_tasks >= self.limit:
+                    rate = self.window_bytes / elapsed
+                    previous = self.previous_rate
+                    if previous is not None and rate < previous * (1 - self.tolerance):
+                        change = self._set_limit(max(self.min_limit, int(self.limit * self.decrease)),
+                                                 'throughput down', rate)
+                        self.last_decrease = now
+                        rate = None  # the next window measures the new limit
+                    elif (previous is None or rate > previous * (1 + self.tolerance)) and self.saturated:
+                        change = self._set_limit(min(self.max_limit, self.limit + 1), 'throughput up', rate)
+                    self._new_window(now, rate)
+        if change is not None:
+            old, limit, reason, rate = change
+            speed = f", {rate / 1e6:.2f} MB/s" if rate is not None else ""
+            print(f"Requests in flight {old} -> {limit} ({reason}{speed})")
+            task_events.emit('limit', record['source'], 'concurrency', limit=limit, reason=reason, bytes_per_s=rate)
+
+    # Function to print the changes of the limit
+    def print_history(self):
+        start = self.history[0]['time']
+        print(f"{'time s':>8} {'limit':>6} {'MB/s':>8}  reason")
+        for h in self.history:
+            speed = f"{h['bytes_per_s'] / 1e6:>8.2f}" if h['bytes_per_s'] is not None else f"{'':>8}"
+            print(f"{h['time'] - start:>8.1f} {h['limit']:>6} {speed}  {h['reason']}")
+
+
+# Function to compute the backoff delay of a retry ("full jitter")
+def backoff_delay(attempt, base_delay, max_delay):
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+# Function to call fn(task), retrying failures with exponential backoff
+def call_with_retries(fn, task, max_retries=3, base_delay=10, max_delay=600, bucket=None):
+    attempt = 0
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return fn(task)
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            task_events.current().retry(e)
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"Retrying {task} in {delay:.0f} s (attempt {attempt + 1}/{max_retries}): {e}")
+            time.sleep(delay)
+            attempt += 1
+
+
+# Function to run all tasks from one shared queue with a cap on requests in flight;
+# with a shard (task_shards.py), a task runs only if this worker claims it when taken:
+# the tasks of its shard first, then those of the other shards nobody has started
+def run_task_queue(tasks, fn, max_in_flight=4, requests_per_minute=None,
+                   max_retries=3, base_delay=10, max_delay=600, source='task', shard=None):
+    bucket = TokenBucket(requests_per_minute / 60.0) if requests_per_minute else None
+    failures = []
+    lock = threading.Lock()
+
+    def worker(work):
+        while True:
+            try:
+                task = work.get_nowait()
+            except queue.Empty:
+                return
+            if shard is not None and not shard.claim(task):
+                continue
+            try:
+                with task_events.task(source, task):
+                    call_with_retries(fn, task, max_retries, base_delay, max_delay, bucket)
+            except Exception as e:
+                print(f"Failed {task} after {max_retries} retries: {e}")
+                with lock:
+                    failures.append((task, e))
+                if shard is not None:
+                    shard.release(task)
+            else:
+                if shard is not None:
+                    with lock:
+                        shard.complete(task)
+
+    for phase in ([tasks] if shard is None else [shard.mine(tasks), shard.others(tasks)]):
+        work = queue.Queue()
+        for task in phase:
+            task_events.enqueue(source, task)
+            work.put(task)
+        threads = [threading.Thread(target=worker, args=(work,), daemon=True)
+                   for _ in range(max(1, min(max_in_flight, work.qsize())))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return failures
+
+
+_STOP = object()
+
+
+# Function to run items through stages connected by bounded queues.
+# `stages` is a list of (name, fn, workers); fn(item) returns the item for
+# the next stage, or None to drop it. Returns per-stage timing statistics.
+def run_pipeline(items, stages, queue_size=2, source='pipeline'):
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stats = {name: {'items': 0, 'failed': 0, 'busy': 0.0, 'first': None, 'last': None}
+             for name, _, _ in stages}
+    lock = threading.Lock()
+    remaining = [workers for _, _, workers in stages]
+
+    def stage_worker(i):
+        name, fn, _ = stages[i]
+        while True:
+            item = queues[i].get()
+            if item is _STOP:
+                break
+            start = time.monotonic()
+            try:
+                with task_events.task(f'{source}.{name}', item):
+                    result = fn(item)
+            except Exception as e:
+                print(f"Stage {name} failed for {item}: {e}")
+                result = None
+                with lock:
+                    stats[name]['failed'] += 1
+            end = time.monotonic()
+            with lock:
+                s = stats[name]
+                s['items'] += 1
+                s['busy'] += end - start
+                s['first'] = start if s['first'] is None else s['first']
+                s['last'] = end
+            if result is not None and i + 1 < len(stages):
+                task_events.enqueue(f'{source}.{stages[i + 1][0]}', result)
+                queues[i + 1].put(result)
+
+        # The last worker of a stage closes the next one
+        with lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last and i + 1 < len(stages):
+            for _ in range(stages[i + 1][2]):
+                queues[i + 1].put(_STOP)
+
+    threads = [threading.Thread(target=stage_worker, args=(i,), daemon=True)
+               for i, (_, _, workers) in enumerate(stages) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for item in items:
+        task_events.enqueue(f'{source}.{stages[0][0]}', item)
+        queues[0].put(item)
+    for _ in range(stages[0][2]):
+        queues[0].put(_STOP)
+    for t in threads:
+        t.join()
+    return stats
+
+
+# Function to print the wall time spent in each stage of a pipeline
+def print_stage_times(stats, wall):
+    print(f"Pipeline wall time: {wall:.1f} s")
+    for name, s in stats.items():
+        span = (s['last'] - s['first']) if s['first'] is not None else 0.0
+        print(f"  {name:<10} {s['items']:>4} items ({s['failed']} failed), "
+              f"busy {s['busy']:.1f} s, active {span:.1f} s")
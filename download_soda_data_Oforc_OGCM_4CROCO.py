@@ -7,8 +7,21 @@
 # Install argparse (if not already installed)
 #pip install argparse
 import os
+import re
+import glob
+import fnmatch
 import argparse
-import subprocess
+import threading
+import http.client
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import forcing_catalogue
+import forcing_check
+import task_events
+import task_shards
+from download_scheduler import ConcurrencyController, call_with_retries
+from forcing_cache import ForcingCache, DEFAULT_QUOTA_GB
 
 DEFAULT_OUTPUT_DIR = "/scratch/20cl91p02/CROCO_TOOL_FIX/Oforc_SODA"
 DEFAULT_YEAR_START = 2023
@@ -16,17 +29,251 @@ DEFAULT_MONTH_START = 1
 DEFAULT_YEAR_END = 2023
 DEFAULT_MONTH_END = 3
 DEFAULT_DATA_TYPE = "monthly"  # Default data type
+DEFAULT_WORKERS = 4            # files downloaded at the same time (at first, without --fixed-workers)
+DEFAULT_MAX_WORKERS = 16       # most files downloaded at the same time, the number following the throughput
+DEFAULT_SEGMENTS = 4           # parallel Range segments of one large file
+SEGMENT_MIN_SIZE = 256 * 1024 * 1024  # files smaller than this are not split
+BLOCK_SIZE = 1024 * 1024
+BASE_URL = "http://dsrs.atmos.umd.edu/DATA/soda3.15.2/REGRIDED/ocean/"
+
+# Keep-alive HTTP connections, one per thread and host
+class ConnectionPool:
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self, scheme, netloc, fresh=False):
+        conns = self.local.__dict__.setdefault('conns', {})
+        if fresh or (scheme, netloc) not in conns:
+            if (scheme, netloc) in conns:
+                conns[(scheme, netloc)].close()
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conns[(scheme, netloc)] = cls(netloc, timeout=self.timeout)
+        return conns[(scheme, netloc)]
+
+    # Send a request, reconnecting once if the kept-alive connection was dropped
+    def request(self, method, url, headers=None):
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        for fresh in (False, True):
+            conn = self._connection(parts.scheme, parts.netloc, fresh)
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                if fresh:
+                    raise
+                continue
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                return self.request(method, urljoin(url, response.getheader('Location')), headers)
+            return response
+
+# Function to get the size of a remote file and whether it supports Range requests
+def remote_info(pool, url):
+    response = pool.request('HEAD', url)
+    response.read()
+    if response.status != 200:
+        raise IOError(f"HEAD {url} returned {response.status} {response.reason}")
+    size = response.getheader('Content-Length')
+    ranges = response.getheader('Accept-Ranges', '') == 'bytes'
+    return (int(size) if size is not None else None), ranges
+
+# Function to list the files of a remote directory index matching a pattern
+def list_remote_files(pool, index_url, pattern):
+    response = pool.request('GET', index_url)
+    body = response.read().decode('utf-8', 'replace')
+    if response.status != 200:
+        raise IOError(f"GET {index_url} returned {response.status} {response.reason}")
+    names = sorted(set(os.path.basename(h) for h in re.findall(r'href="([^"?#]+)"', body)))
+    return [urljoin(index_url, name) for name in names if fnmatch.fnmatch(name, pattern)]
+
+# Function to download bytes [start, end] of a file into a part file, resuming what is there
+def fetch_segment(pool, url, part_file, start, end, handle=None):
+    done = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    if end is not None and start + done > end:
+        return
+    headers = {'Range': f"bytes={start + done}-{'' if end is None else end}"} if start + done > 0 or end is not None else {}
+    response = pool.request('GET', url, headers)
+    if response.status == 200 and headers:
+        if start > 0 or end is not None:
+            response.close()
+            raise IOError(f"{url} does not support Range requests")
+        done = 0  # whole file sent again, restart the part file
+    elif response.status not in (200, 206):
+        response.read()
+        raise IOError(f"GET {url} returned {response.status} {response.reason}")
+    if handle is not None:
+        handle.first_byte()
+    with open(part_file, 'ab' if done else 'wb') as f:
+        while True:
+            block = response.read(BLOCK_SIZE)
+            if not block:
+                break
+            f.write(block)
+
+# Function to describe the download of a file for the shared forcing cache
+def cache_request(url, size):
+    return {'source': 'soda', 'dataset': url, 'extra': {'size': size}}
+
+# Function to download one file with parallel Range segments, resume and size check; the
+# segments run in segment_pool, whose threads keep their connections from file to file
+# (a pool of this file only if not given), a single segment in the calling thread
+def download_file(pool, url, output_dir, segments=DEFAULT_SEGMENTS, max_retries=5, cache=None, handle=None,
+                  segment_pool=None):
+    output = os.path.join(output_dir, os.path.basename(urlsplit(url).path))
+    size, ranges = remote_info(pool, url)
+    if size is not None and os.path.exists(output) and os.path.getsize(output) == size:
+        print(f"Skipping {output} - already complete")
+        return output
+    request = cache_request(url, size)
+    if cache is not None and cache.fetch(request, output):
+        forcing_catalogue.record(output, 'soda', dataset_name(url))
+        return output
+
+    # Split large files into segments when the server allows it
+    nseg = segments if ranges and size is not None and size >= SEGMENT_MIN_SIZE else 1
+    if nseg > 1:
+        step = -(-size // nseg)
+        bounds = [(i * step, min(size, (i + 1) * step) - 1) for i in range(nseg)]
+    else:
+        bounds = [(0, None)]
+    parts = [f"{output}.part{i}of{len(bounds)}" for i in range(len(bounds))]
+    # Parts of an earlier run split differently (other --segments or size) cannot be resumed
+    for part in glob.glob(glob.escape(output) + '.part*of*'):
+        if part not in parts or not ranges:
+            os.remove(part)
+
+    resumed = sum(os.path.getsize(part) for part in parts if os.path.exists(part))
 
-def download_data(url, output_dir, data_type):
-    subprocess.run(['wget', '-r', '-l1', '--no-parent', '--progress=bar', '-nd', '--content-disposition', '--trust-server-names', '-A.nc', f'soda3.15.2_{data_type}_ocean_reg_*.nc', url, '-P', output_dir])
+    print(f"Downloading {url} ({size} bytes, {len(bounds)} segments)...")
+    fetch = lambda task: fetch_segment(pool, url, *task, handle)
 
-def download_monthly_data(year, output_dir, data_type):
-    url = f"http://dsrs.atmos.umd.edu/DATA/soda3.15.2/REGRIDED/ocean/soda3.15.2_mn_ocean_reg_{year}.nc"
-    download_data(url, output_dir, data_type)
+    # Function to fetch one segment, its retries counted in the task of the file
+    def fetch_with_retries(task):
+        with task_events.bound(handle or task_events.current()):
+            return call_with_retries(fetch, task, max_retries, 5, 120)
 
-def download_5daily_data(year, month, output_dir, data_type):
-    url = f"http://dsrs.atmos.umd.edu/DATA/soda3.15.2/REGRIDED/ocean/soda3.15.2_5dy_ocean_reg_{year}_{month:02d}_*.nc"
-    subprocess.run(['wget', '-r', '-l1', '--no-parent', '--progress=bar', '-nd', '--content-disposition', '--trust-server-names', '-A', f'soda3.15.2_{data_type}_ocean_reg_{year}_{month:02d}_*.nc', url, '-P', output_dir])
+    if len(bounds) == 1:
+        fetch_with_retries((parts[0],) + bounds[0])
+    else:
+        executor = segment_pool or ThreadPoolExecutor(max_workers=len(bounds))
+        try:
+            futures = [executor.submit(fetch_with_retries, (part, start, end))
+                       for part, (start, end) in zip(parts, bounds)]
+            for future in futures:
+                future.result()
+        finally:
+            if segment_pool is None:
+                executor.shutdown()
+
+    # Join the segments and check the result against Content-Length
+    with open(parts[0], 'ab') as f:
+        for part in parts[1:]:
+            with open(part, 'rb') as g:
+                while True:
+                    block = g.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    f.write(block)
+            os.remove(part)
+    if size is not None and os.path.getsize(parts[0]) != size:
+        got = os.path.getsize(parts[0])
+        os.remove(parts[0])
+        raise IOError(f"{url}: got {got} bytes, expected {size}")
+    if handle is not None:
+        handle.add_bytes(os.path.getsize(parts[0]) - resumed)
+    os.replace(parts[0], output)
+    if cache is not None:
+        cache.store(request, output)
+    forcing_catalogue.record(output, 'soda', dataset_name(url))
+    print(f"Downloaded {output}")
+    return output
+
+# Function to get the SODA dataset of a file from its name, e.g. soda3.15.2_mn_ocean_reg
+def dataset_name(url):
+    return re.sub(r'(_\d+)+\.nc$', '', os.path.basename(urlsplit(url).path))
+
+# Function to download many files concurrently over pooled connections; with a
+# ConcurrencyController (limit), the files downloaded at once follow its limit; with
+# a shard (task_shards.py), only the files this worker claims, its own ones first
+def download_files(urls, output_dir, workers=DEFAULT_WORKERS, segments=DEFAULT_SEGMENTS, pool=None, cache=None,
+                   limit=None, shard=None):
+    pool = pool or ConnectionPool()
+    failures = []
+    workers = max(1, limit.max_limit if limit is not None else workers)
+    # One segment pool for the whole run: its threads (and their connections) serve every file
+    segment_pool = ThreadPoolExecutor(max_workers=workers * max(1, segments)) if segments > 1 else None
+
+    def download(url):
+        if limit is None:
+            with task_events.task('soda', os.path.basename(url)) as handle:
+                return download_file(pool, url, output_dir, segments, cache=cache, handle=handle,
+                                     segment_pool=segment_pool)
+        with limit, task_events.task('soda', os.path.basename(url)) as handle:
+            return download_file(pool, url, output_dir, segments, cache=cache, handle=handle,
+                                 segment_pool=segment_pool)
+
+    def fetch(url):
+        if shard is None:
+            return download(url)
+        name = os.path.basename(url)
+        if not shard.claim(name):
+            return None
+        try:
+            output = download(url)
+        except Exception:
+            shard.release(name)
+            raise
+        shard.complete(name)
+        return output
+
+    try:
+        for phase in ([urls] if shard is None else [shard.mine(urls), shard.others(urls)]):
+            for url in phase:
+                task_events.enqueue('soda', os.path.basename(url))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(fetch, url): url for url in phase}
+                for future, url in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Failed to download {url}: {e}")
+                        failures.append((url, e))
+    finally:
+        if segment_pool is not None:
+            segment_pool.shutdown()
+    return failures
+
+# Function to check the downloaded files (NetCDF header and a sample of the data) and to
+# download the bad ones again; returns the files still bad as failures
+def check_downloads(urls, output_dir, workers=DEFAULT_WORKERS, segments=DEFAULT_SEGMENTS, pool=None, cache=None,
+                    limit=None):
+    outputs = {os.path.join(output_dir, os.path.basename(urlsplit(url).path)): url for url in urls}
+    bad = forcing_check.scan(list(outputs))
+    if not bad:
+        print(f"{len(outputs)} files passed the integrity check")
+        return []
+    forcing_check.print_report(bad, len(outputs))
+    for output in bad:
+        if cache is not None and os.path.exists(output):
+            cache.discard(cache_request(outputs[output], os.path.getsize(output)))
+        forcing_check.quarantine(output)
+
+    retry = [outputs[output] for output in bad]
+    failures = download_files(retry, output_dir, workers, segments, pool, cache, limit)
+    failed = {url for url, _ in failures}
+    still_bad = forcing_check.scan([output for output in bad if outputs[output] not in failed])
+    for output, problems in still_bad.items():
+        forcing_check.quarantine(output)
+        failures.append((outputs[output], IOError('; '.join(problems))))
+    return failures
+
+def monthly_urls(year):
+    return [urljoin(BASE_URL, f"soda3.15.2_mn_ocean_reg_{year}.nc")]
+
+def five_daily_urls(pool, year, month):
+    return list_remote_files(pool, BASE_URL, f"soda3.15.2_5dy_ocean_reg_{year}_{month:02d}_*.nc")
 
 def main():
     parser = argparse.ArgumentParser(description="Download SODA3.15.2 data.")
@@ -39,6 +286,13 @@ def main():
     # Add --data-type as a choice to allow either monthly or 5daily
     data_type_choices = ["monthly", "5daily"]
     parser.add_argument("--data-type", choices=data_type_choices, default=DEFAULT_DATA_TYPE, help="Type of data to download (monthly or 5daily)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Files downloaded at the same time (at first)")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS, help="Most files downloaded at the same time")
+    parser.add_argument("--fixed-workers", action="store_true", help="Keep --workers files downloading, whatever the throughput")
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS, help="Parallel Range segments per large file")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Shared forcing cache directory (disabled if not given)")
+    parser.add_argument("--cache-quota-gb", type=float, default=DEFAULT_QUOTA_GB, help="Disk quota of the shared forcing cache")
+    parser.add_argument("--no-check", action="store_true", help="Do not check the downloaded files (nor download the bad ones again)")
 
     args = parser.parse_args()
 
@@ -50,16 +304,40 @@ def main():
     data_type = args.data_type
 
     os.makedirs(OUTDIR, exist_ok=True)
+    pool = ConnectionPool()
 
+    urls = []
     if data_type == "monthly":
         for YEAR in range(YEAR_START, YEAR_END + 1):
-            download_monthly_data(YEAR, OUTDIR, data_type)
+            urls += monthly_urls(YEAR)
     elif data_type == "5daily":
         for YEAR in range(YEAR_START, YEAR_END + 1):
-            mstart = MONTH_START if YEAR != YEAR_START else 1
-            mend = MONTH_END if YEAR != YEAR_END else 12
+            mstart = MONTH_START if YEAR == YEAR_START else 1
+            mend = MONTH_END if YEAR == YEAR_END else 12
             for MONTH in range(mstart, mend + 1):
-                download_5daily_data(YEAR, MONTH, OUTDIR, data_type)
+                urls += five_daily_urls(pool, YEAR, MONTH)
+        # The pentads straddling the first and last month boundaries, for the monthly means
+        before = (YEAR_START, MONTH_START - 1) if MONTH_START > 1 else (YEAR_START - 1, 12)
+        after = (YEAR_END, MONTH_END + 1) if MONTH_END < 12 else (YEAR_END + 1, 1)
+        urls = five_daily_urls(pool, *before)[-1:] + urls + five_daily_urls(pool, *after)[:1]
+
+    cache = ForcingCache(args.cache_dir, args.cache_quota_gb) if args.cache_dir else None
+    limit = None if args.fixed_workers else \
+        ConcurrencyController(args.workers, max_limit=args.max_workers, sources=('soda',))
+    # Worker of a sharded run (SLURM job array or several processes): its files are claimed
+    # in OUTDIR/.claims (their names tell their content, no configuration to hash), and
+    # only the files it downloaded are checked
+    shard = task_shards.default_shard('soda', OUTDIR, outputs=lambda name: [os.path.join(OUTDIR, name)])
+    failures = download_files(urls, OUTDIR, args.workers, args.segments, pool, cache, limit, shard)
+    if not args.no_check:
+        failed = {url for url, _ in failures}
+        checked = [url for url in urls if url not in failed and (shard is None or os.path.basename(url) in shard.done)]
+        failures += check_downloads(checked, OUTDIR, args.workers, args.segments, pool, cache, limit)
+    task_events.finish()
+    if limit is not None:
+        limit.print_history()
+    if failures:
+        raise SystemExit(f"{len(failures)} of {len(urls)} files failed to download")
 
     print("Data downloaded successfully to:", OUTDIR)
 
@@ -0,0 +1,196 @@
+#===========================================================================
+# Local cache shared by the ERA5, CMEMS and SODA download scripts
+#
+#  A request is described by a dict:
+#    {'source': 'era5' | 'cmems' | 'soda', 'dataset': ..., 'variables': [...],
+#     'bbox': [lon_min, lon_max, lat_min, lat_max] or None,
+#     'time': [start, end] or None, 'depth': [min, max] or None,
+#     'extra': {...anything else that must match exactly...}}
+#  Files are stored under the sha256 of the canonical request. A request
+#  that is not in the cache can still be served by slicing an entry of the
+#  same dataset/variables/extra whose bbox, time and depth ranges contain
+#  it. Entries are copies of the files, never hard links, and the cache is
+#  kept under a disk quota by evicting the least recently used entries.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+DEFAULT_CACHE_DIR = os.environ.get('FORCING_CACHE_DIR', os.path.expanduser('~/.cache/croco_forcing'))
+DEFAULT_QUOTA_GB = float(os.environ.get('FORCING_CACHE_QUOTA_GB', 200))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    match TEXT NOT NULL,
+    request TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_match ON entries (match);
+'''
+
+
+# Function to build the canonical form of a request
+def canonical_request(request):
+    request = dict(request)
+    request['variables'] = sorted(request.get('variables') or [])
+    for name in ('bbox', 'time', 'depth'):
+        value = request.get(name)
+        request[name] = list(value) if value is not None else None
+    request.setdefault('extra', {})
+    return request
+
+
+# Function to hash a JSON-serialisable object
+def request_hash(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Function to normalise a time bound, a bare date covers the whole day
+def time_bound(value, end=False):
+    value = str(value).replace(' ', 'T')
+    if len(value) == 10:
+        value += 'T23:59:59' if end else 'T00:00:00'
+    return value
+
+
+# Function to tell whether the ranges of a cached request contain those of a new one
+def contains(cached, wanted):
+    if wanted['bbox'] is not None:
+        if cached['bbox'] is not None:
+            c, w = cached['bbox'], wanted['bbox']
+            if not (c[0] <= w[0] and w[1] <= c[1] and c[2] <= w[2] and w[3] <= c[3]):
+                return False
+    elif cached['bbox'] is not None:
+        return False
+    if wanted['time'] is not None:
+        if cached['time'] is None:
+            return False
+        if time_bound(cached['time'][0]) > time_bound(wanted['time'][0]) or \
+                time_bound(cached['time'][1], True) < time_bound(wanted['time'][1], True):
+            return False
+    if wanted['depth'] is not None and cached['depth'] is not None:
+        if cached['depth'][0] > wanted['depth'][0] or cached['depth'][1] < wanted['depth'][1]:
+            return False
+    return True
+
+
+class ForcingCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, quota_gb=DEFAULT_QUOTA_GB):
+        self.cache_dir = cache_dir
+        self.quota = quota_gb * 1e9
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # Serve a request into `output`, exactly or by slicing a larger entry; True on a hit
+    def fetch(self, request, output):
+        request = canonical_request(request)
+        key = request_hash(request)
+        match = request_hash([request['source'], request['dataset'], request['variables'], request['extra']])
+        with self._connect() as db:
+            rows = db.execute('SELECT key, request, path FROM entries WHERE match = ? ORDER BY size',
+                              (match,)).fetchall()
+        for entry_key, entry_request, path in rows:
+            cached = json.loads(entry_request)
+            if entry_key != key and not contains(cached, request):
+                continue
+            if not os.path.exists(path):
+                self._forget(entry_key)
+                continue
+            tmp = f'{output}.cache{os.getpid()}'
+            try:
+                if entry_key == key:
+                    shutil.copyfile(path, tmp)
+                else:
+                    self._slice(path, request, tmp)
+                os.replace(tmp, output)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            with self._connect() as db:
+                db.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), entry_key))
+            print(f"Served {os.path.basename(output)} from cache")
+            return True
+        return False
+
+    # Add a downloaded file to the cache and evict old entries beyond the quota
+    def store(self, request, path):
+        request = canonical_request(request)
+        key = request_hash(request)
+        match = request_hash([request['source'], request['dataset'], request['variables'], request['extra']])
+        target = os.path.join(self.cache_dir, 'objects', key[:2], key + os.path.splitext(path)[1])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # A copy, not a hard link: the entry must own its blocks for the quota, and must
+        # not change with the output files
+        tmp = f'{target}.part{os.getpid()}'
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, target)
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, match, json.dumps(request, sort_keys=True), target,
+                        os.path.getsize(target), time.time()))
+        self.evict(keep=key)
+
+    # Remove the least recently used entries until the cache fits in the quota
+    def evict(self, keep=None):
+        with self._connect() as db:
+            rows = db.execute('SELECT key, path, size FROM entries ORDER BY last_access').fetchall()
+        total = sum(size for _, _, size in rows)
+        for key, path, size in rows:
+            if total <= self.quota:
+                break
+            if key == keep:
+                continue
+            self._forget(key)
+            if os.path.exists(path):
+                os.remove(path)
+            total -= size
+
+    # Remove the entry of a request, e.g. a file found bad after it was served
+    def discard(self, request):
+        key = request_hash(canonical_request(request))
+        with self._connect() as db:
+            row = db.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+        self._forget(key)
+        if row and os.path.exists(row[0]):
+            os.remove(row[0])
+
+    def _forget(self, key):
+        with self._connect() as db:
+            db.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    # Write the part of a cached file covered by a request
+    def _slice(self, path, request, output):
+        import xarray as xr
+        from forcing_subset import subset_dataset
+        from netcdf_encoding import write_netcdf
+
+        with xr.open_dataset(path, chunks={}) as ds:
+            bbox = request['bbox']
+            ds = subset_dataset(ds,
+                                lon=(bbox[0], bbox[1]) if bbox else None,
+                                lat=(bbox[2], bbox[3]) if bbox else None,
+                                depth=request['depth'])
+            if request['time'] is not None:
+                tdim = 'valid_time' if 'valid_time' in ds.dims else 'time'
+                ds = ds.sel({tdim: slice(time_bound(request['time'][0]),
+                                         time_bound(request['time'][1], True))})
+            write_netcdf(ds, output)
@@ -0,0 +1,292 @@
+#===========================================================================
+# SQLite catalogue of the forcing files downloaded and processed by the
+# ERA5, CMEMS and SODA scripts
+#
+#  Every file written by a script is recorded (nothing is recorded if
+#  $FORCING_CATALOGUE is unset) with its source, dataset, variables, time
+#  coverage, bbox, depth range, size and sha256, in one transaction. The
+#  months a file covers entirely (every day of the month, or the time step
+#  of a monthly mean) are kept in their own table, so that questions like
+#  "which months of thetao are missing for 1993-2022 in this box" are one
+#  indexed query instead of a scan of the scratch directories.
+#
+#  python forcing_catalogue.py catalogue.sqlite --scan /scratch/era5 --source era5
+#  python forcing_catalogue.py catalogue.sqlite --missing thetao 1993-01 2022-12 --bbox 86 92 20 23
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+CATALOGUE_FILE = os.environ.get('FORCING_CATALOGUE')
+TOLERANCE = 1e-3  # degrees / metres allowed between a file bbox and a query bbox
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    dataset TEXT,
+    time_start TEXT,
+    time_end TEXT,
+    lon_min REAL,
+    lon_max REAL,
+    lat_min REAL,
+    lat_max REAL,
+    depth_min REAL,
+    depth_max REAL,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    recorded REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS variables (
+    path TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    PRIMARY KEY (variable, path)
+);
+CREATE TABLE IF NOT EXISTS months (
+    path TEXT NOT NULL,
+    month TEXT NOT NULL,
+    PRIMARY KEY (month, path)
+);
+CREATE INDEX IF NOT EXISTS variables_path ON variables (path);
+CREATE INDEX IF NOT EXISTS months_path ON months (path);
+CREATE INDEX IF NOT EXISTS files_source ON files (source);
+'''
+
+
+# Function to compute the sha256 of a file
+def file_checksum(path, blocksize=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Function to list the months entirely covered by time steps: every day of the
+# month for daily or sub-daily data, the month of each step for monthly means
+def covered_months(times):
+    times = np.asarray(times, dtype='datetime64[s]')
+    if times.size == 0:
+        return []
+    months = np.unique(times.astype('datetime64[M]'))
+    if times.size == 1 or np.median(np.diff(np.sort(times))) >= np.timedelta64(28, 'D'):
+        return [str(m) for m in months]
+    days = set(np.unique(times.astype('datetime64[D]')).tolist())
+    covered = []
+    for month in months:
+        first = month.astype('datetime64[D]')
+        last = (month + 1).astype('datetime64[D]')
+        if all(day in days for day in np.arange(first, last).tolist()):
+            covered.append(str(month))
+    return covered
+
+
+# Function to read the variables, time coverage, bbox and depth range of a NetCDF file
+def describe_file(path):
+    import xarray as xr
+    from forcing_subset import coord_kind
+
+    info = {'variables': [], 'months': [], 'time_start': None, 'time_end': None}
+    with xr.open_dataset(path, chunks={}) as ds:
+        info['variables'] = sorted(str(v) for v in ds.data_vars)
+        bounds = {}
+        for dim in ds.dims:
+            if dim not in ds.coords or ds[dim].size == 0:
+                continue
+            values = ds[dim].values
+            if np.issubdtype(values.dtype, np.datetime64):
+                info['time_start'] = str(values.min().astype('datetime64[s]'))
+                info['time_end'] = str(values.max().astype('datetime64[s]'))
+                info['months'] = covered_months(values)
+                continue
+            kind = coord_kind(ds[dim])
+            if kind is None:
+                continue
+            # Several grids of the same kind (e.g. SODA t and u points): keep the range they all cover
+            lo, hi = float(np.nanmin(values)), float(np.nanmax(values))
+            if kind in bounds:
+                lo, hi = max(lo, bounds[kind][0]), min(hi, bounds[kind][1])
+            bounds[kind] = (lo, hi)
+    for kind in ('lon', 'lat', 'depth'):
+        info[f'{kind}_min'], info[f'{kind}_max'] = bounds.get(kind, (None, None))
+    return info
+
+
+# Function to list the months (YYYY-MM) from a month to another (included)
+def month_strings(first, last):
+    return [str(m) for m in np.arange(np.datetime64(first, 'M'), np.datetime64(last, 'M') + 1)]
+
+
+class Catalogue:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # Record (or update) a file, its variables and the months it covers in one transaction
+    def record(self, path, source, dataset=None, sha256=None, info=None):
+        path = os.path.abspath(path)
+        info = info or describe_file(path)
+        sha256 = sha256 or file_checksum(path)
+        with self._connect() as db:
+            db.execute('DELETE FROM variables WHERE path = ?', (path,))
+            db.execute('DELETE FROM months WHERE path = ?', (path,))
+            db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (path, source, dataset, info['time_start'], info['time_end'],
+                        info['lon_min'], info['lon_max'], info['lat_min'], info['lat_max'],
+                        info['depth_min'], info['depth_max'], os.path.getsize(path), sha256, time.time()))
+            db.executemany('INSERT INTO variables VALUES (?, ?)', [(path, v) for v in info['variables']])
+            db.executemany('INSERT INTO months VALUES (?, ?)', [(path, m) for m in info['months']])
+
+    # Remove a file from the catalogue
+    def forget(self, path):
+        path = os.path.abspath(path)
+        with self._connect() as db:
+            db.execute('DELETE FROM variables WHERE path = ?', (path,))
+            db.execute('DELETE FROM months WHERE path = ?', (path,))
+            db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    # Function to build the WHERE clause on the files of a source containing a bbox
+    @staticmethod
+    def _filters(source=None, bbox=None, tolerance=TOLERANCE):
+        clauses, params = [], []
+        if source is not None:
+            clauses.append('f.source = ?')
+            params.append(source)
+        if bbox is not None:
+            lon_min, lon_max, lat_min, lat_max = bbox
+            clauses.append('f.lon_min <= ? AND f.lon_max >= ? AND f.lat_min <= ? AND f.lat_max >= ?')
+            params += [lon_min + tolerance, lon_max - tolerance, lat_min + tolerance, lat_max - tolerance]
+        return clauses, params
+
+    # Files holding a variable (all by default), overlapping [start, end], containing a bbox
+    def files(self, variable=None, source=None, start=None, end=None, bbox=None, tolerance=TOLERANCE):
+        clauses, params = self._filters(source, bbox, tolerance)
+        query = 'SELECT f.* FROM files f'
+        if variable is not None:
+            query += ' JOIN variables v ON v.path = f.path'
+            clauses.append('v.variable = ?')
+            params.append(variable)
+        if start is not None:
+            clauses.append('f.time_end >= ?')
+            params.append(str(start))
+        if end is not None:
+            clauses.append('f.time_start <= ?')
+            params.append(str(end))
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            return [dict(row) for row in db.execute(query + ' ORDER BY f.time_start, f.path', params)]
+
+    # Months (YYYY-MM) between two months covered by a file holding the variable and containing the bbox
+    def covered(self, variable, first, last, source=None, bbox=None, tolerance=TOLERANCE):
+        clauses, params = self._filters(source, bbox, tolerance)
+        clauses = ['v.variable = ?', 'm.month BETWEEN ? AND ?'] + clauses
+        params = [variable, str(first)[:7], str(last)[:7]] + params
+        query = ('SELECT DISTINCT m.month FROM months m JOIN variables v ON v.path = m.path '
+                 'JOIN files f ON f.path = m.path WHERE ' + ' AND '.join(clauses))
+        with self._connect() as db:
+            return sorted(row[0] for row in db.execute(query, params))
+
+    # Months (YYYY-MM) between two months with no file holding the variable and containing the bbox
+    def missing_months(self, variable, first, last, source=None, bbox=None, tolerance=TOLERANCE):
+        covered = set(self.covered(variable, first, last, source, bbox, tolerance))
+        return [m for m in month_strings(str(first)[:7], str(last)[:7]) if m not in covered]
+
+
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+
+# Function to get the catalogue named by $FORCING_CATALOGUE (None if unset)
+def default_catalogue():
+    global _catalogue
+    if not CATALOGUE_FILE:
+        return None
+    with _catalogue_lock:
+        if _catalogue is None:
+            _catalogue = Catalogue(CATALOGUE_FILE)
+        return _catalogue
+
+
+# Function to record a file in the default catalogue; a failure is reported, never raised,
+# so that the catalogue cannot break a download
+def record(path, source, dataset=None, sha256=None):
+    catalogue = default_catalogue()
+    if catalogue is None:
+        return
+    try:
+        catalogue.record(path, source, dataset, sha256)
+    except Exception as e:
+        print(f"Could not record {path} in {CATALOGUE_FILE}: {e}")
+
+
+# Function to remove a file from the default catalogue
+def forget(path):
+    catalogue = default_catalogue()
+    if catalogue is None:
+        return
+    try:
+        catalogue.forget(path)
+    except Exception as e:
+        print(f"Could not remove {path} from {CATALOGUE_FILE}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or fill the catalogue of the forcing files.")
+    parser.add_argument("catalogue", type=str, help="SQLite catalogue file")
+    parser.add_argument("--scan", type=str, nargs='+', metavar="DIR", help="Record the NetCDF files of these directories")
+    parser.add_argument("--source", type=str, help="Source of the scanned files (era5, cmems, soda), or of the queried ones")
+    parser.add_argument("--dataset", type=str, help="Dataset of the scanned files")
+    parser.add_argument("--missing", type=str, nargs=3, metavar=("VARIABLE", "FIRST", "LAST"),
+                        help="List the months (YYYY-MM) of a variable missing between two months")
+    parser.add_argument("--list", type=str, nargs='?', const='', metavar="VARIABLE", help="List the files (of a variable)")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("LON_MIN", "LON_MAX", "LAT_MIN", "LAT_MAX"),
+                        help="Only files containing this box")
+    args = parser.parse_args()
+
+    catalogue = Catalogue(args.catalogue)
+    if args.scan:
+        for directory in args.scan:
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith('.nc'):
+                    continue
+                try:
+                    catalogue.record(os.path.join(directory, name), args.source or 'unknown', args.dataset)
+                    print(f"Recorded {name}")
+                except Exception as e:
+                    print(f"Skipping {name}: {e}")
+    if args.list is not None:
+        for row in catalogue.files(args.list or None, args.source, bbox=args.bbox):
+            print(f"{row['path']}  {row['source']}  {row['time_start']} .. {row['time_end']}  {row['size']}")
+    if args.missing:
+        variable, first, last = args.missing
+        start = time.monotonic()
+        missing = catalogue.missing_months(variable, first, last, args.source, args.bbox)
+        print(f"{len(missing)} months of {variable} missing between {first} and {last} "
+              f"({(time.monotonic() - start) * 1000:.1f} ms)")
+        for month in missing:
+            print(month)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#===========================================================================
+# Integrity check of the forcing files written by the ERA5, CMEMS and
+# SODA download scripts
+#
+#  Failed CDS requests, wget or copernicusmarine runs can leave empty,
+#  truncated or HTML error files which only fail days later in the CROCO
+#  preprocessing. The files are checked by a pool of processes from their
+#  header and a sparse sample of their data: NetCDF signature, file size
+#  against the end of data given by the header (HDF5 superblock or classic
+#  variable offsets), expected variables, time coverage and fraction of
+#  missing values. The scripts move the bad files aside (.bad) and queue
+#  their downloads again.
+#
+#  python forcing_check.py /scratch/era5 --variables u10 --start 2000-01-01 --end 2000-01-31
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import datetime
+import multiprocessing
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import forcing_catalogue
+
+MAX_NAN_FRACTION = 0.99  # files whose data sample has more missing values are bad
+SAMPLE_POINTS = 32       # points kept along each horizontal axis of the data sample
+HEADER_BYTES = 1 << 20   # bytes read to parse the header of a classic NetCDF file
+TIME_NAMES = ('valid_time', 'time')
+
+# Sizes (bytes) of the classic NetCDF types, by type code
+CLASSIC_TYPES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+
+# Function to get the end of the data of an HDF5 file from its superblock (None if unknown)
+def hdf5_end(head):
+    version = head[8]
+    if version in (0, 1):
+        offsets, start = head[13], 24 if version == 0 else 28
+    elif version in (2, 3):
+        offsets, start = head[9], 12
+    else:
+        return None
+    fmt = {4: '<I', 8: '<Q'}.get(offsets)
+    if fmt is None or len(head) < start + 3 * offsets:
+        return None
+    base = struct.unpack_from(fmt, head, start)[0]
+    end = struct.unpack_from(fmt, head, start + 2 * offsets)[0]
+    if end == 2 ** (8 * offsets) - 1:
+        return None
+    return base + end
+
+
+# Function to get the end of the data of a classic (CDF-1, 2 or 5) file from its header
+def classic_end(f):
+    data = f.read(HEADER_BYTES)
+    version = data[3]
+    count = '>Q' if version == 5 else '>I'
+    offset = '>Q' if version in (2, 5) else '>I'
+    pos = 4
+
+    def read(fmt):
+        nonlocal pos
+        value = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+        return value
+
+    def skip(nbytes):
+        nonlocal pos
+        pos += -(-nbytes // 4) * 4  # padded to 4 bytes
+
+    def skip_attributes():
+        read('>I')
+        for _ in range(read(count)):
+            skip(read(count))
+            size = CLASSIC_TYPES[read('>I')]
+            skip(read(count) * size)
+
+    numrecs = read(count)
+    if numrecs == 2 ** (8 * struct.calcsize(count)) - 1:
+        return None  # streaming: number of records not written
+    read('>I')
+    dims = []
+    for _ in range(read(count)):
+        skip(read(count))
+        dims.append(read(count))
+    skip_attributes()
+    read('>I')
+    variables = []
+    for _ in range(read(count)):
+        skip(read(count))
+        dimids = [read(count) for _ in range(read(count))]
+        record = any(dims[d] == 0 for d in dimids)
+        skip_attributes()
+        read('>I')
+        vsize = read(count)
+        variables.append((record, vsize, read(offset)))
+
+    recsize = sum(vsize for record, vsize, _ in variables if record)
+    end = pos
+    for record, vsize, begin in variables:
+        if record:
+            end = max(end, begin + (numrecs - 1) * recsize + vsize if numrecs else begin)
+        else:
+            end = max(end, begin + vsize)
+    return end
+
+
+# Function to find a variable of a file from its name or its GRIB short name (ERA5)
+def find_variable(nc, name):
+    for vname, variable in nc.variables.items():
+        if vname.lower() == name.lower() or str(getattr(variable, 'GRIB_shortName', '')).lower() == name.lower():
+            return variable
+    return None
+
+
+# Function to read the first and last time steps of a file as dates; also checks that they increase
+def time_range(nc):
+    import netCDF4
+
+    for name in TIME_NAMES:
+        if name in nc.variables:
+            variable = nc.variables[name]
+            values = np.ma.filled(variable[:].astype('f8'), np.nan)
+            if values.size == 0 or np.isnan(values).any():
+                raise ValueError(f"{name} has missing values")
+            if values.size > 1 and not (np.diff(values) > 0).all():
+                raise ValueError(f"{name} is not increasing")
+            dates = netCDF4.num2date([values[0], values[-1]], variable.units,
+                                     getattr(variable, 'calendar', 'standard'),
+                                     only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+            return dates[0], dates[-1]
+    return None
+
+
+# Function to check the time steps of a file against the dates they must cover,
+# or the month they must all fall in; returns the problem found, None if none
+def time_problem(nc, start=None, end=None, month=None):
+    try:
+        dates = time_range(nc)
+    except ValueError as e:
+        return str(e)
+    if dates is None:
+        return 'no time coordinate'
+    first, last = dates
+    if (start and first.date() > datetime.date.fromisoformat(start)) or \
+            (end and last.date() < datetime.date.fromisoformat(end)):
+        return f"time {first:%Y-%m-%d}..{last:%Y-%m-%d} does not cover {start or '...'}..{end or '...'}"
+    if month and (first.strftime('%Y-%m') != month or last.strftime('%Y-%m') != month):
+        return f"time {first:%Y-%m-%d}..{last:%Y-%m-%d} is not in {month}"
+    return None
+
+
+# Function to get the fraction of missing values in a sparse sample of a variable:
+# first, middle and last time step, first level, strided horizontal slab
+def nan_fraction(variable):
+    index = []
+    for k, (dim, n) in enumerate(zip(variable.dimensions, variable.shape)):
+        if k >= variable.ndim - 2:
+            index.append(slice(None, None, max(1, n // SAMPLE_POINTS)))
+        elif dim in TIME_NAMES:
+            index.append(sorted({0, n // 2, n - 1}))
+        else:
+            index.append(0)
+    # netCDF4 takes one list index at a time
+    lists = [k for k, i in enumerate(index) if isinstance(i, list)]
+    if lists:
+        k = lists[0]
+        sample = np.ma.concatenate([np.ma.atleast_1d(variable[tuple(index[:k] + [i] + index[k + 1:])]).ravel()
+                                    for i in index[k]])
+    else:
+        sample = np.ma.atleast_1d(variable[tuple(index)]).ravel()
+    if sample.size == 0:
+        return 1.0
+    missing = np.ma.getmaskarray(sample)
+    if np.issubdtype(sample.dtype, np.floating):
+        missing = missing | np.isnan(np.ma.getdata(sample))
+    return float(missing.mean())
+
+
+# Function to check one file; returns the list of its problems, empty for a good file.
+# start / end: dates (YYYY-MM-DD) the time steps must cover; month (YYYY-MM): month
+# every time step must fall in (monthly means)
+def check_file(path, variables=(), start=None, end=None, month=None, max_nan=MAX_NAN_FRACTION):
+    import netCDF4
+
+    if not os.path.exists(path):
+        return ['missing file']
+    size = os.path.getsize(path)
+    if size == 0:
+        return ['empty file']
+    with open(path, 'rb') as f:
+        head = f.read(512)
+        if head.lstrip()[:1] == b'<' or b'<html' in head.lower():
+            return ['HTML/XML page instead of NetCDF']
+        try:
+            if head[:8] == b'\x89HDF\r\n\x1a\n':
+                end_of_data = hdf5_end(head)
+            elif head[:3] == b'CDF' and head[3] in (1, 2, 5):
+                f.seek(0)
+                end_of_data = classic_end(f)
+            else:
+                return ['not a NetCDF file']
+        except (struct.error, IndexError, KeyError):
+            return ['corrupt header']
+    if end_of_data is not None and size < end_of_data - 3:
+        return [f'truncated ({size} of {end_of_data} bytes)']
+
+    problems = []
+    try:
+        with netCDF4.Dataset(path) as nc:
+            found = [find_variable(nc, name) for name in variables]
+            missing = [name for name, variable in zip(variables, found) if variable is None]
+            if missing:
+                problems.append(f"missing variables {', '.join(missing)}")
+
+            if start or end or month:
+                problem = time_problem(nc, start, end, month)
+                if problem:
+                    problems.append(problem)
+
+            # Without expected variables, every field (2 dimensions or more) is sampled
+            sampled = [v for v in found if v is not None] if variables else \
+                [v for name, v in nc.variables.items() if v.ndim >= 2 and name not in nc.dimensions]
+            for variable in sampled:
+                fraction = nan_fraction(variable)
+                if fraction > max_nan:
+                    problems.append(f"{variable.name}: {fraction:.0%} missing values in the sample")
+    except Exception as e:
+        problems.append(f"unreadable: {e}")
+    return problems
+
+
+def _check(item):
+    path, expected = item
+    return path, check_file(path, **expected)
+
+
+# Function to check many files with a pool of processes; `files` maps every path to
+# the keyword arguments of check_file. Returns {path: problems} of the bad files.
+def scan(files, workers=None):
+    items = list(files.items()) if isinstance(files, dict) else [(path, {}) for path in files]
+    if not items:
+        return {}
+    workers = max(1, min(workers or os.cpu_count() or 1, len(items)))
+    if workers == 1:
+        results = map(_check, items)
+    else:
+        # spawn, not fork: a fork of the download scripts would copy the locks held by
+        # their threads (HDF5, HTTP pools); the scripts keep their run under a main guard
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        results = executor.map(_check, items, chunksize=max(1, len(items) // (4 * workers)))
+    try:
+        return {path: problems for path, problems in results if problems}
+    finally:
+        if workers > 1:
+            executor.shutdown()
+
+
+# Function to move a bad file aside (path.bad) so that it is downloaded again
+def quarantine(path):
+    if not os.path.exists(path):
+        return None
+    bad = path + '.bad'
+    os.replace(path, bad)
+    forcing_catalogue.forget(path)
+    return bad
+
+
+# Function to print the problems of the bad files
+def print_report(bad, checked):
+    print(f"{len(bad)} of {checked} files failed the integrity check:")
+    for path in sorted(bad):
+        print(f"  {os.path.basename(path)}: {'; '.join(bad[path])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the integrity of forcing files.")
+    parser.add_argument("paths", type=str, nargs='+', help="NetCDF files, or directories of NetCDF files")
+    parser.add_argument("--variables", type=str, nargs='+', default=[], help="Variables every file must hold")
+    parser.add_argument("--start", type=str, help="First day (YYYY-MM-DD) every file must cover")
+    parser.add_argument("--end", type=str, help="Last day (YYYY-MM-DD) every file must cover")
+    parser.add_argument("--max-nan", type=float, default=MAX_NAN_FRACTION, help="Largest fraction of missing values")
+    parser.add_argument("--workers", type=int, default=None, help="Processes checking files (default: all cores)")
+    parser.add_argument("--quarantine", action="store_true", help="Move the bad files aside (.bad)")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths += [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.nc')]
+        else:
+            paths.append(path)
+    expected = {'variables': args.variables, 'start': args.start, 'end': args.end, 'max_nan': args.max_nan}
+
+    start = time.monotonic()
+    bad = scan({path: expected for path in paths}, args.workers)
+    print(f"Checked {len(paths)} files in {time.monotonic() - start:.2f} s")
+    if bad:
+        print_report(bad, len(paths))
+        if args.quarantine:
+            for path in bad:
+                quarantine(path)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
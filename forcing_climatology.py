@@ -0,0 +1,353 @@
+#===========================================================================
+# Monthly climatology and anomalies of the processed ocean forcing files
+# (raw_soda_Y*M*.nc, raw_motu_mercator_Y*M*.nc), updated incrementally
+#
+#  The running mean and variance of every grid point are kept per calendar
+#  month (Welford: count, mean and sum of the squared deviations), in one
+#  state file per calendar month. Adding files folds in only the months
+#  not folded yet, one horizontal slab (time step and level) at a time:
+#  a new month of a 30-year climatology reads that month and rewrites the
+#  state of its calendar month, nothing else. A month is one sample, the
+#  mean of its time steps (daily CMEMS files), so that the variance is the
+#  interannual one. Missing values (land, partial coverage) are left out
+#  point by point. A file changed after it was folded cannot be taken out
+#  of the state again: --rebuild folds all the files again.
+#
+#  python forcing_climatology.py /scratch/clim_soda --add /scratch/output_soda
+#  python forcing_climatology.py /scratch/clim_soda --climatology soda_clim.nc
+#  python forcing_climatology.py /scratch/clim_soda --anomalies /scratch/output_soda/raw_soda_Y2023M1.nc
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+from forcing_check import TIME_NAMES, find_variable
+from netcdf_encoding import COMPLEVEL, SHUFFLE, chunk_shape
+
+VARIABLES = ('uo', 'vo', 'zos', 'thetao', 'so')
+FILE_PATTERN = re.compile(r'_Y(\d{4})M(\d{1,2})\.nc$')  # raw_soda_Y1993M1.nc, raw_motu_mercator_Y2021M01.nc
+STATE_FILE = 'state_M{:02d}.nc'
+
+
+# Function to get the (year, month) of a monthly file from its name, None if it has none
+def file_month(path):
+    match = FILE_PATTERN.search(os.path.basename(path))
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+# Function to list the monthly files of paths (files, or directories of files) by date
+def monthly_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, name) for name in os.listdir(path) if file_month(name)]
+        elif file_month(path):
+            files.append(path)
+        else:
+            print(f"Skipping {path} - no _Y<year>M<month>.nc in its name")
+    return sorted(files, key=file_month)
+
+
+# Function to identify the content of a file, to notice the files changed after they were folded
+def signature(path):
+    stat = os.stat(path)
+    return {'file': os.path.basename(path), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+# Function to get the name of the time dimension of a NetCDF variable, None if it has none
+def time_dimension(variable):
+    return variable.dimensions[0] if variable.dimensions and variable.dimensions[0] in TIME_NAMES else None
+
+
+# Function to read a horizontal slab of a NetCDF variable as float64, missing values as NaN
+def read_slab(variable, index):
+    return np.ma.filled(np.ma.asarray(variable[index]).astype('f8'), np.nan)
+
+
+# Function to copy the dimensions and coordinate variables of a NetCDF file, but time
+def copy_coordinates(src, dst, dimensions, time=True):
+    for name in dimensions:
+        if name in dst.dimensions or (not time and name in TIME_NAMES):
+            continue
+        size = src.dimensions[name]
+        dst.createDimension(name, None if size.isunlimited() else len(size))
+        if name in src.variables:
+            variable = src.variables[name]
+            out = dst.createVariable(name, variable.dtype, variable.dimensions)
+            out.setncatts({k: variable.getncattr(k) for k in variable.ncattrs() if k != '_FillValue'})
+            out[:] = variable[:]
+
+
+# Function to create a float variable chunked and compressed as the forcing files
+def create_field(nc, name, dimensions, shape, dtype='f4', fill_value=None):
+    chunks = chunk_shape(shape)
+    return nc.createVariable(name, dtype, dimensions, zlib=bool(COMPLEVEL), complevel=COMPLEVEL or 1,
+                             shuffle=SHUFFLE, chunksizes=chunks, fill_value=fill_value)
+
+
+class MonthlyClimatology:
+    def __init__(self, directory, variables=VARIABLES):
+        self.directory = directory
+        self.variables = tuple(variables)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, month):
+        return os.path.join(self.directory, STATE_FILE.format(month))
+
+    # Exclusive lock of the state, shared by the processes adding files to it
+    @contextlib.contextmanager
+    def lock(self):
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Function to get the months folded into the state of a calendar month, {YYYY-MM: signature}
+    def folded(self, month):
+        import netCDF4
+
+        if not os.path.exists(self.path(month)):
+            return {}
+        with netCDF4.Dataset(self.path(month)) as nc:
+            return json.loads(nc.getncattr('folded'))
+
+    # Function to create the (empty) state of a calendar month on the grid of a monthly file
+    def create_state(self, path, template):
+        import netCDF4
+
+        with netCDF4.Dataset(template) as src, netCDF4.Dataset(path, 'w', format='NETCDF4') as nc:
+            names = []
+            for name in self.variables:
+                variable = find_variable(src, name)
+                if variable is None:
+                    continue
+                names.append(name)
+                dims = variable.dimensions[1:] if time_dimension(variable) else variable.dimensions
+                copy_coordinates(src, nc, dims, time=False)
+                shape = variable.shape[len(variable.shape) - len(dims):]
+                for suffix, dtype in (('count', 'i4'), ('mean', 'f8'), ('m2', 'f8')):
+                    field = create_field(nc, f'{name}_{suffix}', dims, shape, dtype, fill_value=False)
+                    for index in np.ndindex(*shape[:-2]):
+                        field[index] = np.zeros(shape[-2:], dtype)
+                nc.variables[f'{name}_mean'].setncatts({k: variable.getncattr(k) for k in variable.ncattrs()
+                                                        if k in ('units', 'long_name', 'standard_name')})
+            if not names:
+                raise ValueError(f"{template} has none of the variables {', '.join(self.variables)}")
+            nc.setncattr('variables', ' '.join(names))
+            nc.setncattr('folded', '{}')
+
+    # Function to fold one monthly file into the (open) state of its calendar month
+    def fold(self, nc, path):
+        import netCDF4
+
+        with netCDF4.Dataset(path) as src:
+            for name in nc.getncattr('variables').split():
+                variable = find_variable(src, name)
+                if variable is None:
+                    raise ValueError(f"{path} has no {name}")
+                count, mean, m2 = (nc.variables[f'{name}_{suffix}'] for suffix in ('count', 'mean', 'm2'))
+                steps = variable.shape[0] if time_dimension(variable) else None
+                shape = variable.shape[1:] if steps is not None else variable.shape
+                if shape != mean.shape:
+                    raise ValueError(f"{path}: {name} has the shape {shape}, the climatology {mean.shape}")
+                for index in np.ndindex(*shape[:-2]):
+                    # The month is one sample: the mean of its time steps
+                    if steps is None:
+                        x = read_slab(variable, index)
+                    else:
+                        total = np.zeros(shape[-2:])
+                        valid = np.zeros(shape[-2:])
+                        for t in range(steps):
+                            slab = read_slab(variable, (t,) + index)
+                            ok = np.isfinite(slab)
+                            total += np.where(ok, slab, 0)
+                            valid += ok
+                        with np.errstate(invalid='ignore', divide='ignore'):
+                            x = total / valid
+                    ok = np.isfinite(x)
+                    n = count[index] + ok
+                    mu = mean[index]
+                    delta = np.where(ok, x - mu, 0)
+                    mu = mu + delta / np.maximum(n, 1)
+                    count[index] = n
+                    mean[index] = mu
+                    m2[index] = m2[index] + np.where(ok, delta * (x - mu), 0)
+
+    # Function to fold the months of files not folded yet; the state of a calendar month
+    # is updated in a copy which replaces it once all its new months are folded
+    def add(self, paths):
+        with self.lock():
+            pending = {}
+            for path in monthly_files(paths):
+                year, month = file_month(path)
+                key = f'{year}-{month:02d}'
+                folded = self.folded(month).get(key)
+                if folded is None:
+                    pending.setdefault(month, []).append((key, path))
+                elif folded != signature(path):
+                    print(f"{os.path.basename(path)} changed since {key} was folded from {folded['file']}, "
+                          f"use --rebuild to fold it again")
+
+            for month, items in sorted(pending.items()):
+                self.add_month(month, items)
+            return sum(len(items) for items in pending.values())
+
+    def add_month(self, month, items):
+        import netCDF4
+
+        path = self.path(month)
+        tmp_path = path + '.part'
+        start = time.monotonic()
+        try:
+            if os.path.exists(path):
+                shutil.copyfile(path, tmp_path)
+            else:
+                self.create_state(tmp_path, items[0][1])
+            with netCDF4.Dataset(tmp_path, 'r+') as nc:
+                nc.set_auto_mask(False)
+                folded = json.loads(nc.getncattr('folded'))
+                for key, file in items:
+                    self.fold(nc, file)
+                    folded[key] = signature(file)
+                nc.setncattr('folded', json.dumps(folded, sort_keys=True))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Folded {', '.join(key for key, _ in items)} into month {month:02d} "
+              f"({len(folded)} years) in {time.monotonic() - start:.2f} s")
+
+    # Function to write the climatology: mean, standard deviation and number of years
+    # of every calendar month (NaN for the months with no data)
+    def write_climatology(self, output):
+        import netCDF4
+
+        months = [month for month in range(1, 13) if os.path.exists(self.path(month))]
+        if not months:
+            raise ValueError(f"no state in {self.directory}")
+        tmp_path = output + '.part'
+        try:
+            with netCDF4.Dataset(self.path(months[0])) as template, \
+                    netCDF4.Dataset(tmp_path, 'w', format='NETCDF4') as out:
+                out.createDimension('month', 12)
+                out.createVariable('month', 'i4', ('month',))[:] = np.arange(1, 13)
+                names = template.getncattr('variables').split()
+                for name in names:
+                    state = template.variables[f'{name}_mean']
+                    copy_coordinates(template, out, state.dimensions)
+                    dims, shape = ('month',) + state.dimensions, (12,) + state.shape
+                    field = create_field(out, name, dims, shape, fill_value=np.float32(np.nan))
+                    field.setncatts({k: state.getncattr(k) for k in state.ncattrs() if k != '_FillValue'})
+                    std = create_field(out, f'{name}_std', dims, shape, fill_value=np.float32(np.nan))
+                    std.long_name = f'interannual standard deviation of {name}'
+                    years = out.createVariable(f'{name}_count', 'i2', dims, zlib=True, chunksizes=chunk_shape(shape))
+                    years.long_name = f'years averaged in {name}'
+                out.setncattr('months_folded', json.dumps({month: sorted(self.folded(month)) for month in months}))
+
+                for month in months:
+                    with netCDF4.Dataset(self.path(month)) as nc:
+                        nc.set_auto_mask(False)
+                        for name in names:
+                            count, mean, m2 = (nc.variables[f'{name}_{suffix}'] for suffix in ('count', 'mean', 'm2'))
+                            for index in np.ndindex(*mean.shape[:-2]):
+                                n = count[index]
+                                with np.errstate(invalid='ignore', divide='ignore'):
+                                    out.variables[name][(month - 1,) + index] = np.where(n > 0, mean[index], np.nan)
+                                    out.variables[f'{name}_std'][(month - 1,) + index] = \
+                                        np.where(n > 1, np.sqrt(m2[index] / (n - 1)), np.nan)
+                                out.variables[f'{name}_count'][(month - 1,) + index] = n
+            os.replace(tmp_path, output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Saved {output}")
+
+    # Function to write the anomalies of a monthly file: its time steps minus the
+    # climatological mean of its calendar month
+    def write_anomaly(self, path, output):
+        import netCDF4
+
+        year, month = file_month(path)
+        if not os.path.exists(self.path(month)):
+            raise ValueError(f"no climatology of month {month:02d} in {self.directory}")
+        tmp_path = output + '.part'
+        try:
+            with netCDF4.Dataset(self.path(month)) as nc, netCDF4.Dataset(path) as src, \
+                    netCDF4.Dataset(tmp_path, 'w', format='NETCDF4') as out:
+                nc.set_auto_mask(False)
+                for name in nc.getncattr('variables').split():
+                    variable = find_variable(src, name)
+                    if variable is None:
+                        print(f"Skipping {name} - not in {path}")
+                        continue
+                    copy_coordinates(src, out, variable.dimensions)
+                    field = create_field(out, name, variable.dimensions, variable.shape, fill_value=np.float32(np.nan))
+                    field.setncatts({k: variable.getncattr(k) for k in variable.ncattrs()
+                                     if k in ('units', 'long_name', 'standard_name')})
+                    field.comment = f'anomaly from the {month:02d} climatology of {len(self.folded(month))} years'
+                    count, mean = nc.variables[f'{name}_count'], nc.variables[f'{name}_mean']
+                    steps = variable.shape[0] if time_dimension(variable) else None
+                    for index in np.ndindex(*mean.shape[:-2]):
+                        climatology = np.where(count[index] > 0, mean[index], np.nan)
+                        for t in ([None] if steps is None else range(steps)):
+                            slab = index if t is None else (t,) + index
+                            field[slab] = read_slab(variable, slab) - climatology
+            os.replace(tmp_path, output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Saved {output}")
+
+    # Function to print the years folded into every calendar month
+    def print_status(self):
+        for month in range(1, 13):
+            years = sorted(self.folded(month))
+            if years:
+                print(f"  month {month:02d}: {len(years)} years, {years[0][:4]}..{years[-1][:4]}")
+            else:
+                print(f"  month {month:02d}: empty")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly climatology and anomalies of the ocean forcing files.")
+    parser.add_argument("state_dir", type=str, help="Directory of the climatology state")
+    parser.add_argument("--add", type=str, nargs='+', default=[], help="Monthly files, or directories, to fold in")
+    parser.add_argument("--rebuild", action="store_true", help="Fold all the files again from an empty state")
+    parser.add_argument("--variables", type=str, nargs='+', default=list(VARIABLES), help="Variables of the climatology")
+    parser.add_argument("--climatology", type=str, help="Climatology file to write")
+    parser.add_argument("--anomalies", type=str, nargs='+', default=[], help="Monthly files whose anomalies are written")
+    parser.add_argument("--output-dir", type=str, help="Directory of the anomaly files (default: next to the files)")
+    args = parser.parse_args()
+
+    climatology = MonthlyClimatology(args.state_dir, args.variables)
+    if args.rebuild:
+        with climatology.lock():
+            for month in range(1, 13):
+                if os.path.exists(climatology.path(month)):
+                    os.remove(climatology.path(month))
+    if args.add:
+        start = time.monotonic()
+        added = climatology.add(args.add)
+        print(f"Folded {added} months in {time.monotonic() - start:.2f} s")
+    if args.climatology:
+        climatology.write_climatology(args.climatology)
+    for path in monthly_files(args.anomalies):
+        output_dir = args.output_dir or os.path.dirname(path)
+        climatology.write_anomaly(path, os.path.join(output_dir, 'anom_' + os.path.basename(path)))
+    if not (args.add or args.climatology or args.anomalies):
+        climatology.print_status()
+
+
+if __name__ == "__main__":
+    main()
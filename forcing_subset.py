@@ -0,0 +1,97 @@
+#===========================================================================
+# Domain subsetting helpers for the forcing scripts
+#
+#  Longitude, latitude and depth dimensions are recognised from their CF or
+#  MOM attributes (axis / cartesian_axis / units) or, failing that, from
+#  their names. Subsetting uses index selection on the lazily opened
+#  dataset, so only the domain is ever read from disk.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import numpy as np
+
+LON_UNITS = ('degrees_east', 'degree_east', 'degrees_e', 'degree_e')
+LAT_UNITS = ('degrees_north', 'degree_north', 'degrees_n', 'degree_n')
+LON_NAMES = ('lon', 'longitude', 'nav_lon', 'xt_ocean', 'xu_ocean', 'x')
+LAT_NAMES = ('lat', 'latitude', 'nav_lat', 'yt_ocean', 'yu_ocean', 'y')
+DEPTH_NAMES = ('depth', 'deptht', 'depthu', 'depthv', 'lev', 'st_ocean', 'sw_ocean', 'z')
+TOLERANCE = 1e-6  # coordinates stored as float32 or rounded grids
+
+
+# Function to read the domain bounds from a crocotools_param file (same parsing as the ERA5 script)
+def read_crocotools_bounds(param_file, margin=0.0):
+    bounds = {}
+    with open(param_file) as f:
+        for line in f:
+            for key in ('lonmin', 'lonmax', 'latmin', 'latmax'):
+                if line.strip().startswith(key) and '=' in line:
+                    bounds[key] = float(line.split('=')[1].split(';')[0].strip())
+    return {
+        'lon': (bounds['lonmin'] - margin, bounds['lonmax'] + margin),
+        'lat': (bounds['latmin'] - margin, bounds['latmax'] + margin),
+    }
+
+
+# Function to tell whether a coordinate is a longitude, latitude, depth or other axis
+def coord_kind(da):
+    axis = str(da.attrs.get('axis', da.attrs.get('cartesian_axis', ''))).upper()
+    units = str(da.attrs.get('units', '')).lower()
+    name = str(da.name).lower()
+    if axis == 'X' or units in LON_UNITS or name in LON_NAMES:
+        return 'lon'
+    if axis == 'Y' or units in LAT_UNITS or name in LAT_NAMES:
+        return 'lat'
+    if axis == 'Z' or name in DEPTH_NAMES:
+        return 'depth'
+    return None
+
+
+# Function to find the indices of a monotonic coordinate within [vmin, vmax]
+def range_indices(values, vmin, vmax):
+    idx = np.nonzero((values >= min(vmin, vmax) - TOLERANCE) & (values <= max(vmin, vmax) + TOLERANCE))[0]
+    if idx.size == 0:
+        raise ValueError(f'No coordinate value within [{vmin}, {vmax}]')
+    return slice(int(idx[0]), int(idx[-1]) + 1)
+
+
+# Function to find the indices of a longitude range, handling 0-360 grids and the seam
+def lon_indices(values, lon_min, lon_max):
+    if values.max() > 180:
+        lon_min, lon_max = lon_min % 360, lon_max % 360
+    else:
+        lon_min, lon_max = (lon_min + 180) % 360 - 180, (lon_max + 180) % 360 - 180
+    if lon_min <= lon_max:
+        return range_indices(values, lon_min, lon_max)
+    # The domain crosses the seam of the grid: east part first, then west part
+    east = np.nonzero(values >= lon_min - TOLERANCE)[0]
+    west = np.nonzero(values <= lon_max + TOLERANCE)[0]
+    return np.concatenate([east, west])
+
+
+# Function to subset a dataset to lon/lat/depth bounds (each a (min, max) tuple or None)
+def subset_dataset(ds, lon=None, lat=None, depth=None):
+    indexers = {}
+    seams = []
+    for dim in ds.dims:
+        if dim not in ds.coords:
+            continue
+        kind = coord_kind(ds[dim])
+        values = ds[dim].values
+        if kind == 'lon' and lon is not None:
+            indexers[dim] = lon_indices(values, *lon)
+            if not isinstance(indexers[dim], slice):
+                seams.append(dim)
+        elif kind == 'lat' and lat is not None:
+            indexers[dim] = range_indices(values, *lat)
+        elif kind == 'depth' and depth is not None:
+            indexers[dim] = range_indices(values, *depth)
+    ds = ds.isel(indexers)
+
+    # Keep longitudes increasing across the seam
+    for dim in seams:
+        values = ds[dim].values.copy()
+        drop = np.nonzero(np.diff(values) < 0)[0]
+        if drop.size:
+            values[drop[0] + 1:] += 360
+        ds = ds.assign_coords({dim: (dim, values, ds[dim].attrs)})
+    return ds
@@ -7,12 +7,23 @@
   
 #This file is part of CROCOTOOLS
 
+import argparse
+import glob
+import re
 import xarray as xr
 import os
-import re
-import subprocess
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import calendar
+import threading
+
+import task_events
+import task_shards
+from download_scheduler import ConcurrencyController
+from forcing_cache import ForcingCache, DEFAULT_QUOTA_GB
+from cmems_download import CmemsDownload
+from cmems_session import CopernicusSession
+from request_planner import time_steps, steps_per_day
+from zarr_store import MonthlyZarrStore
 
 #user nedd to change ========================================================
 # Configuration user modification ON
@@ -24,6 +35,43 @@ lat_min, lat_max = 20, 23
 depth_min, depth_max = 0.493, 5727.918
 variables = ["zos", "uo", "vo", "thetao", "so"]
 
+# Variables fetched together in one request; [[v] for v in variables] for one request per variable
+VARIABLE_GROUPS = [variables]
+USE_API = True         # in-process copernicusmarine session, the command line is the fallback
+
+# Request sizing from the estimated volume (grid step, bbox, depth levels, time step)
+REQUEST_TARGET_MB = 200        # consecutive months are merged up to this size
+REQUEST_MAX_MB = 2000          # larger requests are split into time ranges or depth slabs
+MAX_MONTHS_PER_REQUEST = 12
+
+# Spatial tiling of large domains: tiles of TILE_DEG degrees fetched concurrently
+# and mosaicked back (None for a single bbox)
+TILE_DEG = None
+MAX_IN_FLIGHT = 8              # copernicusmarine requests running at the same time
+ADAPTIVE_CONCURRENCY = True    # adapt the requests in flight to their throughput and errors, from MAX_IN_FLIGHT
+MAX_IN_FLIGHT_LIMIT = 16       # most requests in flight with ADAPTIVE_CONCURRENCY
+MAX_RETRIES = 3                # retries of a failed piece (tile, time range or depth slab)
+RETRY_DELAY = 10               # base delay (s) of the exponential backoff
+
+# Encoding of the NetCDF files (see netcdf_encoding.py): zlib level, 'float32' or
+# 'int16' (scale/offset) packing, per-variable overrides e.g. {'zos': {'packing': 'int16'}}
+NC_ENCODING = {'complevel': 1, 'packing': 'float32', 'variables': {}}
+
+# Zarr store receiving all the months in place of the monthly NetCDF files, None for
+# NetCDF files (e.g. os.path.join(data_dir, 'mercator.zarr')); its first month is the start date
+ZARR_STORE = None
+
+# Integrity check of the monthly files after the downloads (forcing_check.py): the months
+# whose file is missing or bad are downloaded once more (NetCDF files only)
+VERIFY_OUTPUTS = True
+MAX_NAN_FRACTION = 0.99        # files whose data sample has more missing values are bad
+
+# Sync mode (--sync, e.g. a daily cron job of the forecast/interim datasets): only the time
+# steps newer than the last local one are downloaded, up to the last one of the dataset (or
+# today); they are appended to the file of the current month, earlier months are untouched.
+# Without local files the sync starts at the start date. NetCDF files only.
+SYNC = False
+
 # Date range for the download
 YEAR_START = 2023
 MONTH_START = 10
@@ -32,108 +80,158 @@ YEAR_END = 2023
 MONTH_END = 12
 DAY_END = 30
 
-# Configuration  user modification OFF 
+# Pipeline: months downloading, merging and being cleaned up at the same time
+DOWNLOAD_WORKERS = 2   # months downloading at once
+MERGE_WORKERS = 1      # months merging at once
+CLEANUP_WORKERS = 1    # months being cleaned up at once
+QUEUE_SIZE = 2         # months waiting between two stages
 
-# Function to download data for a specific variable
-def download_variable(variable, start_str, end_str):
-    command = [
-        "copernicusmarine", "subset",
-        "--dataset-id", dataset_id,
-        "--variable", variable,
-        "--minimum-longitude", str(lon_min),
-        "--maximum-longitude", str(lon_max),
-        "--minimum-latitude", str(lat_min),
-        "--maximum-latitude", str(lat_max),
-        "--start-datetime", start_str,
-        "--end-datetime", end_str,
-        "--minimum-depth", str(depth_min),
-        "--maximum-depth", str(depth_max)
-    ]
-    
-    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    stdout, stderr = process.communicate(input='y\n')
-
-    if process.returncode != 0:
-        print(f"Failed to download data for {variable} from {start_str} to {end_str}: {stderr}")
-    else:
-        print(f"Successfully downloaded data for {variable} from {start_str} to {end_str}")
-
-# Function to process and concatenate NetCDF files
-def concatenate_files():
-    pattern = re.compile(r'cmems_mod_glo_phy_my_0.083deg_P1M-m_(\w+)_86\.00E-92\.00E_20\.00N-23\.00N_\d+\.\d+-\d+\.\d+m_(\d{4})-(\d{2})-(\d{2})\.nc')
-
-    files = os.listdir(data_dir)
-    matching_files = [f for f in files if pattern.match(f)]
-    files_by_date = {}
-
-    for file in matching_files:
-        match = pattern.match(file)
-        variable, year, month, day = match.groups()
-        date_key = f"{year}-{month}-{day}"
-        
-        if date_key not in files_by_date:
-            files_by_date[date_key] = []
-        
-        files_by_date[date_key].append(os.path.join(data_dir, file))
-
-    for date_key, file_list in files_by_date.items():
-        if not file_list:
-            print(f"No files found for date {date_key}")
-            continue
-
-        datasets = []
-        try:
-            datasets = [xr.open_dataset(f) for f in file_list]
-            combined = xr.concat(datasets, dim='time')
-            
-            year, month, _ = date_key.split('-')
-            output_filename = f'raw_motu_mercator_Y{year}M{month}.nc'
-            combined.to_netcdf(os.path.join(data_dir, output_filename))
-            print(f"Successfully created {output_filename}")
-
-        except Exception as e:
-            print(f"Failed to concatenate files for date {date_key}: {e}")
-
-        finally:
-            # Ensure datasets are closed even if an error occurs
-            for ds in datasets:
-                ds.close()
-
-# Function to remove temporary files
-def remove_temp_files():
-    pattern = re.compile(r'cmems_mod_glo_phy_my.*\.nc')
-    files = os.listdir(data_dir)
-    
-    for file in files:
-        if pattern.match(file):
-            file_path = os.path.join(data_dir, file)
-            os.remove(file_path)
-            print(f"Removed {file_path}")
+# Shared cache of forcing downloads (None to disable)
+CACHE_DIR = None       # e.g. '/scratch/croco_forcing', the cache_dir of the ERA5 script
+CACHE_QUOTA_GB = DEFAULT_QUOTA_GB
 
-# Main script execution
-if __name__ == "__main__":
-    start_date = datetime(YEAR_START, MONTH_START, DAY_START)
-    end_date = datetime(YEAR_END, MONTH_END, DAY_END)
+# Configuration  user modification OFF 
 
-    current_date = start_date
+cache = ForcingCache(CACHE_DIR, CACHE_QUOTA_GB) if CACHE_DIR else None
+session = CopernicusSession(dataset_id, (lon_min, lon_max, lat_min, lat_max), (depth_min, depth_max), USE_API,
+                             NC_ENCODING)
+if ADAPTIVE_CONCURRENCY:
+    slots = ConcurrencyController(MAX_IN_FLIGHT, max_limit=MAX_IN_FLIGHT_LIMIT, sources=('cmems',))
+    piece_threads = MAX_IN_FLIGHT_LIMIT
+else:
+    slots = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+    piece_threads = MAX_IN_FLIGHT
+
+# Function to count the time steps of a whole month of the dataset
+def month_steps(year, month):
+    return time_steps(dataset_id, date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1]))
+
+zarr_store = MonthlyZarrStore(ZARR_STORE, (YEAR_START, MONTH_START), month_steps, NC_ENCODING['packing']) \
+    if ZARR_STORE else None
+
+pipeline = CmemsDownload(session, data_dir, VARIABLE_GROUPS, slots, cache=cache, zarr_store=zarr_store,
+                         encoding=NC_ENCODING, tile_deg=TILE_DEG, request_target_mb=REQUEST_TARGET_MB,
+                         request_max_mb=REQUEST_MAX_MB, max_months=MAX_MONTHS_PER_REQUEST, max_retries=MAX_RETRIES,
+                         retry_delay=RETRY_DELAY, piece_threads=piece_threads,
+                         stage_workers=(DOWNLOAD_WORKERS, MERGE_WORKERS, CLEANUP_WORKERS), queue_size=QUEUE_SIZE,
+                         max_nan=MAX_NAN_FRACTION)
+
+# Worker of a sharded run (SLURM job array or several processes, see task_shards.py),
+# None for a single worker: its requests are claimed in data_dir/.claims, per domain
+# and variables, and only the months it wrote are checked
+shard = task_shards.default_shard(f'cmems_{dataset_id}', data_dir,
+                                  config=[dataset_id, pipeline.bbox, pipeline.depths, pipeline.variables, NC_ENCODING],
+                                  outputs=pipeline.request_outputs)
+
+# Function to list the (year, month, first day, last day) of the date range
+def month_list():
+    months = []
+    current_date = datetime(YEAR_START, MONTH_START, DAY_START)
+    end_date = datetime(YEAR_END, MONTH_END, DAY_END)
     while current_date <= end_date:
         year = current_date.year
         month = current_date.month
-        day = current_date.day
         _, last_day = calendar.monthrange(year, month)
+        months.append((year, month, current_date.day, last_day))
 
-        start_str = current_date.strftime('%Y-%m-%dT00:00:00')
-        end_str = datetime(year, month, last_day).strftime('%Y-%m-%dT00:00:00')
-
-        for variable in variables:
-            try:
-                download_variable(variable, start_str, end_str)
-            except Exception as e:
-                print(f"Failed to download data for {variable} from {start_str} to {end_str}: {e}")
+        current_date = datetime(year, month, last_day) + timedelta(days=1)
+    return months
 
-        concatenate_files()
-        remove_temp_files()  # Remove temporary files after concatenation
+# Function to list the (year, month, first day, last day) between two dates
+def months_between(start_date, end_date):
+    months = []
+    current_date = start_date
+    while current_date <= end_date:
+        year = current_date.year
+        month = current_date.month
+        _, last_day = calendar.monthrange(year, month)
+        day_end = end_date.day if (year, month) == (end_date.year, end_date.month) else last_day
+        months.append((year, month, current_date.day, day_end))
 
         current_date = datetime(year, month, last_day) + timedelta(days=1)
+    return months
+
+# Function to convert a numpy datetime64 to a datetime
+def to_datetime(value):
+    return datetime.fromisoformat(str(value.astype('datetime64[s]')))
+
+# Function to find the last time step of the local monthly files, None without local file
+def last_local_time():
+    monthly = {}
+    for path in glob.glob(os.path.join(data_dir, 'raw_motu_mercator_Y*M*.nc')):
+        match = re.fullmatch(r'raw_motu_mercator_Y(\d{4})M(\d{2})\.nc', os.path.basename(path))
+        if match:
+            monthly[int(match[1]), int(match[2])] = path
+    if not monthly:
+        return None
+    with xr.open_dataset(monthly[max(monthly)]) as ds:
+        return to_datetime(ds['time'].values[-1])
+
+# Function to list the (year, month, first day, last day) of the time steps newer than
+# the local files, up to the last time step of the dataset (today if unknown)
+def sync_months():
+    per_day = steps_per_day(dataset_id)
+    end_date = datetime.combine(date.today(), datetime.min.time())
+    latest = session.last_time(VARIABLE_GROUPS[0])
+    if latest is not None:
+        end_date = min(end_date, to_datetime(latest))
+    elif per_day is None:
+        # A monthly mean is only there once its month is over
+        end_date = datetime(end_date.year, end_date.month, 1) - timedelta(days=1)
+
+    last = last_local_time()
+    if last is None:
+        start_date = datetime(YEAR_START, MONTH_START, DAY_START)
+        print(f"No local files, syncing from {start_date:%Y-%m-%d}")
+    elif per_day is None:
+        start_date = datetime(last.year, last.month, calendar.monthrange(last.year, last.month)[1]) + timedelta(days=1)
+    else:
+        # Days with a part of their steps already local are downloaded again; the merge keeps the newer steps
+        next_step = last + timedelta(days=1 / per_day)
+        start_date = datetime(next_step.year, next_step.month, next_step.day)
+    if last is not None:
+        print(f"Last local time step {last:%Y-%m-%d %H:%M}, syncing up to {end_date:%Y-%m-%d}")
+    return months_between(start_date, end_date)
+
+# Main script execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the CMEMS forcing of CROCO month by month.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the planned requests and their estimated size, download nothing")
+    parser.add_argument("--sync", action="store_true", help="Download only the time steps newer than the local files")
+    args = parser.parse_args()
+    SYNC = SYNC or args.sync
+    if SYNC and zarr_store is not None:
+        raise SystemExit("The sync mode appends to the monthly NetCDF files, set ZARR_STORE = None")
+    pipeline.sync = SYNC
+
+    months = sync_months() if SYNC else month_list()
+    if not months:
+        print("The local files are up to date")
+        raise SystemExit(0)
+    requests = pipeline.plan_requests(months)
+    if args.dry_run:
+        pipeline.print_request_plan(requests)
+        raise SystemExit(0)
+
+    # Request N+1 downloads while request N merges and request N-1 is cleaned up
+    pipeline.run_requests(requests, "cmems", shard)
+
+    # Months whose file is missing or bad are downloaded once more, each on its own
+    if VERIFY_OUTPUTS and zarr_store is None:
+        retry = pipeline.bad_months(months if shard is None else [item for done in shard.done for item in done])
+        if retry and SYNC:
+            # The whole month is downloaded again, its file having been moved aside
+            retry = [(year, month, 1, day_end) for year, month, _, day_end in retry]
+        if retry:
+            requests = [request for item in retry for request in pipeline.plan_requests([item])]
+            pipeline.discard_cached(requests)
+            pipeline.run_requests(requests, "cmems-requeue")
+            retry = pipeline.bad_months(retry)
+        if retry:
+            task_events.finish()
+            raise SystemExit(f"{len(retry)} months are still missing or bad after a second download")
+    task_events.finish()
+    if ADAPTIVE_CONCURRENCY:
+        slots.print_history()
 
     print("=========== Download and concatenation completed! ===========")
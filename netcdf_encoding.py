@@ -0,0 +1,148 @@
+#===========================================================================
+# NetCDF4 output encoding shared by the SODA, CMEMS and ERA5 scripts
+#
+#  The forcing files are written compressed (zlib + shuffle), as float32 or
+#  packed to int16 with a scale factor and offset, and chunked by one time
+#  step (and one level) times the full horizontal slab, which is how the
+#  crocotools interpolation reads them. Per-variable settings override the
+#  defaults, e.g.
+#     variables={'zos': {'packing': 'int16'}, 'thetao': {'complevel': 6}}
+#
+#  packing:  'float32'  float64 data are stored as float32
+#            'int16'    scale/offset packing over the min/max of the data
+#                       (one extra pass over lazy data)
+#            'none'     the dtype of the data is kept
+#
+#  libnetcdf is not thread-safe and xarray only locks the reads and writes
+#  of the data, not the creation of the files and their variables: the
+#  writes of the threads of a process go one at a time (NETCDF_LOCK).
+#  Scripts writing many files at once use processes (process_soda) or
+#  stream the data by blocks of time steps (write_netcdf_steps, used by
+#  cmems_session): each block is fetched outside the lock and only the
+#  creation of the file and the write of the block hold it.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import threading
+
+import numpy as np
+import xarray as xr
+
+COMPLEVEL = 1          # zlib level, 0 for no compression (higher levels gain little on float data)
+SHUFFLE = True         # byte shuffle filter before zlib
+PACKING = 'float32'    # 'float32', 'int16' or 'none'
+INT16_FILL = -32768    # _FillValue of the int16 packed variables
+STEPS_BLOCK_MB = 32    # data fetched at once by write_netcdf_steps (per writing thread)
+
+NETCDF_LOCK = threading.RLock()
+
+
+# Function to get the chunk shape of a variable of the given shape: one step along
+# every dimension but the last two, which are kept whole (the horizontal slab)
+def chunk_shape(shape):
+    if len(shape) < 2:
+        return None
+    return tuple(1 for _ in shape[:-2]) + tuple(max(1, n) for n in shape[-2:])
+
+
+# Function to get the scale factor and offset packing data between vmin and vmax to int16
+def int16_scale(vmin, vmax):
+    if not np.isfinite(vmin) or not np.isfinite(vmax) or vmax <= vmin:
+        return 1.0, float(vmin) if np.isfinite(vmin) else 0.0
+    # -32768 is kept for the missing values
+    scale = (float(vmax) - float(vmin)) / (2 ** 16 - 2)
+    return scale, (float(vmax) + float(vmin)) / 2
+
+
+# Function to build the encoding of the data variables of a dataset
+def encoding_for(ds, complevel=None, shuffle=None, packing=None, variables=None):
+    defaults = {
+        'complevel': COMPLEVEL if complevel is None else complevel,
+        'shuffle': SHUFFLE if shuffle is None else shuffle,
+        'packing': PACKING if packing is None else packing,
+    }
+    variables = variables or {}
+
+    encoding = {}
+    ranges = {}
+    for name, variable in ds.data_vars.items():
+        settings = dict(defaults, **variables.get(name, {}))
+        enc = {}
+        if settings['complevel']:
+            enc.update(zlib=True, complevel=settings['complevel'], shuffle=settings['shuffle'])
+        chunks = chunk_shape(variable.shape)
+        if chunks:
+            enc['chunksizes'] = chunks
+        if np.issubdtype(variable.dtype, np.floating):
+            if settings['packing'] == 'int16':
+                enc.update(dtype='int16', _FillValue=INT16_FILL)
+                ranges[name] = (variable.min(), variable.max())
+            elif settings['packing'] == 'float32':
+                enc['dtype'] = 'float32'
+        encoding[name] = enc
+
+    # The min/max of all the packed variables are computed in one pass
+    if ranges:
+        import dask
+        values = dask.compute(*[(vmin.data, vmax.data) for vmin, vmax in ranges.values()])
+        for name, (vmin, vmax) in zip(ranges, values):
+            scale, offset = int16_scale(float(vmin), float(vmax))
+            encoding[name].update(scale_factor=scale, add_offset=offset)
+    return encoding
+
+
+# Function to write a dataset with the forcing encoding; the encoding given
+# here replaces the one inherited from the files the data were read from
+def write_netcdf(ds, path, complevel=None, shuffle=None, packing=None, variables=None):
+    with NETCDF_LOCK:
+        encoding = encoding_for(ds, complevel, shuffle, packing, variables)
+        ds.to_netcdf(path, format='NETCDF4', engine='netcdf4', encoding=encoding)
+    return path
+
+
+# Function to write a lazy dataset with the forcing encoding by blocks of time steps
+# of about STEPS_BLOCK_MB: each block is fetched outside NETCDF_LOCK, the first one
+# creates the file (unlimited time dimension) and the next ones are appended to it,
+# encoded as xarray encodes the first one
+def write_netcdf_steps(ds, path, complevel=None, shuffle=None, packing=None, variables=None,
+                       block_mb=STEPS_BLOCK_MB):
+    steps = ds.sizes.get('time', 0)
+    if steps == 0:
+        return write_netcdf(ds.load(), path, complevel, shuffle, packing, variables)
+    block = max(1, int(block_mb * 1e6 * steps // max(ds.nbytes, 1)))
+    encoding = encoding_for(ds, complevel, shuffle, packing, variables)
+
+    part = ds.isel(time=slice(0, block)).load()
+    with NETCDF_LOCK:
+        part.to_netcdf(path, format='NETCDF4', engine='netcdf4', encoding=encoding, unlimited_dims=['time'])
+    for start in range(block, steps, block):
+        part = ds.isel(time=slice(start, start + block)).load()
+        with NETCDF_LOCK:
+            append_steps(part, path, encoding, start)
+    return path
+
+
+# Function to append the time steps of a loaded dataset to a file written by
+# write_netcdf_steps, from the time index start
+def append_steps(part, path, encoding, start):
+    import netCDF4
+    with netCDF4.Dataset(path, 'a') as nc:
+        nc.set_auto_maskandscale(False)
+        timed = {}
+        for name, variable in part.variables.items():
+            if 'time' not in variable.dims:
+                continue
+            variable = variable.copy(deep=False)
+            if name in encoding:
+                variable.encoding = dict(encoding[name])
+            if np.issubdtype(variable.dtype, np.datetime64):
+                # The units of the file, xarray would pick them from the dates of this block
+                stored = nc[name]
+                variable.encoding = {'units': stored.units, 'calendar': getattr(stored, 'calendar', 'standard'),
+                                     'dtype': stored.dtype}
+            timed[name] = variable
+        encoded, _ = xr.conventions.cf_encoder(timed, {})
+        for name, variable in encoded.items():
+            index = tuple(slice(start, start + variable.shape[i]) if dim == 'time' else slice(None)
+                          for i, dim in enumerate(variable.dims))
+            nc[name][index] = variable.values
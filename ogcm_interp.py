@@ -0,0 +1,266 @@
+#===========================================================================
+# Horizontal interpolation of the monthly OGCM files (raw_soda_Y*M*.nc,
+# raw_motu_mercator_Y*M*.nc) onto the CROCO grid
+#
+#  The geometry is done once: the bilinear weights from a source grid to
+#  the rho, u or v points of the CROCO grid (a sparse matrix of 4 weights
+#  per target point) are computed on the first use and stored on disk,
+#  keyed by the coordinates of both grids. Every month is then one sparse
+#  matrix product over all its time steps and depth levels at once.
+#  Source points on land (NaN) are left out and the weights of the others
+#  renormalised; target points with no ocean neighbour are NaN.
+#
+#  python ogcm_interp.py croco_grd.nc /scratch/soda/raw_soda_Y*M*.nc --output-dir /scratch/croco_in
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+import forcing_catalogue
+import task_events
+from forcing_subset import coord_kind
+from netcdf_encoding import write_netcdf
+
+DEFAULT_WEIGHTS_DIR = os.environ.get('FORCING_WEIGHTS_DIR',
+                                     os.path.expanduser('~/.cache/croco_forcing/weights'))
+DEFAULT_WORKERS = 1   # files interpolated in parallel (processes)
+DEFAULT_POINTS = {}   # CROCO points of the variables (rho if not given), e.g. {'uo': 'u', 'vo': 'v'}
+TOLERANCE = 1e-6      # target points this close outside the source grid are kept
+
+_weights = {}
+_weights_lock = threading.Lock()
+
+
+# Function to find the two neighbours along a source axis and the weight of the second
+# one for every target coordinate; longitudes are wrapped, global grids periodic
+def axis_weights(axis, x, is_lon=False):
+    axis = np.asarray(axis, dtype='f8')
+    n = axis.size
+    ascending = axis[-1] >= axis[0]
+    a = axis if ascending else axis[::-1]
+    if is_lon:
+        x = a[0] + np.mod(x - a[0] + TOLERANCE, 360) - TOLERANCE
+    periodic = is_lon and n > 1 and a[-1] - a[0] + np.median(np.diff(a)) >= 360 - TOLERANCE
+    i0 = np.clip(np.searchsorted(a, x, side='right') - 1, 0, n - 1 if periodic else n - 2)
+    if periodic:
+        i1 = (i0 + 1) % n
+        width = np.where(i1 == 0, a[0] + 360 - a[-1], a[i1] - a[i0])
+        inside = np.ones(x.shape, dtype=bool)
+    else:
+        i1 = i0 + 1
+        width = a[i1] - a[i0]
+        inside = (x >= a[0] - TOLERANCE) & (x <= a[-1] + TOLERANCE)
+    t = np.clip((x - a[i0]) / width, 0, 1)
+    if not ascending:
+        i0, i1 = n - 1 - i0, n - 1 - i1
+    return i0, i1, t, inside
+
+
+# Function to compute the bilinear weights from a rectilinear grid to target points: a sparse
+# (target points x source points) matrix of 4 weights per row, empty rows outside the grid
+def bilinear_weights(src_lon, src_lat, dst_lon, dst_lat):
+    x0, x1, tx, xin = axis_weights(src_lon, np.ravel(dst_lon), is_lon=True)
+    y0, y1, ty, yin = axis_weights(src_lat, np.ravel(dst_lat))
+    nx = len(src_lon)
+    index = np.stack([y0 * nx + x0, y0 * nx + x1, y1 * nx + x0, y1 * nx + x1], axis=-1)
+    weights = np.stack([(1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx], axis=-1)
+    weights[~(xin & yin)] = 0
+    rows = np.repeat(np.arange(index.shape[0]), 4)
+    return sparse.csr_matrix((weights.ravel(), (rows, index.ravel())), shape=(index.shape[0], nx * len(src_lat)))
+
+
+# Function to get the key of a pair of grids, from their coordinates
+def weights_key(src_lon, src_lat, dst_lon, dst_lat):
+    sha = hashlib.sha256(b'bilinear')
+    for values in (src_lon, src_lat, dst_lon, dst_lat):
+        values = np.ascontiguousarray(values, dtype='f8')
+        sha.update(str(values.shape).encode())
+        sha.update(values.tobytes())
+    return sha.hexdigest()
+
+
+# Function to get the weights between two grids: from memory, from disk, or computed
+# and stored (written aside and moved in place, so concurrent runs never read half a file)
+def grid_weights(src_lon, src_lat, dst_lon, dst_lat, weights_dir=DEFAULT_WEIGHTS_DIR):
+    key = weights_key(src_lon, src_lat, dst_lon, dst_lat)
+    with _weights_lock:
+        if key in _weights:
+            return _weights[key]
+    path = os.path.join(weights_dir, f'bilinear_{key[:24]}.npz')
+    if os.path.exists(path):
+        weights = sparse.load_npz(path)
+    else:
+        start = time.monotonic()
+        weights = bilinear_weights(src_lon, src_lat, dst_lon, dst_lat)
+        os.makedirs(weights_dir, exist_ok=True)
+        tmp = f'{path}.part{os.getpid()}.npz'
+        sparse.save_npz(tmp, weights)
+        os.replace(tmp, path)
+        print(f"Computed {os.path.basename(path)} ({weights.shape[0]} points) in {time.monotonic() - start:.2f} s")
+    with _weights_lock:
+        _weights[key] = weights
+    return weights
+
+
+# Function to interpolate an array (..., ny, nx) to the target points (..., N): one sparse
+# product for all the leading dimensions (time steps, depth levels); a second one with
+# the valid (not NaN) points gives the sum of the weights used by every target point
+def apply_weights(values, weights):
+    flat = values.reshape(-1, values.shape[-2] * values.shape[-1])
+    valid = np.isfinite(flat)
+    total = weights @ valid.T.astype(flat.dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = (weights @ np.where(valid, flat, 0).T) / total
+    result = np.where(total > 0, result, np.nan).T
+    return result.reshape(values.shape[:-2] + (weights.shape[0],)).astype(values.dtype)
+
+
+# Function to read the coordinates of the rho, u and v points of a CROCO grid file
+def read_croco_grid(grid_file):
+    points = {}
+    with xr.open_dataset(grid_file) as grd:
+        for p in ('rho', 'u', 'v'):
+            if f'lon_{p}' in grd and f'lat_{p}' in grd:
+                points[p] = (grd[f'lon_{p}'].values, grd[f'lat_{p}'].values, grd[f'lon_{p}'].dims)
+    if 'rho' not in points:
+        raise ValueError(f'{grid_file} has no lon_rho/lat_rho')
+    return points
+
+
+# Function to find the longitude and latitude (1-D) coordinates of a variable
+def source_axes(ds, variable):
+    lon = lat = None
+    for dim in ds[variable].dims[-2:]:
+        kind = coord_kind(ds[dim]) if dim in ds.coords else None
+        if kind == 'lon':
+            lon = dim
+        elif kind == 'lat':
+            lat = dim
+    if lon is None or lat is None or ds[variable].dims[-2:] != (lat, lon):
+        raise ValueError(f'{variable} is not on a rectilinear (..., lat, lon) grid')
+    return lat, lon
+
+
+# Function to get the CROCO points and the weights of a variable of a dataset
+def variable_weights(ds, name, grid, points=None, weights_dir=DEFAULT_WEIGHTS_DIR):
+    lat, lon = source_axes(ds, name)
+    p = dict(DEFAULT_POINTS, **(points or {})).get(name, 'rho')
+    dst_lon, dst_lat, _ = grid[p]
+    return p, grid_weights(ds[lon].values, ds[lat].values, dst_lon, dst_lat, weights_dir)
+
+
+# Function to interpolate all the variables of a dataset onto the CROCO grid
+def interpolate_dataset(ds, grid, points=None, weights_dir=DEFAULT_WEIGHTS_DIR):
+    data, coords = {}, {}
+    for name, variable in ds.data_vars.items():
+        if variable.ndim < 2:
+            continue
+        p, weights = variable_weights(ds, name, grid, points, weights_dir)
+        dst_lon, dst_lat, dims = grid[p]
+        values = apply_weights(variable.values, weights)
+        data[name] = (variable.dims[:-2] + dims, values.reshape(values.shape[:-1] + dst_lon.shape), variable.attrs)
+        coords[f'lon_{p}'] = (dims, dst_lon)
+        coords[f'lat_{p}'] = (dims, dst_lat)
+    # Time and depth are kept, the source horizontal coordinates are dropped
+    horizontal = {d for d in ds.dims if d in ds.coords and coord_kind(ds[d]) in ('lon', 'lat')}
+    keep = {c: ds[c] for c in ds.coords if not horizontal.intersection(ds[c].dims)}
+    return xr.Dataset(data, coords=dict(keep, **coords), attrs=ds.attrs)
+
+
+# Function to get the name of the interpolated file of a monthly file
+def output_name(input_file):
+    name = os.path.basename(input_file)
+    return 'croco_' + (name[len('raw_'):] if name.startswith('raw_') else name)
+
+
+# Function to interpolate one monthly file and write it in output_dir
+def interpolate_file(input_file, grid_file, output_dir, points=None, weights_dir=DEFAULT_WEIGHTS_DIR, encoding=None):
+    grid = read_croco_grid(grid_file)
+    output_file = os.path.join(output_dir, output_name(input_file))
+    tmp_file = output_file + '.part'
+    with task_events.task('interp', os.path.basename(input_file)) as handle:
+        with xr.open_dataset(input_file) as ds:
+            result = interpolate_dataset(ds, grid, points, weights_dir)
+        try:
+            write_netcdf(result, tmp_file, **(encoding or {}))
+            os.replace(tmp_file, output_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        handle.add_bytes(os.path.getsize(output_file))
+    forcing_catalogue.record(output_file, 'croco', os.path.basename(grid_file))
+    print(f"Saved {output_file}")
+    return output_file
+
+
+# Function to interpolate many monthly files; the weights are computed (or loaded) once
+# from the first file, before the files are shared out between the processes
+def interpolate_files(input_files, grid_file, output_dir, points=None, weights_dir=DEFAULT_WEIGHTS_DIR,
+                      workers=DEFAULT_WORKERS, encoding=None):
+    os.makedirs(output_dir, exist_ok=True)
+    if not input_files:
+        return []
+    grid = read_croco_grid(grid_file)
+    with xr.open_dataset(input_files[0]) as ds:
+        for name, variable in ds.data_vars.items():
+            if variable.ndim >= 2:
+                variable_weights(ds, name, grid, points, weights_dir)
+
+    failures = []
+    for input_file in input_files:
+        task_events.enqueue('interp', os.path.basename(input_file))
+    if workers <= 1:
+        for input_file in input_files:
+            try:
+                interpolate_file(input_file, grid_file, output_dir, points, weights_dir, encoding)
+            except Exception as e:
+                print(f"Failed to interpolate {input_file}: {e}")
+                failures.append((input_file, e))
+        return failures
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(interpolate_file, input_file, grid_file, output_dir, points, weights_dir,
+                                   encoding): input_file
+                   for input_file in input_files}
+        for future, input_file in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to interpolate {input_file}: {e}")
+                failures.append((input_file, e))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Interpolate monthly OGCM files onto the CROCO grid.")
+    parser.add_argument("grid", type=str, help="CROCO grid file (lon_rho, lat_rho, lon_u, ...)")
+    parser.add_argument("inputs", type=str, nargs='+', help="Monthly files (raw_soda_Y*M*.nc, raw_motu_mercator_Y*M*.nc)")
+    parser.add_argument("--output-dir", type=str, required=True, help="Output directory of the interpolated files")
+    parser.add_argument("--points", type=str, nargs='+', default=[], metavar="VAR=POINTS",
+                        help="CROCO points (rho, u, v) of some variables, e.g. uo=u vo=v (default: rho)")
+    parser.add_argument("--weights-dir", type=str, default=DEFAULT_WEIGHTS_DIR, help="Directory of the stored weights")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Files interpolated in parallel")
+    parser.add_argument("--complevel", type=int, default=1, help="zlib level of the output files (0: no compression)")
+    args = parser.parse_args()
+
+    points = dict(item.split('=', 1) for item in args.points)
+    start = time.monotonic()
+    failures = interpolate_files(sorted(args.inputs), args.grid, args.output_dir, points, args.weights_dir,
+                                 args.workers, {'complevel': args.complevel})
+    print(f"Interpolated {len(args.inputs) - len(failures)} files in {time.monotonic() - start:.1f} s")
+    task_events.finish(from_file=args.workers > 1)
+    if failures:
+        raise SystemExit(f"{len(failures)} of {len(args.inputs)} files failed")
+
+
+if __name__ == "__main__":
+    main()
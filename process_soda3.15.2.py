@@ -1,6 +1,22 @@
 import os
+import re
+import calendar
+import contextlib
+import functools
+import multiprocessing
+import numpy as np
+import pandas as pd
 import xarray as xr
 import argparse
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import forcing_catalogue
+import task_events
+import task_shards
+from forcing_subset import read_crocotools_bounds, subset_dataset
+from netcdf_encoding import write_netcdf
+from zarr_store import MonthlyZarrStore
 
 # Default directories and date ranges
 DEFAULT_INPUT_DIR = "/scratch/20cl91p02/CROCO_TOOL_FIX/Oforc_SODA"
@@ -9,8 +25,17 @@ DEFAULT_YEAR_START = 2023
 DEFAULT_MONTH_START = 1
 DEFAULT_YEAR_END = 2023
 DEFAULT_MONTH_END = 3
+DEFAULT_WORKERS = 1   # years processed in parallel (processes)
+DEFAULT_WRITERS = 4   # months written in parallel for each year (processes)
+DEFAULT_MARGIN = 2    # degrees added around the crocotools_param domain, as for ERA5
+DEFAULT_COMPLEVEL = 1           # zlib level of the monthly files, 0 for no compression
+DEFAULT_PACKING = 'float32'     # 'float32', 'int16' (scale/offset) or 'none'
+DEFAULT_VARIABLE_ENCODING = {}  # per-variable overrides, e.g. {'zos': {'packing': 'int16'}}
+DEFAULT_DATA_TYPE = "monthly"   # "monthly" (yearly files of monthly means) or "5daily" (one file per pentad)
+DEFAULT_PENTADS = "mean"        # 5daily: "mean" (time-weighted monthly means) or "snapshots" (the pentads of each month)
+PENTAD_DAYS = 5                 # days averaged in a 5daily file, centred on the day in its name
 
-def extract_variables(input_file):
+def extract_variables(input_file, bounds=None):
     ds = xr.open_dataset(input_file)
 
     # Rename variables
@@ -19,46 +44,327 @@ def extract_variables(input_file):
 
     # Extracting desired variables
     ds_subset = ds[['uo', 'vo', 'zos', 'thetao', 'so']]
-    ds.close()
-    return ds_subset
-
-def create_monthly_files(input_dir, output_dir, start_year, end_year, start_month, end_month):
-    for year in range(start_year, end_year + 1):
-        input_file = f"{input_dir}/soda3.15.2_mn_ocean_reg_{year}.nc"
-        
-        if os.path.exists(input_file):
-            for month in range(start_month, end_month + 1):
-                # Construct the output filename in the desired "raw_soda_Y1993M3.nc" format
-                output_file = f"{output_dir}/raw_soda_Y{year}M{month}.nc"
-
-                ds_subset = extract_variables(input_file)
-
-                try:
-                    # Select the monthly data
-                    ds_monthly = ds_subset.sel(time=f"{year}-{month:02d}")
-                    ds_monthly.to_netcdf(output_file)
-                    print(f"Saved {output_file}")
-                except KeyError:
-                    print(f"Skipping {output_file} - Date {year}-{month:02d} not found in dataset")
-                except IndexError as e:
-                    print(f"Skipping {output_file} - Index error: {str(e)}")
-                except Exception as e:
-                    print(f"Skipping {output_file} - Unexpected error: {str(e)}")
+
+    # Restrict to the domain before anything is read, then chunk one time step at a time
+    if bounds:
+        ds_subset = subset_dataset(ds_subset, **bounds)
+    return ds_subset.chunk({'time': 1})
+
+def write_month(ds_subset, output_dir, year, month, encoding=None, store=None):
+    # Construct the output filename in the desired "raw_soda_Y1993M3.nc" format
+    output_file = f"{output_dir}/raw_soda_Y{year}M{month}.nc"
+
+    with task_events.task('soda-write', f"{year}-{month:02d}") as handle:
+        try:
+            # Select the monthly data
+            ds_monthly = ds_subset.sel(time=f"{year}-{month:02d}")
+            if store is not None:
+                # Month written into its region of the Zarr store instead of a NetCDF file
+                store.write_month(ds_monthly, year, month)
+                handle.add_bytes(ds_monthly.nbytes)
+                print(f"Saved {year}-{month:02d} to {store.path}")
+                return
+            write_netcdf(ds_monthly, output_file, **(encoding or {}))
+            handle.add_bytes(os.path.getsize(output_file))
+            forcing_catalogue.record(output_file, 'soda', 'raw_soda')
+            print(f"Saved {output_file}")
+        except KeyError as e:
+            handle.fail(e)
+            print(f"Skipping {output_file} - Date {year}-{month:02d} not found in dataset")
+        except IndexError as e:
+            handle.fail(e)
+            print(f"Skipping {output_file} - Index error: {str(e)}")
+        except Exception as e:
+            handle.fail(e)
+            print(f"Skipping {output_file} - Unexpected error: {str(e)}")
+
+# Function to get the pool writing the months of a year: processes, as libnetcdf cannot
+# write several files at once from the threads of one process; None to write them in turn
+def month_pool(writers):
+    if writers <= 1:
+        return None
+    # spawn: the reads may have left dask threads running in this process
+    return ProcessPoolExecutor(max_workers=writers, mp_context=multiprocessing.get_context('spawn'))
+
+# Yearly files opened by this writer process, once for all the months it writes
+_opened = {}
+
+def write_year_month(input_file, output_dir, year, month, bounds=None, encoding=None, store=None):
+    key = (input_file, repr(bounds))
+    if key not in _opened:
+        _opened[key] = extract_variables(input_file, bounds)
+    write_month(_opened[key], output_dir, year, month, encoding, store)
+
+def process_year(input_dir, output_dir, year, start_month, end_month, writers=DEFAULT_WRITERS, bounds=None,
+                 encoding=None, store=None):
+    input_file = f"{input_dir}/soda3.15.2_mn_ocean_reg_{year}.nc"
+
+    if not os.path.exists(input_file):
+        print(f"Skipping {input_file} - File not found")
+        return
+
+    months = range(start_month, end_month + 1)
+    executor = month_pool(writers)
+    if executor is None:
+        # Open the yearly file once and write its months in turn
+        ds_subset = extract_variables(input_file, bounds)
+        try:
+            for month in months:
+                write_month(ds_subset, output_dir, year, month, encoding, store)
+        finally:
+            ds_subset.close()
+        return
+
+    # Every writer process opens the yearly file once and writes its share of the months
+    with executor:
+        futures = []
+        for month in months:
+            task_events.enqueue('soda-write', f"{year}-{month:02d}")
+            futures.append(executor.submit(write_year_month, input_file, output_dir, year, month, bounds, encoding,
+                                           store))
+        for future in futures:
+            future.result()
+
+# Function to list the 5daily files of a directory as (first day, path), sorted by date;
+# soda3.15.2_5dy_ocean_reg_2000_01_03.nc averages 2000-01-01 to 2000-01-05
+def pentad_files(input_dir):
+    files = []
+    for name in os.listdir(input_dir):
+        match = re.fullmatch(r"soda3\.15\.2_5dy_ocean_reg_(\d{4})_(\d{2})_(\d{2})\.nc", name)
+        if match:
+            centre = date(*(int(g) for g in match.groups()))
+            files.append((centre - timedelta(days=PENTAD_DAYS // 2), os.path.join(input_dir, name)))
+    return sorted(files)
+
+# Function to get the first day of a month and the first day of the next one
+def month_bounds(year, month):
+    first = date(year, month, 1)
+    return first, first + timedelta(days=calendar.monthrange(year, month)[1])
+
+# Function to count the days of a pentad starting on `first` that fall in a month
+def overlap_days(first, year, month):
+    start, stop = month_bounds(year, month)
+    return max(0, (min(first + timedelta(days=PENTAD_DAYS), stop) - max(first, start)).days)
+
+# Time-weighted mean of the pentads of one month, accumulated one pentad at a time;
+# the weight of a pentad is its number of days in the month
+class MonthlyMean:
+    def __init__(self, year, month):
+        self.year, self.month = year, month
+        self.days = 0
+        self.sums, self.weights = {}, {}
+        self.template = None
+
+    def add(self, ds, days):
+        if self.template is None:
+            # Coordinates, dims and attributes only, the data are held by the sums
+            self.template = ds.drop_vars(list(ds.data_vars)), \
+                {name: (v.dims, v.dtype, v.attrs) for name, v in ds.data_vars.items()}
+        for name, variable in ds.data_vars.items():
+            values = variable.values.astype('f8')
+            valid = np.isfinite(values)
+            if name not in self.sums:
+                self.sums[name] = np.zeros(values.shape)
+                self.weights[name] = np.zeros(values.shape)
+            self.sums[name] += days * np.where(valid, values, 0)
+            self.weights[name] += days * valid
+        self.days += days
+
+    def complete(self):
+        start, stop = month_bounds(self.year, self.month)
+        return self.days == (stop - start).days
+
+    # Function to get the mean as a dataset of one time step, in the middle of the month
+    def result(self):
+        coords, variables = self.template
+        start, stop = month_bounds(self.year, self.month)
+        middle = pd.Timestamp(start) + (pd.Timestamp(stop) - pd.Timestamp(start)) / 2
+        data = {}
+        for name, (dims, dtype, attrs) in variables.items():
+            # Points never valid (land) are NaN
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = self.sums[name] / self.weights[name]
+            data[name] = (('time',) + dims, mean[None].astype(dtype), attrs)
+        return xr.Dataset(data, coords=coords.coords).assign_coords(time=[middle]).assign_attrs(coords.attrs)
+
+# Function to process the 5daily files of a year: the pentads are read one at a time, in
+# date order, and added to the months they overlap (two at most); a month is written as
+# soon as no later pentad can reach it
+def process_year_5daily(input_dir, output_dir, year, start_month, end_month, writers=DEFAULT_WRITERS, bounds=None,
+                        encoding=None, store=None, pentads=DEFAULT_PENTADS):
+    months = [(year, month) for month in range(start_month, end_month + 1)]
+    files = pentad_files(input_dir)
+
+    # The complete months are sent to the writer processes while the next pentads are read
+    executor = month_pool(writers)
+    with executor or contextlib.nullcontext():
+        futures = []
+
+        def submit(ds_monthly, year, month):
+            if executor is None:
+                write_month(ds_monthly, output_dir, year, month, encoding, store)
+                return
+            task_events.enqueue('soda-write', f"{year}-{month:02d}")
+            futures.append(executor.submit(write_month, ds_monthly, output_dir, year, month, encoding, store))
+
+        if pentads == 'snapshots':
+            # The pentads centred in each month, opened lazily and written one time step at a time
+            for year, month in months:
+                paths = [path for first, path in files
+                         if month_bounds(year, month)[0] <= first + timedelta(days=PENTAD_DAYS // 2)
+                         < month_bounds(year, month)[1]]
+                if not paths:
+                    print(f"Skipping {year}-{month:02d} - no 5daily file found")
+                    continue
+                submit(xr.concat([extract_variables(path, bounds) for path in paths], dim='time'), year, month)
         else:
-            print(f"Skipping {input_file} - File not found")
+            pending = {}
+            for first, path in files:
+                # Months that no pentad from this one on can reach are complete
+                for key in [k for k in pending if month_bounds(*k)[1] <= first]:
+                    finish_month(pending.pop(key), submit)
+                overlaps = [(y, m, overlap_days(first, y, m)) for y, m in months]
+                overlaps = [(y, m, days) for y, m, days in overlaps if days]
+                if not overlaps:
+                    continue
+                with task_events.task('soda-read', os.path.basename(path)) as handle:
+                    ds = extract_variables(path, bounds)
+                    try:
+                        pentad = ds.isel(time=0, drop=True).load()
+                    finally:
+                        ds.close()
+                    handle.add_bytes(pentad.nbytes)
+                for y, m, days in overlaps:
+                    pending.setdefault((y, m), MonthlyMean(y, m)).add(pentad, days)
+                del pentad
+            for key in sorted(pending):
+                finish_month(pending.pop(key), submit)
+            for year, month in months:
+                if not any(overlap_days(first, year, month) for first, _ in files):
+                    print(f"Skipping {year}-{month:02d} - no 5daily file found")
+
+        for future in futures:
+            future.result()
+
+# Function to write a monthly mean if all the days of the month were covered
+def finish_month(mean, submit):
+    start, stop = month_bounds(mean.year, mean.month)
+    if not mean.complete():
+        print(f"Skipping {mean.year}-{mean.month:02d} - 5daily files cover {mean.days} of {(stop - start).days} days "
+              f"(the pentads straddling the month boundaries are needed too)")
+        return
+    submit(mean.result(), mean.year, mean.month)
+
+# Function to list the files written for a year, in which a sharded run checks its done years
+def year_outputs(output_dir, start_month, end_month, store, year):
+    if store is not None:
+        return [store]
+    return [f"{output_dir}/raw_soda_Y{year}M{month}.nc" for month in range(start_month, end_month + 1)]
+
+# Function to count the pentads centred in a month, the steps of the month in the store
+# (module level, as the store is sent to the writer processes)
+def count_centres(centres, year, month):
+    return sum(1 for c in centres if (c.year, c.month) == (year, month))
+
+# Function to process one year of a sharded run if this worker claims it
+def process_claimed_year(process, shard, input_dir, output_dir, year, *args):
+    if not shard.claim(year):
+        return
+    try:
+        process(input_dir, output_dir, year, *args)
+    except Exception:
+        shard.release(year)
+        raise
+    shard.complete(year)
+
+def create_monthly_files(input_dir, output_dir, start_year, end_year, start_month, end_month,
+                         workers=DEFAULT_WORKERS, writers=DEFAULT_WRITERS, bounds=None, encoding=None,
+                         store=None, data_type=DEFAULT_DATA_TYPE, pentads=DEFAULT_PENTADS, shard=None):
+    os.makedirs(output_dir, exist_ok=True)
+    years = range(start_year, end_year + 1)
+    if data_type == "5daily":
+        process = functools.partial(process_year_5daily, pentads=pentads)
+    else:
+        process = process_year
+
+    # A worker of a sharded run processes the years it claims: its own ones, then those nobody has started
+    phases = [years]
+    if shard is not None:
+        process = functools.partial(process_claimed_year, process, shard)
+        phases = [shard.mine(years), shard.others(years)]
+
+    for phase in phases:
+        if workers <= 1:
+            for year in phase:
+                process(input_dir, output_dir, year, start_month, end_month, writers, bounds, encoding, store)
+            continue
+
+        # Process years in parallel, one yearly file (or one year of 5daily files) per process
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process, input_dir, output_dir, year, start_month, end_month, writers, bounds,
+                                       encoding, store)
+                       for year in phase]
+            for future in futures:
+                future.result()
 
 def main():
     parser = argparse.ArgumentParser(description="Process SODA3.15.2 data and create monthly files.")
-    parser.add_argument("--input-dir", type=str, default=DEFAULT_INPUT_DIR, help="Input directory for yearly files")
+    parser.add_argument("--input-dir", type=str, default=DEFAULT_INPUT_DIR, help="Input directory for yearly (or 5daily) files")
     parser.add_argument("--output-dir", type=str, default=DEFAULT_OUTPUT_DIR, help="Output directory for monthly files")
     parser.add_argument("--start-year", type=int, default=DEFAULT_YEAR_START, help="Start year")
     parser.add_argument("--end-year", type=int, default=DEFAULT_YEAR_END, help="End year")
     parser.add_argument("--start-month", type=int, default=DEFAULT_MONTH_START, help="Start month")
     parser.add_argument("--end-month", type=int, default=DEFAULT_MONTH_END, help="End month")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Years processed in parallel")
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS, help="Monthly files written in parallel per year (processes)")
+    parser.add_argument("--complevel", type=int, default=DEFAULT_COMPLEVEL, help="zlib level of the monthly files (0: no compression)")
+    parser.add_argument("--packing", choices=['float32', 'int16', 'none'], default=DEFAULT_PACKING,
+                        help="Storage of the variables: float32, int16 with scale/offset, or the input dtype")
+    parser.add_argument("--zarr", type=str, help="Zarr store receiving all the months, instead of monthly NetCDF files")
+    parser.add_argument("--data-type", choices=["monthly", "5daily"], default=DEFAULT_DATA_TYPE,
+                        help="Input files: yearly files of monthly means, or 5daily files")
+    parser.add_argument("--pentads", choices=["mean", "snapshots"], default=DEFAULT_PENTADS,
+                        help="5daily: time-weighted monthly means, or the native 5-day means of each month")
+
+    # Domain bounds, given directly or read from the crocotools_param file
+    parser.add_argument("--lon", type=float, nargs=2, metavar=("MIN", "MAX"), help="Longitude bounds")
+    parser.add_argument("--lat", type=float, nargs=2, metavar=("MIN", "MAX"), help="Latitude bounds")
+    parser.add_argument("--depth", type=float, nargs=2, metavar=("MIN", "MAX"), help="Depth bounds (m)")
+    parser.add_argument("--param-file", type=str, help="crocotools_param file to read lonmin/lonmax/latmin/latmax from")
+    parser.add_argument("--margin", type=float, default=DEFAULT_MARGIN, help="Margin (degrees) added around the param-file bounds")
 
     args = parser.parse_args()
 
-    create_monthly_files(args.input_dir, args.output_dir, args.start_year, args.end_year, args.start_month, args.end_month)
+    bounds = {}
+    if args.param_file:
+        bounds.update(read_crocotools_bounds(args.param_file, args.margin))
+    if args.lon:
+        bounds['lon'] = tuple(args.lon)
+    if args.lat:
+        bounds['lat'] = tuple(args.lat)
+    if args.depth:
+        bounds['depth'] = tuple(args.depth)
+
+    # The store holds one step per month, or the pentads centred in each month
+    steps_per_month = 1
+    if args.data_type == "5daily" and args.pentads == "snapshots":
+        centres = [first + timedelta(days=PENTAD_DAYS // 2) for first, _ in pentad_files(args.input_dir)]
+        steps_per_month = functools.partial(count_centres, centres)
+
+    create_monthly_files(args.input_dir, args.output_dir, args.start_year, args.end_year, args.start_month, args.end_month,
+                         workers=args.workers, writers=args.writers, bounds=bounds or None,
+                         encoding={'complevel': args.complevel, 'variables': DEFAULT_VARIABLE_ENCODING,
+                                   'packing': args.packing},
+                         store=MonthlyZarrStore(args.zarr, (args.start_year, args.start_month), steps_per_month,
+                                                packing=args.packing)
+                         if args.zarr else None,
+                         data_type=args.data_type, pentads=args.pentads,
+                         shard=task_shards.default_shard(
+                             f'soda_{args.data_type}', args.output_dir,
+                             config=[args.pentads, bounds, args.complevel, args.packing, args.zarr],
+                             outputs=functools.partial(year_outputs, args.output_dir, args.start_month,
+                                                       args.end_month, args.zarr)))
+    task_events.finish(from_file=args.workers > 1 or args.writers > 1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,113 @@
+#===========================================================================
+# Request size estimates shared by the ERA5 and CMEMS download scripts
+#
+#  The volume of a request is estimated from the grid step, the bbox, the
+#  depth levels and the time step (4 bytes per value). Small requests are
+#  merged into multi-month ones, large ones are split into time ranges or
+#  depth slabs, so that every request stays under the service limits.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import datetime
+import math
+import re
+
+MB = 1024 * 1024
+VALUE_BYTES = 4  # float32
+
+# The 50 depth levels (m) of the GLORYS12 products
+GLORYS12_DEPTHS = [
+    0.494, 1.541, 2.646, 3.819, 5.078, 6.441, 7.930, 9.573, 11.405, 13.467,
+    15.810, 18.496, 21.599, 25.211, 29.445, 34.434, 40.344, 47.374, 55.764, 65.807,
+    77.854, 92.326, 109.729, 130.666, 155.851, 186.126, 222.475, 266.040, 318.127, 380.213,
+    453.938, 541.089, 643.567, 763.333, 902.339, 1062.440, 1245.291, 1452.251, 1684.284, 1941.893,
+    2225.078, 2533.336, 2865.703, 3220.820, 3597.032, 3992.484, 4405.224, 4833.291, 5274.784, 5727.917,
+]
+
+# Variables of the CMEMS physics products without a depth dimension
+SURFACE_VARIABLES = ['zos', 'mlotst', 'siconc', 'sithick', 'usi', 'vsi', 'bottomT']
+
+
+# Function to count the points of a regular axis between two bounds
+def grid_points(lo, hi, step):
+    return int(math.floor(abs(float(hi) - float(lo)) / step + 1e-6)) + 1
+
+
+# Function to get the grid step (degrees) of a CMEMS dataset from its id, e.g. "..._0.083deg_P1M-m"
+def dataset_resolution(dataset_id, default=1 / 12):
+    match = re.search(r'_(\d+(?:\.\d+)?)deg', dataset_id)
+    if not match:
+        return default
+    step = float(match.group(1))
+    return 1 / 12 if abs(step - 0.083) < 1e-3 else step
+
+
+# Function to get the number of time steps per day of a CMEMS dataset (None for monthly means)
+def steps_per_day(dataset_id):
+    match = re.search(r'_P(T?)(\d+)([DHM])', dataset_id)
+    if not match:
+        return 1
+    hourly, n, unit = match.group(1), int(match.group(2)), match.group(3)
+    if hourly:
+        return 24 / n if unit == 'H' else 24 * 60 / n
+    return None if unit == 'M' else 1 / n
+
+
+# Function to count the time steps of a CMEMS dataset between two dates (inclusive)
+def time_steps(dataset_id, start, end):
+    per_day = steps_per_day(dataset_id)
+    if per_day is None:
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return max(1, int(round(((end - start).days + 1) * per_day)))
+
+
+# Function to list the depth levels between two depths
+def depth_levels(depth_min, depth_max, levels=GLORYS12_DEPTHS):
+    return [d for d in levels if depth_min - 1e-3 <= d <= depth_max + 1e-3]
+
+
+# Function to estimate the size (bytes) of a request
+def estimate_bytes(npoints, nlevels, ntimes, nvars=1):
+    return npoints * nlevels * ntimes * nvars * VALUE_BYTES
+
+
+# Function to split the levels into n slabs; the bounds are half-way between
+# levels so that no level falls in two slabs
+def depth_slabs(levels, n):
+    n = max(1, min(n, len(levels)))
+    size = math.ceil(len(levels) / n)
+    groups = [levels[i:i + size] for i in range(0, len(levels), size)]
+    slabs = []
+    for i, group in enumerate(groups):
+        lo = group[0] if i == 0 else (groups[i - 1][-1] + group[0]) / 2
+        hi = group[-1] if i == len(groups) - 1 else (group[-1] + groups[i + 1][0]) / 2
+        slabs.append((lo, hi))
+    return slabs
+
+
+# Function to split the days between two dates (inclusive) into n consecutive ranges
+def day_ranges(start, end, n):
+    ndays = (end - start).days + 1
+    n = max(1, min(n, ndays))
+    size = math.ceil(ndays / n)
+    return [(start + datetime.timedelta(days=i), min(end, start + datetime.timedelta(days=i + size - 1)))
+            for i in range(0, ndays, size)]
+
+
+# Function to format a size in bytes
+def format_size(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+
+# Function to print a request plan: rows of (label, number of pieces, estimated bytes)
+def print_plan(rows):
+    print(f"{'request':<60} {'pieces':>6} {'estimated':>12}")
+    for label, pieces, nbytes in rows:
+        print(f"{label:<60} {pieces:>6} {format_size(nbytes):>12}")
+    total = sum(nbytes for _, _, nbytes in rows)
+    print(f"{len(rows)} requests, {sum(p for _, p, _ in rows)} pieces, {format_size(total)} estimated in total")
+    return total
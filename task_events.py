@@ -0,0 +1,261 @@
+#===========================================================================
+# Per-task instrumentation shared by the forcing scripts
+#
+#  Every download / processing task emits JSON-lines events:
+#    enqueue, start, first_byte, retry, end (duration, queue wait, bytes,
+#    retries, exit code, stderr tail, error)
+#  to the file named by $FORCING_EVENTS_FILE (nothing is written if unset).
+#  first_byte is only measured by the downloads streaming their response
+#  (SODA); the end events of the other sources have no first_byte field.
+#  Threads working for a task (e.g. the pieces of a split request) run
+#  under its handle with bound(handle).
+#  finish() prints a summary per source (p50/p95 latency, throughput) and,
+#  if $FORCING_PROM_FILE is set, writes it in the Prometheus textfile format.
+#  Listeners (add_listener) receive every event as it is emitted, e.g. the
+#  adaptive concurrency limit of download_scheduler.py.
+#
+#  The summary of an existing events file can be printed with
+#    python task_events.py events.jsonl [--prometheus forcing.prom]
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import contextlib
+import json
+import os
+import threading
+import time
+
+EVENTS_FILE = os.environ.get('FORCING_EVENTS_FILE')
+PROM_FILE = os.environ.get('FORCING_PROM_FILE')
+STDERR_TAIL = 500  # characters of stderr kept in the end event
+
+_lock = threading.Lock()
+_local = threading.local()
+_ended = []
+_enqueued = {}
+_listeners = []
+
+
+# Function to write one event to the events file and keep end events in memory
+def emit(event, source, task, **fields):
+    record = {'ts': time.time(), 'event': event, 'source': source, 'task': str(task), 'pid': os.getpid()}
+    record.update(fields)
+    with _lock:
+        if event == 'end':
+            _ended.append(record)
+    if EVENTS_FILE:
+        line = (json.dumps(record, default=str) + '\n').encode()
+        fd = os.open(EVENTS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    for listener in list(_listeners):
+        listener(record)
+
+
+# Function to call listener(record) for every event emitted from now on
+def add_listener(listener):
+    with _lock:
+        _listeners.append(listener)
+
+
+# Function to record that a task was put in a queue
+def enqueue(source, task):
+    with _lock:
+        _enqueued[(source, str(task))] = time.time()
+    emit('enqueue', source, task)
+
+
+# Handle of a running task, filled in by the code doing the work
+class TaskHandle:
+    def __init__(self, source, task):
+        self.source = source
+        self.task = task
+        self.start = time.time()
+        self.bytes = 0
+        self.retries = 0
+        self.exit_code = None
+        self.stderr = None
+        self.error = None
+        self.first_byte_ts = None
+
+    def first_byte(self):
+        with _lock:
+            if self.first_byte_ts is not None:
+                return
+            self.first_byte_ts = time.time()
+        emit('first_byte', self.source, self.task, latency=self.first_byte_ts - self.start)
+
+    def add_bytes(self, nbytes):
+        with _lock:
+            self.bytes += nbytes
+
+    def retry(self, error):
+        with _lock:
+            self.retries += 1
+        emit('retry', self.source, self.task, attempt=self.retries, error=str(error))
+
+    # Mark the task as failed when the error is handled without raising
+    def fail(self, error):
+        self.error = error
+
+
+# Handle used when no task is running, so instrumented code never has to check
+class _NoTask(TaskHandle):
+    def __init__(self):
+        super().__init__(None, None)
+
+    def first_byte(self):
+        pass
+
+    def retry(self, error):
+        pass
+
+
+# Function to get the handle of the task running in this thread
+def current():
+    return getattr(_local, 'handle', None) or _NoTask()
+
+
+# Context manager running the code of another thread (e.g. a pool worker) under the
+# handle of a task, so that its bytes and retries are counted in that task
+@contextlib.contextmanager
+def bound(handle):
+    parent = getattr(_local, 'handle', None)
+    _local.handle = handle
+    try:
+        yield handle
+    finally:
+        _local.handle = parent
+
+
+# Context manager timing one task and emitting its start and end events
+@contextlib.contextmanager
+def task(source, name):
+    handle = TaskHandle(source, name)
+    parent = getattr(_local, 'handle', None)
+    _local.handle = handle
+    with _lock:
+        queued = _enqueued.pop((source, str(name)), None)
+    emit('start', source, name, queue_wait=(handle.start - queued) if queued else None)
+    error = None
+    try:
+        yield handle
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _local.handle = parent
+        error = error if error is not None else handle.error
+        failed = error is not None or (handle.exit_code not in (None, 0))
+        fields = {'first_byte': handle.first_byte_ts - handle.start} if handle.first_byte_ts else {}
+        emit('end', source, name,
+             duration=time.time() - handle.start,
+             queue_wait=(handle.start - queued) if queued else None,
+             bytes=handle.bytes, retries=handle.retries, exit_code=handle.exit_code,
+             stderr_tail=handle.stderr[-STDERR_TAIL:] if handle.stderr else None,
+             ok=not failed, error=str(error) if error is not None else None, **fields)
+
+
+# Function to compute a percentile of sorted values
+def percentile(values, p):
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0.0
+
+
+# Function to summarise end events per source
+def summarize(records):
+    summary = {}
+    for source in sorted({r['source'] for r in records}):
+        ended = [r for r in records if r['source'] == source]
+        durations = sorted(r['duration'] for r in ended)
+        waits = sorted(r['queue_wait'] for r in ended if r.get('queue_wait') is not None)
+        nbytes = sum(r.get('bytes') or 0 for r in ended)
+        span = max(r['ts'] for r in ended) - min(r['ts'] - r['duration'] for r in ended)
+        summary[source] = {
+            'tasks': len(ended),
+            'failed': sum(1 for r in ended if not r.get('ok', True)),
+            'retries': sum(r.get('retries') or 0 for r in ended),
+            'p50_s': percentile(durations, 50),
+            'p95_s': percentile(durations, 95),
+            'queue_wait_p95_s': percentile(waits, 95),
+            'bytes': nbytes,
+            'bytes_per_s': nbytes / span if span > 0 else 0.0,
+        }
+    return summary
+
+
+# Function to read the end events of an events file
+def read_events(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('event') == 'end':
+                records.append(record)
+    return records
+
+
+# Function to print a summary table
+def print_summary(summary):
+    print(f"{'source':<16} {'tasks':>6} {'failed':>6} {'retries':>7} {'p50 s':>8} {'p95 s':>8} {'wait p95':>8} {'MB/s':>8}")
+    for source, s in summary.items():
+        print(f"{source:<16} {s['tasks']:>6} {s['failed']:>6} {s['retries']:>7} {s['p50_s']:>8.2f} "
+              f"{s['p95_s']:>8.2f} {s['queue_wait_p95_s']:>8.2f} {s['bytes_per_s'] / 1e6:>8.2f}")
+
+
+# Function to write a summary in the Prometheus textfile collector format
+def write_prometheus(summary, path):
+    metrics = [
+        ('forcing_tasks_total', 'counter', 'tasks', 'Finished tasks'),
+        ('forcing_tasks_failed_total', 'counter', 'failed', 'Failed tasks'),
+        ('forcing_task_retries_total', 'counter', 'retries', 'Retries of tasks'),
+        ('forcing_task_duration_p50_seconds', 'gauge', 'p50_s', 'Median task duration'),
+        ('forcing_task_duration_p95_seconds', 'gauge', 'p95_s', '95th percentile of task duration'),
+        ('forcing_task_queue_wait_p95_seconds', 'gauge', 'queue_wait_p95_s', '95th percentile of queue wait'),
+        ('forcing_bytes_total', 'counter', 'bytes', 'Bytes transferred or written'),
+        ('forcing_bytes_per_second', 'gauge', 'bytes_per_s', 'Throughput over the active span'),
+    ]
+    lines = []
+    for name, kind, key, help_text in metrics:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for source, s in summary.items():
+            lines.append(f'{name}{{source="{source}"}} {s[key]}')
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
+
+
+# Function to print the run summary and export it; `from_file` also counts
+# the events written by other processes of the run
+def finish(from_file=False):
+    records = read_events(EVENTS_FILE) if from_file and EVENTS_FILE and os.path.exists(EVENTS_FILE) else list(_ended)
+    if not records:
+        return {}
+    summary = summarize(records)
+    print_summary(summary)
+    if PROM_FILE:
+        write_prometheus(summary, PROM_FILE)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a forcing events file.")
+    parser.add_argument("events_file", type=str, help="JSON-lines events file")
+    parser.add_argument("--prometheus", type=str, help="Write the summary to this Prometheus textfile")
+    args = parser.parse_args()
+
+    summary = summarize(read_events(args.events_file))
+    print_summary(summary)
+    if args.prometheus:
+        write_prometheus(summary, args.prometheus)
+
+
+if __name__ == "__main__":
+    main()
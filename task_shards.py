@@ -0,0 +1,236 @@
+#===========================================================================
+# Sharding of the tasks of a run (months, variables, files) across
+# independent workers: SLURM job array tasks or several local processes
+# sharing a scratch directory
+#
+#  Every worker builds the same task list from the same configuration.
+#  Worker i of N takes the tasks i, i+N, i+2N... in order; once it has run
+#  them, it takes the tasks of the other shards nobody has started, from
+#  their ends, so that the work of stragglers and of workers that never
+#  started is picked up. A task is taken by creating its claim file with
+#  O_CREAT | O_EXCL in the claims directory, which is atomic on local and
+#  shared (NFS, Lustre, GPFS) filesystems: no lock server, no database. A
+#  finished task leaves a done file, so that a new run of the same job
+#  skips it as long as its output files exist. The claims directory is
+#  named after the run and a hash of the configuration of the script, so
+#  that a run with another domain or variables starts afresh. The claims
+#  of a crashed worker are taken over once its process is gone (on the
+#  same host), or after $FORCING_CLAIM_TIMEOUT seconds (a day by default,
+#  longer than any task should run).
+#
+#  Environment:
+#    FORCING_SHARDS, FORCING_SHARD  number of workers and index of this one
+#                                   (default: the SLURM job array)
+#    FORCING_CLAIMS_DIR             claims directory (default: .claims/<run>-<config
+#                                   hash> in the output directory of the script)
+#    FORCING_RUN_ID                 <run> (default: $SLURM_ARRAY_JOB_ID, or local)
+#    FORCING_CLAIM_TIMEOUT          seconds after which an unfinished claim is stale
+#                                   (default 86400)
+#
+#  sbatch --array=0-15 era5_job.sh
+#  for i in 0 1 2 3; do FORCING_SHARDS=4 FORCING_SHARD=$i python process_soda3.15.2.py & done
+#  python task_shards.py /scratch/era5/.claims/local-1f3a...  # claims and done tasks
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import socket
+import time
+
+CLAIMS_DIR = os.environ.get('FORCING_CLAIMS_DIR')
+RUN_ID = os.environ.get('FORCING_RUN_ID') or os.environ.get('SLURM_ARRAY_JOB_ID') or 'local'
+CLAIM_TIMEOUT = float(os.environ.get('FORCING_CLAIM_TIMEOUT') or 24 * 3600)
+MAX_NAME = 120  # characters of a task kept in its claim file name
+
+
+# Function to read the number of workers and the index of this one: $FORCING_SHARDS and
+# $FORCING_SHARD, else the SLURM job array; (0, 1) for a single worker
+def shard_settings():
+    if os.environ.get('FORCING_SHARDS'):
+        return int(os.environ.get('FORCING_SHARD', 0)), int(os.environ['FORCING_SHARDS'])
+    if os.environ.get('SLURM_ARRAY_TASK_COUNT'):
+        first = int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+        return int(os.environ['SLURM_ARRAY_TASK_ID']) - first, int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+    return 0, 1
+
+
+# Function to hash the configuration of a run (any JSON-serialisable value)
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+# Function to build the file name of a task (any value with a stable str, e.g. a tuple)
+def task_name(source, task):
+    name = re.sub(r'[^A-Za-z0-9.=-]+', '_', f'{source}_{task}').strip('_')
+    if len(name) > MAX_NAME:
+        name = name[:MAX_NAME] + '_' + hashlib.sha1(name.encode()).hexdigest()[:12]
+    return name
+
+
+class Shard:
+    # outputs(task): the files of a task, its done file is only trusted while they all exist
+    def __init__(self, source, index, count, claims_dir, timeout=CLAIM_TIMEOUT, outputs=None):
+        if not 0 <= index < count:
+            raise ValueError(f"shard {index} out of 0..{count - 1}")
+        self.source = source
+        self.index = index
+        self.count = count
+        self.claims_dir = claims_dir
+        self.timeout = timeout
+        self.outputs = outputs
+        self.host = socket.gethostname()
+        self.worker = f'{self.host}:{os.getpid()}:{index}'
+        self.done = []  # tasks completed by this worker
+        os.makedirs(claims_dir, exist_ok=True)
+
+    def _path(self, task, kind):
+        return os.path.join(self.claims_dir, f'{task_name(self.source, task)}.{kind}')
+
+    def _create(self, path):
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        try:
+            os.write(fd, f'{self.worker} {time.time():.0f}\n'.encode())
+        finally:
+            os.close(fd)
+
+    # Function to list the tasks of this shard
+    def mine(self, tasks):
+        return list(tasks)[self.index::self.count]
+
+    # Function to list the tasks of the other shards, the next shards first, each from its end
+    def others(self, tasks):
+        tasks = list(tasks)
+        return [task for k in range(1, self.count)
+                for task in tasks[(self.index + k) % self.count::self.count][::-1]]
+
+    # Function to tell whether a claim is stale: its worker ran on this host and is gone
+    # (a worker never claims a task twice, so a claim with its pid is from an earlier
+    # process), or it is older than the timeout
+    def _stale(self, path):
+        with open(path) as f:
+            fields = f.read().split(':')
+        if len(fields) == 3 and fields[0] == self.host and fields[1].isdigit():
+            pid = int(fields[1])
+            if pid == os.getpid():
+                return True
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return self.timeout is not None and time.time() - os.path.getmtime(path) >= self.timeout
+
+    # Function to take a task; False if it is done, or claimed by a live worker
+    def claim(self, task):
+        path = self._path(task, 'claim')
+        done = self._path(task, 'done')
+        if os.path.exists(done):
+            if self.outputs is None or all(os.path.exists(output) for output in self.outputs(task)):
+                return False
+            # Done, but its output is gone: its claim, then its done file are renamed aside
+            # (one worker only wins the rename of the done file) and the task is claimed
+            # again; a worker finding no done file finds no claim of the finished task
+            try:
+                os.rename(path, f'{path}.gone.{self.index}.{os.getpid()}')
+            except FileNotFoundError:
+                pass
+            try:
+                os.rename(done, f'{done}.gone.{self.index}.{os.getpid()}')
+            except FileNotFoundError:
+                return False
+            print(f"Output of {task} is missing, running it again")
+            try:
+                self._create(path)
+                return True
+            except FileExistsError:
+                return False
+        try:
+            self._create(path)
+            return True
+        except FileExistsError:
+            pass
+        # A stale claim is renamed aside first: one worker only wins the rename
+        try:
+            if not self._stale(path):
+                return False
+            os.rename(path, f'{path}.stale.{self.index}.{os.getpid()}')
+        except FileNotFoundError:
+            return False
+        print(f"Taking over the stale claim of {task}")
+        try:
+            self._create(path)
+            return True
+        except FileExistsError:
+            return False
+
+    # Function to mark a claimed task as done
+    def complete(self, task):
+        try:
+            self._create(self._path(task, 'done'))
+        except FileExistsError:
+            pass
+        self.done.append(task)
+
+    # Function to give a failed task back, for a later run or another worker
+    def release(self, task):
+        try:
+            os.remove(self._path(task, 'claim'))
+        except FileNotFoundError:
+            pass
+
+    # Function to yield the tasks this worker claims, one at a time (a task is claimed
+    # when it is taken): its own tasks, then the others; key(task) names the task
+    def claimed(self, tasks, key=lambda task: task):
+        tasks = list(tasks)
+        for task in self.mine(tasks) + self.others(tasks):
+            if self.claim(key(task)):
+                yield task
+
+
+# Function to get the shard of this worker for a source, None without sharding; the
+# claims are kept in $FORCING_CLAIMS_DIR, or in base_dir/.claims/<run>-<hash of config>
+def default_shard(source, base_dir, config=None, outputs=None):
+    index, count = shard_settings()
+    if count <= 1:
+        return None
+    run = RUN_ID if config is None else f'{RUN_ID}-{config_hash(config)}'
+    shard = Shard(source, index, count, CLAIMS_DIR or os.path.join(base_dir, '.claims', run), outputs=outputs)
+    # Not again in the check processes spawned by the worker, which import its script
+    if multiprocessing.current_process().name == 'MainProcess':
+        print(f"Worker {index} of {count}, claims in {shard.claims_dir}")
+    return shard
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the claimed and done tasks of a sharded run.")
+    parser.add_argument("claims_dir", type=str, help="Claims directory")
+    parser.add_argument("--list", action="store_true", help="List the tasks claimed but not done")
+    args = parser.parse_args()
+
+    names = os.listdir(args.claims_dir)
+    done = {name[:-5] for name in names if name.endswith('.done')}
+    claimed = {name[:-6] for name in names if name.endswith('.claim')}
+    running = sorted(claimed - done)
+    workers = {}
+    for name in done:
+        with open(os.path.join(args.claims_dir, name + '.done')) as f:
+            worker = f.read().split()[0].rsplit(':', 1)[-1]
+        workers[worker] = workers.get(worker, 0) + 1
+    print(f"{len(done)} tasks done, {len(running)} claimed and not done, "
+          f"{sum(1 for name in names if '.stale.' in name)} stale claims taken over")
+    for worker in sorted(workers, key=int):
+        print(f"  shard {worker}: {workers[worker]} done")
+    if args.list:
+        for name in running:
+            with open(os.path.join(args.claims_dir, name + '.claim')) as f:
+                print(f"  {name}: {f.read().strip()}")
+
+
+if __name__ == "__main__":
+    main()
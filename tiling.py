@@ -0,0 +1,51 @@
+#===========================================================================
+# Spatial tiling of large download domains, shared by the ERA5 and CMEMS
+# download scripts
+#
+#  The domain is cut into tiles of about `size` degrees whose edges fall on
+#  the grid and are shared by neighbouring tiles; the downloaded tiles are
+#  mosaicked back lazily (dask), dropping the duplicated edge points, so
+#  whole fields are never loaded in memory.
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import math
+
+import xarray as xr
+
+
+# Function to cut [lo, hi] into ranges of about `size` with edges on the grid of step `step`;
+# inner edges are widened by `pad` so that rounding never drops the shared edge points
+def tile_ranges(lo, hi, size, step, pad=0.0):
+    lo, hi = float(lo), float(hi)
+    cells = max(1, int(round(size / step)))
+    n = max(1, math.ceil((hi - lo) / (cells * step) - 1e-6))
+    edges = [lo + k * cells * step for k in range(n)] + [hi]
+    return [(edges[k] - (pad if k > 0 else 0), edges[k + 1] + (pad if k < n - 1 else 0)) for k in range(n)]
+
+
+# Function to cut a bbox into (lon_min, lon_max, lat_min, lat_max) tiles
+def domain_tiles(lon_min, lon_max, lat_min, lat_max, size, step, pad=0.0):
+    return [(x0, x1, y0, y1)
+            for y0, y1 in tile_ranges(lat_min, lat_max, size, step, pad)
+            for x0, x1 in tile_ranges(lon_min, lon_max, size, step, pad)]
+
+
+# Function to mosaic tiles of one grid back into a single (lazy) dataset:
+# tiles of a row are joined along `lon`, then the rows along `lat`
+def mosaic(datasets, lon='longitude', lat='latitude'):
+    datasets = [ds for ds in datasets if ds.sizes[lon] > 0 and ds.sizes[lat] > 0]
+    if len(datasets) == 1:
+        return datasets[0]
+
+    rows = {}
+    for ds in datasets:
+        rows.setdefault(round(float(ds[lat].values[0]), 6), []).append(ds)
+
+    def join(pieces, dim):
+        descending = bool(len(pieces[0][dim]) > 1 and pieces[0][dim].values[1] < pieces[0][dim].values[0])
+        pieces = sorted(pieces, key=lambda ds: float(ds[dim].values[0]), reverse=descending)
+        joined = xr.concat(pieces, dim=dim, data_vars='minimal', coords='minimal', compat='override')
+        return joined.drop_duplicates(dim)
+
+    return join([join(row, lon) for row in rows.values()], lat)
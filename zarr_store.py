@@ -0,0 +1,217 @@
+#===========================================================================
+# Monthly Zarr store, an alternative to the monthly NetCDF files written
+# by the SODA, CMEMS and ERA5 scripts
+#
+#  One consolidated store per source holds the whole period along time.
+#  Every month owns a fixed range of time steps of the store (its region),
+#  so writers of different months, threads or processes, never touch the
+#  same chunks and write their data without any lock. Only the allocation
+#  of new months or variables and the writes of the time coordinate are
+#  serialised, by a lock file next to the store. Months not written yet
+#  read as NaN. Variables with different time steps (ERA5) are kept in
+#  groups of the same store.
+#
+#  store = MonthlyZarrStore('/scratch/soda.zarr', (1993, 1), steps_per_month=1)
+#  store.write_month(ds, 1993, 1)
+#  ds = open_store('/scratch/soda.zarr')   # the whole period, lazily
+#
+#This file is part of CROCOTOOLS
+#===========================================================================
+import calendar
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+
+import dask.array as da
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+from netcdf_encoding import chunk_shape
+
+TIME_ORIGIN = '1900-01-01'
+TIME_UNITS = f'hours since {TIME_ORIGIN} 00:00:00'
+
+
+# Function to open a store (or one of its groups) for reading, the whole period lazily
+def open_store(path, group=None):
+    return xr.open_zarr(path, group=group, consolidated=True)
+
+
+# Function to list the (year, month) pairs from a month to another (included)
+def months_between(first, last):
+    start, stop = first[0] * 12 + first[1] - 1, last[0] * 12 + last[1] - 1
+    return [(k // 12, k % 12 + 1) for k in range(start, stop + 1)]
+
+
+# Function to get the name of the time dimension of a dataset (ERA5 files use valid_time)
+def time_dim(ds):
+    return 'valid_time' if 'valid_time' in ds.dims else 'time'
+
+
+class MonthlyZarrStore:
+    # steps_per_month: number of time steps of a month, or a function of (year, month)
+    def __init__(self, path, first_month, steps_per_month=1, packing='float32', group=None):
+        self.path = path
+        self.group = group
+        self.first_month = tuple(first_month)
+        self.steps_per_month = steps_per_month
+        self.packing = packing
+
+    def steps(self, year, month):
+        if callable(self.steps_per_month):
+            return self.steps_per_month(year, month)
+        return self.steps_per_month
+
+    # Function to count the time steps of the first year (12 months) of the store
+    def year_steps(self):
+        year, month = self.first_month
+        last = (year + (month + 10) // 12, (month + 10) % 12 + 1)
+        return sum(self.steps(*m) for m in months_between(self.first_month, last))
+
+    # Exclusive lock of the store, shared by the threads and processes writing to it
+    @contextlib.contextmanager
+    def lock(self):
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def exists(self):
+        return os.path.isdir(os.path.join(self.path, self.group or ''))
+
+    # Function to build the empty (lazy) dataset of some months, shaped like `template`
+    def placeholder(self, template, months, start, variables=None):
+        tdim = time_dim(template)
+        times, index = [], {}
+        for year, month in months:
+            n = self.steps(year, month)
+            step = pd.Timedelta(days=calendar.monthrange(year, month)[1]) / n
+            index[f'{year}-{month:02d}'] = [start + len(times), start + len(times) + n]
+            times.extend(pd.Timestamp(year, month, 1) + k * step for k in range(n))
+
+        data, encoding = {}, {}
+        for name, variable in template.data_vars.items():
+            if tdim not in variable.dims or (variables is not None and name not in variables):
+                continue
+            shape = tuple(len(times) if d == tdim else template.sizes[d] for d in variable.dims)
+            dtype = variable.dtype
+            if self.packing == 'float32' and dtype == np.float64:
+                dtype = np.dtype('float32')
+            chunks = chunk_shape(shape) or tuple(1 for _ in shape)
+            data[name] = xr.Variable(variable.dims, da.full(shape, np.nan, dtype=dtype, chunks=chunks),
+                                     variable.attrs)
+            encoding[name] = {'chunks': chunks}
+        coords = {c: template[c].variable for c in template.coords if tdim not in template[c].dims}
+        coords[tdim] = pd.DatetimeIndex(times)
+        # A year of time steps per chunk of the time coordinate: months share its chunks,
+        # which is safe as it is only written under the lock
+        encoding[tdim] = {'units': TIME_UNITS, 'calendar': 'proleptic_gregorian', 'dtype': 'float64',
+                          'chunks': (self.year_steps(),)}
+        return xr.Dataset(data, coords=coords, attrs=template.attrs), encoding, index
+
+    def read_attrs(self):
+        return dict(zarr.open_group(self.path, path=self.group or '', mode='r').attrs)
+
+    # Function to read the month index and the variables of the store
+    def read_index(self):
+        group = zarr.open_group(self.path, path=self.group or '', mode='r')
+        return json.loads(group.attrs['month_index']), set(group.array_keys())
+
+    # Function to make room in the store for a month and the variables of `ds`;
+    # returns the (start, stop) time steps of the month. Called under the lock.
+    def allocate(self, ds, year, month):
+        tdim = time_dim(ds)
+        if not self.exists():
+            # The store is built aside and moved in place, never left half-created
+            months = months_between(self.first_month, (year, month))
+            if not months:
+                raise ValueError(f"{year}-{month:02d} is before the first month of {self.path}")
+            placeholder, encoding, index = self.placeholder(ds, months, 0)
+            placeholder.attrs['first_month'] = '%d-%02d' % self.first_month
+            placeholder.attrs['month_index'] = json.dumps(index)
+            tmp = f'{self.path}.init{os.getpid()}'
+            shutil.rmtree(tmp, ignore_errors=True)
+            placeholder.to_zarr(tmp, group=self.group, mode='w', compute=False, consolidated=True,
+                                encoding=encoding)
+            if self.group and os.path.isdir(self.path):
+                os.rename(os.path.join(tmp, self.group), os.path.join(self.path, self.group))
+                shutil.rmtree(tmp)
+                zarr.consolidate_metadata(self.path)
+            else:
+                os.rename(tmp, self.path)
+            return index[f'{year}-{month:02d}']
+
+        index, arrays = self.read_index()
+        key = f'{year}-{month:02d}'
+        length = max(stop for _, stop in index.values())
+        if key not in index:
+            first = tuple(int(v) for v in min(index).split('-'))
+            last = tuple(int(v) for v in max(index).split('-'))
+            if (year, month) < first:
+                raise ValueError(f"{key} is before the first month ({min(index)}) of {self.path}")
+            # Months after the last one are appended along time, for all the variables of the store
+            with xr.open_zarr(self.path, group=self.group, consolidated=False) as stored:
+                placeholder, encoding, new = self.placeholder(stored, months_between(last, (year, month))[1:],
+                                                              length)
+            index.update(new)
+            placeholder = placeholder.drop_vars([c for c in placeholder.coords if c != tdim])
+            placeholder.attrs['month_index'] = json.dumps(index)
+            placeholder.to_zarr(self.path, group=self.group, mode='a', append_dim=tdim, compute=False,
+                                consolidated=True)
+
+        # Variables not in the store yet are added over the whole period
+        missing = [v for v in ds.data_vars if tdim in ds[v].dims and v not in arrays]
+        if missing:
+            months = [tuple(int(v) for v in k.split('-')) for k in sorted(index)]
+            placeholder, encoding, _ = self.placeholder(ds, months, 0, variables=missing)
+            placeholder = placeholder.drop_vars([c for c in placeholder.coords if c == tdim or c in arrays])
+            placeholder.attrs = self.read_attrs()
+            encoding = {name: enc for name, enc in encoding.items() if name in placeholder.variables}
+            placeholder.to_zarr(self.path, group=self.group, mode='a', compute=False, consolidated=True,
+                                encoding=encoding)
+        return index[key]
+
+    # Function to write time-invariant fields (e.g. a land-sea mask), replacing those of the store
+    def write_static(self, ds):
+        with self.lock():
+            ds.to_zarr(self.path, group=self.group, mode='w', consolidated=True)
+            if self.group:
+                zarr.consolidate_metadata(self.path)
+
+    # Function to write the month (year, month) of `ds` into its region of the store;
+    # time steps of other months (e.g. overlap days) are dropped
+    def write_month(self, ds, year, month):
+        tdim = time_dim(ds)
+        ds = ds.sel({tdim: f'{year}-{month:02d}'}).reset_coords(drop=True)
+        expected = self.steps(year, month)
+        if ds.sizes[tdim] != expected:
+            raise ValueError(f"{year}-{month:02d} has {ds.sizes[tdim]} time steps, the store expects {expected}")
+
+        with self.lock():
+            start, stop = self.allocate(ds, year, month)
+        region = {tdim: slice(start, stop)}
+
+        # Data: one dask chunk per zarr chunk, written without the lock
+        data = ds.drop_vars([v for v in ds.variables if tdim not in ds[v].dims or v == tdim])
+        horizontal = {d for v in data.data_vars.values() for d in v.dims[-2:]}
+        data = data.chunk({d: -1 if d in horizontal else 1 for d in data.dims})
+        # Attributes are written at allocation only, region writes never touch the metadata
+        data.attrs = {}
+        for variable in data.data_vars.values():
+            variable.attrs = {}
+            variable.encoding = {}
+        data.to_zarr(self.path, group=self.group, region=region, mode='r+', consolidated=False)
+
+        # Time coordinate: region writes leave the indexes alone, so its values are written
+        # directly, under the lock as the chunks are tiny
+        hours = (ds[tdim].values - np.datetime64(TIME_ORIGIN)) / np.timedelta64(1, 'h')
+        with self.lock():
+            times = zarr.open_array(self.path, path='/'.join(filter(None, [self.group, tdim])), mode='r+')
+            times[start:stop] = hours
+        return start, stop